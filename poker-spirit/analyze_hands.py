@@ -3,12 +3,25 @@
 This script reads and processes hands written by PokerStars to their text file
 '''
 
+import datetime
+import mmap
+import os
 import re
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
+
+from instrumentation import INSTRUMENTATION
+from stats_matrix import StatsMatrix, StatLines, RATIO_BY_NAME, format_ratio, HANDS_PLAYED, VPIP, PFR, \
+    _3_BET, _3_BET_OPP, FOLDS_3_BET_OPP, CALLS_3_BET_OPP, _4_BET, _5_BET, \
+    FOLDS_TO_3_BET, CALLS_3_BET, SEEN_3_BET, C_BET, CHECKS_C_BET_OPP, C_BET_OPP, \
+    FOLDS_TO_C_BET, CALLS_C_BET, RAISES_C_BET, SEEN_C_BET, \
+    DOUBLE_BARREL_OPP, DOUBLE_BARREL, SEEN_TURN_BET, FOLDS_TO_TURN_BET
 
 
 CASH_GAME = True
 HAND_START_PATTERN = re.compile("PokerStars.*Hand #(\d+)")
+# for finding where hands start (and end) in the raw bytes of a file, before decoding anything
+HAND_START_BYTES_PATTERN = re.compile(rb"^(?:\xef\xbb\xbf)?PokerStars.*Hand #(\d+)", re.MULTILINE)
+BLANK_LINE_BYTES_PATTERN = re.compile(rb"\n[ \t]*\r?\n")
 if CASH_GAME:
     MONEY = ".+"
 else:
@@ -28,86 +41,252 @@ CHECK_PATTERN = re.compile(f"(.+): checks")
 
 TURN_PATTERN = re.compile(f"\*\*\* TURN \*\*\* \[(\w+) (\w+) (\w+)\] \[(\w+)\]")
 
+# the keyword after "player_name: " tells us what kind of action a line is
+ACTION_KEYWORDS = {
+    'calls': 'call',
+    'bets': 'bet',
+    'raises': 'raise',
+    'folds': 'fold',
+    'checks': 'check',
+}
+# the Hand method that each kind of action is routed to
+ACTION_TO_HAND_METHOD = {
+    'call': 'player_calls',
+    # a bet is just the first raise of a street
+    'bet': 'player_raises',
+    'raise': 'player_raises',
+    'fold': 'player_folds',
+    'check': 'player_checks',
+}
+PRE_FLOP_ACTIONS = frozenset({'call', 'raise', 'fold'})
+FLOP_ACTIONS = frozenset({'check', 'bet', 'call', 'raise', 'fold'})
+# the action kinds that each stage routes to the Hand (every action is still recorded in Hand.events)
+STAGE_ACTIONS = {
+    'pre-flop': PRE_FLOP_ACTIONS,
+    'flop': FLOP_ACTIONS,
+    'turn': FLOP_ACTIONS,
+    'river': FLOP_ACTIONS,
+}
+# what the text between "*** " and " ***" starts, and the stage it starts
+STREET_MARKERS = {
+    'HOLE CARDS': 'pre-flop',
+    'FLOP': 'flop',
+    'TURN': 'turn',
+    'RIVER': 'river',
+    'SHOW DOWN': 'finish-hand',
+    'SUMMARY': 'finish-hand',
+}
+
+# small codes for the streets and the actions, for Hand.events
+STAGES = ('pre-flop', 'flop', 'turn', 'river')
+STAGE_CODES = {stage: code for code, stage in enumerate(STAGES)}
+ACTIONS = ('call', 'raise', 'fold', 'check', 'bet')
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+
+def parse_action(line):
+    '''
+    Classifies a line of a hand with a single look at the keyword that follows the last ": ",
+    instead of trying every pattern in turn.
+    Returns a tuple of (action, player_name, amount), where action is one of 'small', 'big',
+    'call', 'raise', 'fold' or 'check', or None if the line is not a player action.
+    '''
+    player_name, sep, rest = line.rpartition(': ')
+    if not sep:
+        return None
+    keyword, _, amount = rest.partition(' ')
+    if keyword == 'posts':
+        if amount.startswith('small blind '):
+            return 'small', player_name, amount[len('small blind '):]
+        if amount.startswith('big blind '):
+            return 'big', player_name, amount[len('big blind '):]
+        return None
+    action = ACTION_KEYWORDS.get(keyword)
+    if action is None:
+        return None
+    if action in ('call', 'bet', 'raise') and amount == '':
+        return None
+    return action, player_name, amount
+
+
+# everything a player did in a hand that matters for the stats, one bit each of PlayerHand.flags
+PLAYER_FLAGS = (
+    'folded', 'vpip', 'pfr', 'first_to_raise_pre_flop',
+    '_3_bet', 'calls_3_bet_opp', 'folds_3_bet_opp',
+    '_4_bet', '_5_bet',
+    'folds_to_3_bet', 'calls_3_bet',
+    'c_bet', 'checks_c_bet_opp',
+    'folds_to_c_bet', 'calls_c_bet', 'raises_c_bet',
+    'double_barrel_opp', 'double_barrel',
+    'seen_turn_bet', 'folds_to_turn_bet',
+)
+# bump this whenever the way the flags are worked out from the actions changes,
+# so that flags saved in the event log get recomputed from the actions instead of being reused
+PLAYER_FLAGS_VERSION = 2
+FOLDED_FLAG, VPIP_FLAG, PFR_FLAG, FIRST_TO_RAISE_FLAG, \
+    _3_BET_FLAG, CALLS_3_BET_OPP_FLAG, FOLDS_3_BET_OPP_FLAG, \
+    _4_BET_FLAG, _5_BET_FLAG, \
+    FOLDS_TO_3_BET_FLAG, CALLS_3_BET_FLAG, \
+    C_BET_FLAG, CHECKS_C_BET_OPP_FLAG, \
+    FOLDS_TO_C_BET_FLAG, CALLS_C_BET_FLAG, RAISES_C_BET_FLAG, \
+    DOUBLE_BARREL_OPP_FLAG, DOUBLE_BARREL_FLAG, \
+    SEEN_TURN_BET_FLAG, FOLDS_TO_TURN_BET_FLAG = (1 << bit for bit in range(len(PLAYER_FLAGS)))
+
 
 class PlayerHand:
-    __slots__ = 'name', 'sb', 'bb', 'folded', \
-        'vpip', 'pfr', 'first_to_raise_pre_flop', \
-        '_3_bet', 'calls_3_bet_opp', 'folds_3_bet_opp', \
-        '_4_bet', '_5_bet', \
-        'folds_to_3_bet', 'calls_3_bet', \
-        'c_bet', 'checks_c_bet_opp',  \
-        'folds_to_c_bet', 'calls_c_bet', 'raises_c_bet', \
+    '''
+    What one player did in a hand. Everything but the blinds is packed into the bits of flags,
+    and each flag can also be read (or set) by its name, e.g. player.vpip
+    '''
+    __slots__ = 'name', 'sb', 'bb', 'flags'
     
     def __init__(self, name):
         self.name = name
         self.sb = None
         self.bb = None
-        self.folded = False
-        self.vpip = False
-        self.pfr = False
-        self.first_to_raise_pre_flop = False
-        self._3_bet = False
-        self.calls_3_bet_opp = False
-        self.folds_3_bet_opp = False                
-        self._4_bet = False
-        self._5_bet = False
-        self.folds_to_3_bet = False
-        self.calls_3_bet = False        
-        self.c_bet = False
-        self.checks_c_bet_opp = False
-        self.folds_to_c_bet = False
-        self.calls_c_bet = False
-        self.raises_c_bet = False
+        self.flags = 0
 
     def calls_pre_flop(self, num_raises):
         if num_raises == 1:
-            self.calls_3_bet_opp = True            
+            self.flags |= VPIP_FLAG | CALLS_3_BET_OPP_FLAG
         elif num_raises == 2:
-            self.calls_3_bet = True
-        self.vpip = True
+            self.flags |= VPIP_FLAG | CALLS_3_BET_FLAG
+        else:
+            self.flags |= VPIP_FLAG
         
     def raises_pre_flop(self, num_raises):
-        self.vpip = True
-        self.pfr = True            
         if num_raises == 0:
-            self.first_to_raise_pre_flop = True
+            self.flags |= VPIP_FLAG | PFR_FLAG | FIRST_TO_RAISE_FLAG
         elif num_raises == 1:
             # if already a raise, and we raising again, it's a 3 bet
-            self._3_bet = True
+            self.flags |= VPIP_FLAG | PFR_FLAG | _3_BET_FLAG
         elif num_raises == 2:
-            self._4_bet = True                
-        elif num_raises == 3:
-            self._5_bet = True
-        elif num_raises == 4:
-            self._5_bet = True
+            self.flags |= VPIP_FLAG | PFR_FLAG | _4_BET_FLAG
+        elif num_raises <= 4:
+            self.flags |= VPIP_FLAG | PFR_FLAG | _5_BET_FLAG
+        else:
+            self.flags |= VPIP_FLAG | PFR_FLAG
 
     def folds_pre_flop(self, num_raises):
-        self.folded = True
         if num_raises == 1:
-            self.folds_3_bet_opp = True                                
+            self.flags |= FOLDED_FLAG | FOLDS_3_BET_OPP_FLAG
         elif num_raises == 2:
-            self.folds_to_3_bet = True                                
+            self.flags |= FOLDED_FLAG | FOLDS_TO_3_BET_FLAG
+        else:
+            self.flags |= FOLDED_FLAG
             
     def checks_flop(self):
-        if self.pfr:
-            self.checks_c_bet_opp = True
+        if self.flags & PFR_FLAG:
+            self.flags |= CHECKS_C_BET_OPP_FLAG
 
     def calls_flop(self, active_c_bet:bool):
         if active_c_bet:
-            self.calls_c_bet = True
+            self.flags |= CALLS_C_BET_FLAG
         
     def raises_flop(self, num_raises, active_c_bet:bool):
         if active_c_bet:
-            self.raises_c_bet = True
-        if num_raises == 0 and self.pfr:               
-            self.c_bet = True
+            self.flags |= RAISES_C_BET_FLAG
+        if num_raises == 0 and self.flags & PFR_FLAG:
+            self.flags |= C_BET_FLAG
 
     def folds_flop(self, active_c_bet:bool):
-        self.folded = True            
         if active_c_bet:
-            self.folds_to_c_bet = True
+            self.flags |= FOLDED_FLAG | FOLDS_TO_C_BET_FLAG
+        else:
+            self.flags |= FOLDED_FLAG
+
+    def checks_turn(self, num_raises):
+        # whoever c-bet the flop could have kept betting
+        if num_raises == 0 and self.flags & C_BET_FLAG:
+            self.flags |= DOUBLE_BARREL_OPP_FLAG
+
+    def calls_turn(self, num_raises):
+        if num_raises == 1:
+            self.flags |= SEEN_TURN_BET_FLAG
+
+    def raises_turn(self, num_raises):
+        if num_raises == 0 and self.flags & C_BET_FLAG:
+            self.flags |= DOUBLE_BARREL_OPP_FLAG | DOUBLE_BARREL_FLAG
+        elif num_raises == 1:
+            self.flags |= SEEN_TURN_BET_FLAG
+
+    def folds_turn(self, num_raises):
+        if num_raises == 1:
+            self.flags |= FOLDED_FLAG | SEEN_TURN_BET_FLAG | FOLDS_TO_TURN_BET_FLAG
+        else:
+            self.flags |= FOLDED_FLAG
+
+
+def flag_property(flag):
+    def get_flag(player):
+        return bool(player.flags & flag)
+
+    def set_flag(player, val):
+        if val:
+            player.flags |= flag
+        else:
+            player.flags &= ~flag
+    return property(get_flag, set_flag)
+
+
+for bit, flag_name in enumerate(PLAYER_FLAGS):
+    setattr(PlayerHand, flag_name, flag_property(1 << bit))
+
+
+StatRule = namedtuple('StatRule', ['columns', 'when', 'unless'], defaults=(0,))
+
+# which counters a player's hand adds one to: a rule applies when all of the flags in when
+# are set and none of those in unless are. Adding a stat is adding its column and a rule here.
+STAT_RULES = (
+    StatRule((HANDS_PLAYED,), 0),
+    StatRule((VPIP,), VPIP_FLAG),
+    StatRule((PFR,), PFR_FLAG),
+
+    StatRule((_3_BET, _3_BET_OPP), _3_BET_FLAG),
+    StatRule((FOLDS_3_BET_OPP, _3_BET_OPP), FOLDS_3_BET_OPP_FLAG),
+    StatRule((CALLS_3_BET_OPP, _3_BET_OPP), CALLS_3_BET_OPP_FLAG),
+
+    StatRule((_5_BET,), _5_BET_FLAG),
+
+    StatRule((FOLDS_TO_3_BET, SEEN_3_BET), FOLDS_TO_3_BET_FLAG),
+    StatRule((CALLS_3_BET, SEEN_3_BET), CALLS_3_BET_FLAG, unless=FOLDS_TO_3_BET_FLAG),
+    StatRule((_4_BET, SEEN_3_BET), _4_BET_FLAG, unless=FOLDS_TO_3_BET_FLAG | CALLS_3_BET_FLAG),
+
+    StatRule((C_BET, C_BET_OPP), C_BET_FLAG),
+    StatRule((CHECKS_C_BET_OPP, C_BET_OPP), CHECKS_C_BET_OPP_FLAG, unless=C_BET_FLAG),
+
+    StatRule((FOLDS_TO_C_BET, SEEN_C_BET), FOLDS_TO_C_BET_FLAG),
+    StatRule((CALLS_C_BET, SEEN_C_BET), CALLS_C_BET_FLAG, unless=FOLDS_TO_C_BET_FLAG),
+    StatRule((RAISES_C_BET, SEEN_C_BET), RAISES_C_BET_FLAG, unless=FOLDS_TO_C_BET_FLAG | CALLS_C_BET_FLAG),
+
+    StatRule((DOUBLE_BARREL_OPP,), DOUBLE_BARREL_OPP_FLAG),
+    StatRule((DOUBLE_BARREL,), DOUBLE_BARREL_FLAG),
+    StatRule((SEEN_TURN_BET,), SEEN_TURN_BET_FLAG),
+    StatRule((FOLDS_TO_TURN_BET,), FOLDS_TO_TURN_BET_FLAG),
+)
+
+# flags -> the columns that a hand with those flags adds one to.
+# Only a few hundred of the possible patterns ever happen, so they are compiled the first time we see them
+STAT_COLUMNS_BY_FLAGS = {}
+# the same, for any other set of rules (e.g. when replaying the event log with new stats)
+STAT_COLUMNS_BY_RULES = {STAT_RULES: STAT_COLUMNS_BY_FLAGS}
 
 
+def stat_columns(flags, rules=STAT_RULES):
+    '''
+    Returns the columns (as a tuple, a column can appear more than once) that a player's hand
+    with these flags counts towards, going through the rules only the first time we see the flags
+    '''
+    columns_by_flags = STAT_COLUMNS_BY_FLAGS if rules is STAT_RULES else STAT_COLUMNS_BY_RULES.setdefault(rules, {})
+    columns = columns_by_flags.get(flags)
+    if columns is None:
+        columns = ()
+        for rule in rules:
+            if flags & rule.when == rule.when and not flags & rule.unless:
+                columns += rule.columns
+        columns_by_flags[flags] = columns
+    return columns
+
 
 class Hand:
 
@@ -117,9 +296,13 @@ class Hand:
         'turn': 'river',
         'river': 'finish-hand'
     }
+    # what the player_* action methods read and change besides the stage and the acting player's flags
+    # (event_log.replay_flags relies on this being everything, so add any new counter here)
+    ACTION_STATE = ('num_pre_flop_raises', 'num_flop_raises', 'active_flop_c_bet', 'num_turn_raises')
     
     
-    def __init__(self, sb_index=None):
+    def __init__(self, sb_index=None, hand_number=None):
+        self.hand_number = hand_number
         self.players = {}
         self.player_order = []
         self.stage = 'pre-flop'
@@ -132,14 +315,19 @@ class Hand:
         self.num_flop_raises = 0
         self.active_flop_c_bet = False
 
+        # turn stats
+        self.num_turn_raises = 0
+
+        # every action of the hand in order, two bytes each: the index of the player in player_order,
+        # then the stage code * 16 + the action code. Enough to replay the hand without the text
+        self.events = bytearray()
+
 
     def advance_stage(self):
         if self.stage == 'finish-hand':
-            print('already over!')
+            # already over
             return
-        print(f'advancing from {self.stage}')
         self.stage = self.STAGE_TO_NEXT[self.stage]
-        print(f'new stage = {self.stage}')
         
     def add_player(self, player_name):
         self.players[player_name] = PlayerHand(name=player_name)        
@@ -159,7 +347,7 @@ class Hand:
             true_index = index % len(self.player_order) # want to keep wrapping around the players in a circle
             player_name = self.player_order[true_index]
             player = self.get_player(player_name)
-            if player.folded:
+            if player.flags & FOLDED_FLAG:
                 continue
             yield player_name
 
@@ -174,6 +362,11 @@ class Hand:
             yield player_name
     '''
     
+    def record_action(self, player_name, action):
+        if player_name in self.players:
+            self.events += bytes((self.player_order.index(player_name),
+                                  STAGE_CODES[self.stage] << 4 | ACTION_CODES[action]))
+
     def set_sb(self, player_name, sb=1):
         self.players[player_name].sb = sb
         self.sb_index = self.player_order.index(player_name)
@@ -184,8 +377,10 @@ class Hand:
 
     def player_checks(self, player_name):
         player = self.players[player_name]
-        if self.stage == 'pre-flop':
+        if self.stage == 'flop':
             player.checks_flop()
+        elif self.stage == 'turn':
+            player.checks_turn(num_raises=self.num_turn_raises)
 
 
     def player_raises(self, player_name):
@@ -196,10 +391,10 @@ class Hand:
         elif self.stage == 'flop':
             player.raises_flop(num_raises=self.num_flop_raises, active_c_bet=self.active_flop_c_bet)
             self.num_flop_raises += 1
-            if player.c_bet:
-                self.active_flop_c_bet = True
-            else:
-                self.active_flop_c_bet = False
+            self.active_flop_c_bet = bool(player.flags & C_BET_FLAG)
+        elif self.stage == 'turn':
+            player.raises_turn(num_raises=self.num_turn_raises)
+            self.num_turn_raises += 1
 
     
     def player_folds(self, player_name):
@@ -208,92 +403,86 @@ class Hand:
             player.folds_pre_flop(num_raises=self.num_pre_flop_raises)
         elif self.stage == 'flop':
             player.folds_flop(active_c_bet=self.active_flop_c_bet)            
+        elif self.stage == 'turn':
+            player.folds_turn(num_raises=self.num_turn_raises)
+        else:
+            player.flags |= FOLDED_FLAG
     
     def player_calls(self, player_name):
         player = self.players[player_name]        
         if self.stage == 'pre-flop':
-            print('pre flop call baby!')
             player.calls_pre_flop(num_raises=self.num_pre_flop_raises)
         elif self.stage == 'flop':        
             player.calls_flop(active_c_bet=self.active_flop_c_bet)
+        elif self.stage == 'turn':
+            player.calls_turn(num_raises=self.num_turn_raises)
         
 
-def assign_stats_from_hand(game_stats, hand):
+def assign_stats_from_hand(game_stats, hand, rules=STAT_RULES):
     '''
     Looks through hand information, and adds to the stats for each
-    corresponding player in game_stats.
+    corresponding player in game_stats (a StatsMatrix).
     If a player in the hand is not in game_stats, then add them.
     '''
-
+    columns_by_flags = STAT_COLUMNS_BY_FLAGS if rules is STAT_RULES else STAT_COLUMNS_BY_RULES.setdefault(rules, {})
+    player_id = game_stats.player_id
+    add = game_stats.add
     for player_name, player in hand.players.items():
+        flags = player.flags
+        columns = columns_by_flags.get(flags)
+        if columns is None:
+            columns = stat_columns(flags, rules)
+        add(player_id(player_name), columns)
+
+
+def merge_game_stats(game_stats, other_game_stats):
+    '''
+    Adds the stats of every player in other_game_stats into game_stats,
+    e.g. to combine the results of analyzing several files.
+    '''
+    for player_name, other_stats in other_game_stats.items():
         if player_name not in game_stats:
-            player_stats = defaultdict(int)
-            game_stats[player_name] = player_stats
-            # for storage, we want the stats dictionary to know the player/game info
-            #game_stats[player_name]['player_name'] = player_name
-            #game_stats[player_name]['game_id'] = self.game_id
-        else:
-            player_stats = game_stats[player_name]
-            
-        player_stats['hands_played'] += 1
-        if player.vpip:
-            player_stats['vpip'] += 1
-        if player.pfr:
-            player_stats['pfr'] += 1
-
-        if player._3_bet:
-            player_stats['3_bet'] += 1
-            player_stats['3_bet_opp'] += 1            
-        if player.folds_3_bet_opp:
-            player_stats['folds_3_bet_opp'] += 1            
-            player_stats['3_bet_opp'] += 1
-        if player.calls_3_bet_opp:
-            player_stats['calls_3_bet_opp'] += 1            
-            player_stats['3_bet_opp'] += 1
-
-        if player._5_bet:
-            player_stats['5_bet'] += 1
-
-        if player.folds_to_3_bet:
-            player_stats['folds_to_3_bet'] += 1
-            player_stats['seen_3_bet'] += 1            
-        elif player.calls_3_bet:
-            player_stats['calls_3_bet'] += 1
-            player_stats['seen_3_bet'] += 1            
-        elif player._4_bet:
-            player_stats['4_bet'] += 1
-            player_stats['seen_3_bet'] += 1            
-
-        if player.c_bet:
-            player_stats['c_bet'] += 1
-            player_stats['c_bet_opp'] += 1            
-        elif player.checks_c_bet_opp:
-            player_stats['checks_c_bet_opp'] += 1
-            player_stats['c_bet_opp'] += 1
-
-        if player.folds_to_c_bet:
-            player_stats['folds_to_c_bet'] += 1
-            player_stats['seen_c_bet'] += 1            
-        elif player.calls_c_bet:
-            player_stats['calls_c_bet'] += 1
-            player_stats['seen_c_bet'] += 1            
-        elif player.raises_c_bet:
-            player_stats['raises_c_bet'] += 1
-            player_stats['seen_c_bet'] += 1            
+            game_stats[player_name] = defaultdict(int)
+        player_stats = game_stats[player_name]
+        for stat, val in other_stats.items():
+            player_stats[stat] += val
+    return game_stats
 
-            
+
+def ratio_str(name):
+    '''
+    Makes the GameIO.*_str helper for the ratio called name in stats_matrix.RATIOS
+    '''
+    ratio = RATIO_BY_NAME[name]
+    numerator, denominator = ratio.numerator, ratio.denominator
+
+    def stat_str(game_stats, player_name):
+        stats = game_stats[player_name]
+        return format_ratio(ratio, stats[numerator], stats[denominator])
+    return staticmethod(stat_str)
 
 
 class GameIO:
 
     def __init__(self):
-        self.game_stats = {}
+        self.game_stats = StatsMatrix()
         self.game_id = None
         self.current_hand = None        
         self.current_players = []
         self.__current_sb = None 
         self.current_bb = None
+        # every finished hand. A plain list keeps them all; an event_log.HandHistory only keeps the last few
         self.hands = []
+        # the numbers of the hands counted in game_stats
+        self.hand_numbers = set()
+        # if given, the IngestedHands of the stats db, so we can skip hands saved as part of another game
+        self.ingested_hands = None
+        self.num_duplicate_hands = 0
+        # if given, a stats_matrix.RollingStats (or DecayedStats) that every finished hand is also counted in
+        self.recent_stats = None
+        # if given, a multi_table.SharedStats that every finished hand is also counted in (e.g. from several tables)
+        self.shared_stats = None
+        self.stat_lines = StatLines()
 
 
     def add_player(self, player_name):
@@ -317,9 +506,26 @@ class GameIO:
         '''
         Update the blind positions
         '''
-        self.current_players = self.current_hand.player_order # for knowing who is still at the table        
-        assign_stats_from_hand(self.game_stats, self.current_hand)
+        # a copy, since add_player appends to current_players while the next hand is set up
+        self.current_players = list(self.current_hand.player_order) # for knowing who is still at the table        
+        with INSTRUMENTATION.timer('aggregate.hand'):
+            assign_stats_from_hand(self.game_stats, self.current_hand)
+            if self.recent_stats is not None:
+                assign_stats_from_hand(self.recent_stats, self.current_hand)
+            if self.shared_stats is not None:
+                self.shared_stats.add_hand(self.current_hand)
         self.hands.append(self.current_hand)
+        if self.current_hand.hand_number is not None:
+            self.hand_numbers.add(self.current_hand.hand_number)
+
+    def is_duplicate_hand(self, hand_number):
+        '''
+        True if we have already counted this hand, either in this game or (if we have
+        the IngestedHands of the stats db) as part of another game that has been saved
+        '''
+        if hand_number in self.hand_numbers:
+            return True
+        return self.ingested_hands is not None and self.ingested_hands.is_duplicate(hand_number, self.game_id)
         
     @staticmethod
     def hands_played_str(game_stats, player_name):
@@ -327,118 +533,36 @@ class GameIO:
         hands_played = stats['hands_played']
         return f'Hands played = {hands_played}'
 
-    @staticmethod    
-    def vpip_str(game_stats, player_name):
-        stats = game_stats[player_name]
-        hands_played = stats['hands_played']
-        if hands_played > 0:
-            return f'VPIP = {stats["vpip"]}/{hands_played} = {round(100*stats["vpip"]/hands_played, 1)}'
-        else:
-            return f'VPIP = {stats["vpip"]}/{hands_played} = NA'
-
-    @staticmethod        
-    def pfr_str(game_stats, player_name):
-        stats = game_stats[player_name]
-        hands_played = stats['hands_played']
-        if hands_played > 0:
-            return f'PFR = {stats["pfr"]}/{hands_played} = {round(100*stats["pfr"]/hands_played, 1)}'
-        else:
-            return f'PFR = {stats["pfr"]}/{hands_played} = NA'
-
-    @staticmethod        
-    def _3_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]
-        if stats['3_bet_opp'] > 0:        
-            return f'3-Bet = {stats["3_bet"]}/{stats["3_bet_opp"]} = {round(100*stats["3_bet"]/stats["3_bet_opp"], 1)}'
-        else:
-            return f'3-Bet = {stats["3_bet"]}/{stats["3_bet_opp"]} = NA'
-
-    @staticmethod
-    def _4_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]
-        if stats['4_bet_opp'] > 0:        
-            return f'4-Bet = {stats["4_bet"]}/{stats["4_bet_opp"]} = {round(100*stats["4_bet"]/stats["4_bet_opp"], 1)}'
-        else:
-            return f'4-Bet = NA'
-
-    @staticmethod        
-    def folds_to_3_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['seen_3_bet'] > 0:
-            return f'Folds 3-Bet = {stats["folds_to_3_bet"]}/{stats["seen_3_bet"]} = {round(100*stats["folds_to_3_bet"]/stats["seen_3_bet"], 1)}'
-        else:
-            return f'Folds 3-Bet = NA'
-        
-    @staticmethod
-    def calls_3_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['seen_3_bet'] > 0:
-            return f'Calls 3-Bet = {stats["calls_3_bet"]}/{stats["seen_3_bet"]} = {round(100*stats["calls_3_bet"]/stats["seen_3_bet"], 1)}'
-        else:
-            return f'Calls 3-Bet = NA'
-        
-    @staticmethod
-    def folds_to_c_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['seen_c_bet'] > 0:
-            return f'Folds C-Bet = {stats["folds_to_c_bet"]}/{stats["seen_c_bet"]} = {round(100*stats["folds_to_c_bet"]/stats["seen_c_bet"], 1)}'
-        else:
-            return f'Folds C-Bet = NA'
-
-    @staticmethod        
-    def calls_c_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['seen_c_bet'] > 0:
-            return f'Calls C-Bet = {stats["calls_c_bet"]}/{stats["seen_c_bet"]} = {round(100*stats["calls_c_bet"]/stats["seen_c_bet"], 1)}'
-        else:
-            return f'Calls C-Bet = NA'
-
-    @staticmethod        
-    def raises_c_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['seen_c_bet'] > 0:
-            return f'Raises C-Bet = {stats["raises_c_bet"]}/{stats["seen_c_bet"]} = {round(100*stats["raises_c_bet"]/stats["seen_c_bet"], 1)}'
-        else:
-            return f'Raises C-Bet = NA'
-
-    @staticmethod        
-    def c_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['c_bet_opp'] > 0:
-            return f'C-Bet = {stats["c_bet"]}/{stats["c_bet_opp"]} = {round(100*stats["c_bet"]/stats["c_bet_opp"], 1)}'
-        else:
-            return f'C-Bet = NA'
-        
-    @staticmethod
-    def checks_c_bet_str(game_stats, player_name):
-        stats = game_stats[player_name]        
-        if stats['c_bet_opp'] > 0:
-            return f'Checks C-Bet Opp. = {stats["checks_c_bet_opp"]}/{stats["c_bet_opp"]} = {round(100*stats["checks_c_bet_opp"]/stats["c_bet_opp"], 1)}'
-        else:
-            return f'Checks C-Bet Opp. = NA'
+    vpip_str = ratio_str('vpip')
+    pfr_str = ratio_str('pfr')
+    _3_bet_str = ratio_str('3_bet')
+    _4_bet_str = ratio_str('4_bet')
+    folds_to_3_bet_str = ratio_str('folds_to_3_bet')
+    calls_3_bet_str = ratio_str('calls_3_bet')
+    folds_to_c_bet_str = ratio_str('folds_to_c_bet')
+    calls_c_bet_str = ratio_str('calls_c_bet')
+    raises_c_bet_str = ratio_str('raises_c_bet')
+    c_bet_str = ratio_str('c_bet')
+    checks_c_bet_str = ratio_str('checks_c_bet_opp')
+    double_barrel_str = ratio_str('double_barrel')
+    folds_to_turn_bet_str = ratio_str('folds_to_turn_bet')
         
     def print_stats(self):
         for player_name in sorted(self.current_players, key=lambda x: x.lower() ):
             print(f'Player: {player_name}')
             print(GameIO.hands_played_str(self.game_stats, player_name))
-            print(GameIO.vpip_str(self.game_stats, player_name))
-            print(GameIO.pfr_str(self.game_stats, player_name))
-            print(GameIO._3_bet_str(self.game_stats, player_name))
-            print(GameIO._4_bet_str(self.game_stats, player_name))            
-
-            print(GameIO.folds_to_3_bet_str(self.game_stats, player_name))
-            print(GameIO.calls_3_bet_str(self.game_stats, player_name))
-
-            print(GameIO.folds_to_c_bet_str(self.game_stats, player_name))
-            print(GameIO.calls_c_bet_str(self.game_stats, player_name))
-            print(GameIO.raises_c_bet_str(self.game_stats, player_name))            
-
-            print(GameIO.c_bet_str(self.game_stats, player_name))
-            print(GameIO.checks_c_bet_str(self.game_stats, player_name))
+            # every ratio, in the order of RATIOS
+            for line in self.stat_lines.lines(self.game_stats, player_name):
+                print(line)
             print()
 
 class LiveGameIO(GameIO):
 
+    def __init__(self):
+        super().__init__()
+        # a live game has no file to name it after, so each session is its own game, named by when it started
+        self.game_id = f'live {datetime.datetime.now():%Y-%m-%d %H:%M:%S}'
+
     def finish_hand(self):
         # in a live game, we need to manage who the blinds are
         super().finish_hand()
@@ -447,141 +571,203 @@ class LiveGameIO(GameIO):
 
         
 class PokerStarsGameIO(GameIO):
+    # how many hands run_file analyzes between progress reports
+    PROGRESS_INTERVAL = 200
     
-    def __init__(self, path_to_file):
+    def __init__(self, path_to_file, hand_index=None, ingested_hands=None, hands=None):
         super().__init__()
+        if hands is not None:
+            self.hands = hands
         self.path_to_file = path_to_file
-        self.game_id = path_to_file.split("/")[-1].split()[0]
-        print(f'game id = {self.game_id}')
-    
-    def set_up_hand(self, hand_lines):
-        for i, line in enumerate(hand_lines):
-            seat_match = SEAT_PATTERN.match(line)
-            if seat_match:
-                player_name = seat_match.group(2)
-                self.add_player(player_name)
-                continue
-
-            small_match = SMALL_PATTERN.match(line)
-            if small_match:
-                player_name = small_match.group(1)
-                sb = small_match.group(2)
-                self.current_hand.set_sb(player_name, sb)
-                self.current_sb = player_name
-                continue
-
-            big_match = BIG_PATTERN.match(line)
-            if big_match:
-                player_name = big_match.group(1)
-                bb = big_match.group(2)
-                self.current_hand.set_bb(player_name, bb)
-                self.current_bb = player_name
-                # once we found the big blind we break
-                break
-        self.last_set_up_index = i
-        # after the big blind is the line "*** HOLE CARDS ***",
-        # so we skip past that
-        self.pre_flop_index = self.last_set_up_index + 2
+        self.ingested_hands = ingested_hands
+        # every table gets its own file (e.g. "HH20200501 Table Name.txt"), so the file name is the game.
+        # just the date at the start of it would be shared by every table played that day,
+        # and saving one of them would replace the records of the others
+        self.game_id = os.path.splitext(os.path.basename(path_to_file))[0]
+        self.file_offset = 0 # bytes of the file that have already been processed
+        # if given, a HandIndex that records where in the file each hand we parse is
+        self.hand_index = hand_index
     
-    def analyze_pre_flop(self, hand_lines):
-        for i, line in enumerate(hand_lines[self.pre_flop_index:]):
-            flop_match = FLOP_PATTERN.match(line)
-            if flop_match:
-                break
-
-            call_match = CALL_PATTERN.match(line)
-            if call_match:
-                player_name = call_match.group(1)
-                self.current_hand.player_calls(player_name)
-                continue
-
-            raise_match = RAISE_PATTERN.match(line)
-            if raise_match:
-                player_name = raise_match.group(1)
-                self.current_hand.player_raises(player_name)                
-                continue
-
-            fold_match = FOLD_PATTERN.match(line)
-            if fold_match:
-                player_name = fold_match.group(1)
-                self.current_hand.player_folds(player_name)
-                continue
-
-        self.current_hand.advance_stage()            
-        self.flop_index = self.pre_flop_index + i
-
-        
-    def analyze_flop(self, hand_lines):
-        for i, line in enumerate(hand_lines[self.flop_index:]):
-            turn_match = TURN_PATTERN.match(line)
-            if turn_match:
-                break
-
-            check_match = CHECK_PATTERN.match(line)
-            if check_match:
-                player_name = check_match.group(1)
-                self.current_hand.player_checks(player_name)
+    def analyze_hand(self, hand_lines):
+        '''
+        Goes through the lines of the hand once, from the seats and blinds down to the showdown.
+        Each street marker ("*** FLOP ***" and so on) advances the Hand to its stage, and every
+        action in between is recorded and routed to the Hand for the current stage.
+        '''
+        hand = self.current_hand
+        setting_up = True # until the hole cards are dealt, we're looking for the seats and blinds
+        found_bb = False
+        # how many lines matched each kind of line, only kept while instrumenting
+        line_counts = defaultdict(int) if INSTRUMENTATION.enabled else None
+        for line in hand_lines:
+            if line.startswith('*** '):
+                if line_counts is not None:
+                    line_counts['street'] += 1
+                stage = STREET_MARKERS.get(line[4:].partition(' ***')[0])
+                if stage is None:
+                    continue
+                if stage == 'finish-hand':
+                    # nothing after the show down or the summary is an action
+                    break
+                if stage == 'pre-flop':
+                    setting_up = False
+                    continue
+                while hand.stage != stage and hand.stage != 'finish-hand':
+                    hand.advance_stage()
                 continue
 
-            call_match = CALL_PATTERN.match(line)
-            if call_match:
-                player_name = call_match.group(1)
-                self.current_hand.player_calls(player_name)
-                continue
-            
-            raise_match = RAISE_PATTERN.match(line)
-            if raise_match:
-                player_name = raise_match.group(1)
-                self.current_hand.player_raises(player_name)
+            if setting_up:
+                if line.startswith('Seat '):
+                    seat_match = SEAT_PATTERN.match(line)
+                    if seat_match:
+                        if line_counts is not None:
+                            line_counts['seat'] += 1
+                        self.add_player(seat_match.group(2))
+                        continue
+                parsed = parse_action(line)
+                if line_counts is not None:
+                    line_counts[parsed[0] if parsed is not None else 'unmatched'] += 1
+                if parsed is None:
+                    continue
+                action, player_name, amount = parsed
+                if action == 'small' and hand.sb_index is None:
+                    hand.set_sb(player_name, amount)
+                    self.current_sb = player_name
+                elif action == 'big' and not found_bb:
+                    hand.set_bb(player_name, amount)
+                    self.current_bb = player_name
+                    found_bb = True
                 continue
 
-            fold_match = FOLD_PATTERN.match(line)
-            if fold_match:
-                player_name = fold_match.group(1)
-                self.current_hand.player_folds(player_name)
+            parsed = parse_action(line)
+            if line_counts is not None:
+                line_counts[parsed[0] if parsed is not None else 'unmatched'] += 1
+            if parsed is None:
                 continue
-
-        self.current_hand.advance_stage()
-        self.turn_index = self.flop_index + i
-        
-    def process_single_hand(self, hand_lines):
+            action, player_name, _ = parsed
+            if action in ACTION_CODES:
+                hand.record_action(player_name, action)
+                if action in STAGE_ACTIONS[hand.stage]:
+                    getattr(hand, ACTION_TO_HAND_METHOD[action])(player_name)
+        if line_counts is not None:
+            INSTRUMENTATION.add_counts(line_counts, 'lines.')
+
+    def process_single_hand(self, hand_lines, hand_number=None):
         ''' given all the lines of the text file that correspond to a given hand,
-        analyze what happens
+        analyze what happens.
+        Returns False if the hand was skipped, because it has already been counted.
         '''
         if hand_lines == []:
-            return
-
-        self.current_hand = Hand()
-        self.set_up_hand(hand_lines)
-        self.analyze_pre_flop(hand_lines)
-        self.analyze_flop(hand_lines)
+            return False
+
+        if hand_number is None:
+            hand_match = HAND_START_PATTERN.match(hand_lines[0])
+            if hand_match:
+                hand_number = int(hand_match.group(1))
+        if hand_number is not None and self.is_duplicate_hand(hand_number):
+            self.num_duplicate_hands += 1
+            INSTRUMENTATION.count('hands.duplicate')
+            return False
+        self.current_hand = Hand(hand_number=hand_number)
+        with INSTRUMENTATION.timer('parse.hand'):
+            self.analyze_hand(hand_lines)
         self.finish_hand()
-        #self.add_hand(self.current_hand)
+        INSTRUMENTATION.count('hands.parsed')
+        return True
         
 
-    def run_file(self):
-        print(f"opening file = {self.path_to_file}")
-        with open(self.path_to_file, 'r') as file:
-            lines = file.read().split('\n')
-            start_index = 0
-            end_index = 0
-            for line in lines:
-                end_index += 1
-                hand_match = HAND_START_PATTERN.match(line)
-                if hand_match:
-                    hand_lines = lines[start_index: end_index]
-                    self.process_single_hand(hand_lines)
-                    start_index = end_index
+    def read_hand_spans(self):
+        '''
+        Memory maps the file and yields (hand_number, offset, length, hand_lines) for each hand
+        that has been completely written since the last call, one hand at a time, so only one hand
+        is ever copied out of the file. offset and length are the hand's position in bytes.
+        A hand is complete once it is followed by a blank line or by the start of the next hand.
+        A trailing hand that PokerStars is still writing is left for the next call.
+        '''
+        with open(self.path_to_file, 'rb') as file:
+            if os.fstat(file.fileno()).st_size <= self.file_offset:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                next_start = HAND_START_BYTES_PATTERN.search(buffer, self.file_offset)
+                while next_start is not None:
+                    start = next_start.start()
+                    hand_number = int(next_start.group(1))
+                    next_start = HAND_START_BYTES_PATTERN.search(buffer, next_start.end())
+                    blank_line = BLANK_LINE_BYTES_PATTERN.search(buffer, start)
+                    if blank_line is not None and (next_start is None or blank_line.start() < next_start.start()):
+                        end = blank_line.start()
+                    elif next_start is not None:
+                        end = next_start.start()
+                    else:
+                        # the hand is not finished yet, so start from its first line next time
+                        self.file_offset = start
+                        return
+                    hand_lines = buffer[start:end].decode('utf-8', errors='replace').lstrip('\ufeff').splitlines()
+                    self.file_offset = end
+                    yield hand_number, start, end - start, hand_lines
+
+    def read_new_hands(self):
+        '''
+        Yields the lines of each hand that has been completely written since the last call
+        '''
+        for _, _, _, hand_lines in self.read_hand_spans():
+            yield hand_lines
 
+    def run_file(self, progress=None, cancelled=None):
+        '''
+        Analyzes the hands in the file. Only the hands written since the previous call
+        are processed, so calling this again on a growing file just follows along.
+        If given, progress(bytes_done, bytes_total, hands_done) is called every PROGRESS_INTERVAL hands,
+        and we stop early (after a whole hand, so the next call carries on from there)
+        as soon as cancelled() returns True.
+        '''
+        print(f"opening file = {self.path_to_file}")
+        self.analyze_new_hands(progress, cancelled)
         self.print_stats()        
 
+    def analyze_new_hands(self, progress=None, cancelled=None):
+        '''
+        run_file without printing the stats: analyzes the hands written since the previous call,
+        and returns how many there were
+        '''
+        with INSTRUMENTATION.timer('read.new_hands'):
+            return self._analyze_new_hands(progress, cancelled)
+
+    def _analyze_new_hands(self, progress, cancelled):
+        bytes_total = os.path.getsize(self.path_to_file)
+        start_offset = self.file_offset
+        hands_done = 0
+        for hand_number, offset, length, hand_lines in self.read_hand_spans():
+            counted = self.process_single_hand(hand_lines, hand_number)
+            if counted and self.hand_index is not None:
+                self.hand_index.add_hand(hand_number, self.path_to_file, offset, length, self.current_hand.player_order)
+            hands_done += 1
+            if progress is not None and hands_done % self.PROGRESS_INTERVAL == 0:
+                progress(self.file_offset, bytes_total, hands_done)
+            if cancelled is not None and cancelled():
+                break
+        if progress is not None:
+            progress(self.file_offset, bytes_total, hands_done)
+        if self.hand_index is not None:
+            with INSTRUMENTATION.timer('hand_index.commit'):
+                self.hand_index.commit()
+        INSTRUMENTATION.count('read.bytes', self.file_offset - start_offset)
+        return hands_done
+
+
 if __name__ == "__main__":
-    import os
+    import argparse
+    import instrumentation
     from dotenv import load_dotenv
     load_dotenv()
+    parser = argparse.ArgumentParser(description='Analyze a PokerStars hand history file and print the stats.')
     # get env vars from .env file
-    path_to_file = os.getenv("PATH_TO_FILE", ".")
+    parser.add_argument('path_to_file', nargs='?', default=os.getenv("PATH_TO_FILE", "."))
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.enable_from_arguments(args)
     
-    game = PokerStarsGameIO(path_to_file)
+    game = PokerStarsGameIO(args.path_to_file)
     game.run_file()
+    instrumentation.dump_from_arguments(args)
 
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+'''
+Measures how long the hud takes to refresh the player windows of a full 9 handed table
+(18 windows), refreshing after every hand of a synthetic history like the hud does when
+following a game. Needs a display, since it draws real windows.
+
+usage: python bench_hud.py [--hands N]
+'''
+
+import argparse
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import tkinter as tk
+
+from analyze_hands import PokerStarsGameIO
+from hand_history_generator import write_history
+from hud import PlayerWindowsManager
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time refreshing the hud player windows.')
+    parser.add_argument('--hands', type=int, default=500)
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    root.withdraw()
+    pwm = PlayerWindowsManager(root)
+    career_stats_by_player = defaultdict(lambda: defaultdict(int))
+    refresh_times = []
+    lines_updated = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        path_to_file = write_history(os.path.join(work_dir, 'HH20200501 Synthetic.txt'), args.hands, num_seats=9)
+        game = PokerStarsGameIO(path_to_file)
+        for hand_number, _, _, hand_lines in game.read_hand_spans():
+            game.process_single_hand(hand_lines, hand_number)
+            start = time.perf_counter()
+            pwm.populate(game, career_stats_by_player)
+            # include Tk actually redrawing the windows
+            root.update_idletasks()
+            refresh_times.append(time.perf_counter() - start)
+            lines_updated.append(pwm.last_num_lines_updated)
+
+    num_lines = len(PlayerWindowsManager.STAT_NAMES) * (len(pwm.player_windows) + len(pwm.player_career_windows))
+    steady = sorted(refresh_times[1:]) # the first refresh creates the windows
+    print(f'{len(pwm.player_windows) + len(pwm.player_career_windows)} windows, {len(refresh_times)} refreshes')
+    print(f'first refresh {1000 * refresh_times[0]:.1f} ms')
+    print(f'refresh mean {1000 * sum(steady) / len(steady):.2f} ms, '
+          f'95th percentile {1000 * steady[int(0.95 * (len(steady) - 1))]:.2f} ms, max {1000 * steady[-1]:.2f} ms')
+    print(f'lines redrawn per refresh {sum(lines_updated[1:]) / len(steady):.1f} of {num_lines}')
+    pwm.destroy()
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
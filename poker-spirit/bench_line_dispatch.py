@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''
+Compares how many hand history lines per second we can classify with the old
+sequential regex cascade versus the single pass parse_action dispatcher.
+
+usage: python bench_line_dispatch.py [num_hands]
+'''
+
+import argparse
+import random
+import re
+import time
+
+from analyze_hands import MONEY, SEAT_PATTERN, SMALL_PATTERN, BIG_PATTERN, \
+    CALL_PATTERN, RAISE_PATTERN, FOLD_PATTERN, CHECK_PATTERN, parse_action
+
+# the old patterns never had one for bets, but parse_action tells them apart from raises,
+# so the cascade needs it too to classify the same lines
+BET_PATTERN = re.compile(f"(.+): bets ({MONEY})")
+
+
+def make_synthetic_lines(num_hands, seed=0):
+    '''
+    Builds the lines of a large synthetic history, with long player names since those
+    are what make the "(.+):" prefixes backtrack.
+    '''
+    rng = random.Random(seed)
+    names = [f'a_rather_long_player_name_{i:03d}_' + 'x' * rng.randint(0, 20) for i in range(200)]
+    lines = []
+    for hand_number in range(num_hands):
+        players = rng.sample(names, 6)
+        lines.append(f"PokerStars Hand #{hand_number}: Hold'em No Limit ($0.01/$0.02 USD) - 2020/05/01 10:00:00 ET")
+        lines.append("Table 'Synthetic' 6-max Seat #1 is the button")
+        for seat, name in enumerate(players, 1):
+            lines.append(f'Seat {seat}: {name} ($2 in chips)')
+        lines.append(f'{players[0]}: posts small blind $0.01')
+        lines.append(f'{players[1]}: posts big blind $0.02')
+        lines.append('*** HOLE CARDS ***')
+        lines.append(f'{players[2]}: raises $0.04 to $0.06')
+        for name in players[3:]:
+            lines.append(f'{name}: folds')
+        lines.append(f'{players[0]}: calls $0.05')
+        lines.append(f'{players[1]}: folds')
+        lines.append('*** FLOP *** [2c 7d 9h]')
+        lines.append(f'{players[0]}: checks')
+        lines.append(f'{players[2]}: bets $0.10')
+        lines.append(f'{players[0]}: folds')
+        lines.append(f'Uncalled bet ($0.10) returned to {players[2]}')
+        lines.append(f'{players[2]} collected $0.12 from pot')
+        lines.append('*** SUMMARY ***')
+    return lines
+
+
+def classify_with_cascade(line):
+    # the way set_up_hand, analyze_pre_flop and analyze_flop used to look at every line
+    if SEAT_PATTERN.match(line):
+        return 'seat'
+    if SMALL_PATTERN.match(line):
+        return 'small'
+    if BIG_PATTERN.match(line):
+        return 'big'
+    if CALL_PATTERN.match(line):
+        return 'call'
+    if RAISE_PATTERN.match(line):
+        return 'raise'
+    if BET_PATTERN.match(line):
+        return 'bet'
+    if FOLD_PATTERN.match(line):
+        return 'fold'
+    if CHECK_PATTERN.match(line):
+        return 'check'
+    return None
+
+
+def classify_with_dispatcher(line):
+    if line.startswith('Seat ') and SEAT_PATTERN.match(line):
+        return 'seat'
+    parsed = parse_action(line)
+    if parsed is None:
+        return None
+    return parsed[0]
+
+
+def time_classifier(classify, lines):
+    start = time.perf_counter()
+    for line in lines:
+        classify(line)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the regex cascade with the parse_action dispatcher.')
+    parser.add_argument('num_hands', type=int, nargs='?', default=20000, help='hands in the synthetic history')
+    num_hands = parser.parse_args().num_hands
+    lines = make_synthetic_lines(num_hands)
+
+    # both ways of looking at a line have to agree before the timing means anything
+    for line in lines:
+        assert classify_with_cascade(line) == classify_with_dispatcher(line), line
+
+    print(f'{len(lines)} lines from {num_hands} hands')
+    before = time_classifier(classify_with_cascade, lines)
+    after = time_classifier(classify_with_dispatcher, lines)
+    print(f'regex cascade: {len(lines)/before:,.0f} lines/sec')
+    print(f'dispatcher:    {len(lines)/after:,.0f} lines/sec')
+    print(f'speed up = {before/after:.1f}x')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+Measures how long it takes for a hand written to one of several tables to show up in the
+shared stats, the way the hud follows several tables at once: a thread per table appends
+synthetic hands to its file while a MultiTableTracker polls them all and takes a snapshot
+(with the career stats from a scratch db) after every poll that found new hands.
+
+usage: python bench_multi_table.py [--tables N] [--seconds S] [--hands-per-second R]
+'''
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from db_management import DBManager
+from hand_history_generator import HandHistoryGenerator
+from multi_table import MultiTableTracker
+
+
+def write_table(path, generator, hands_per_second, stop_event, write_times):
+    ''' appends a hand to path every 1 / hands_per_second seconds until stop_event is set '''
+    with open(path, 'w', encoding='utf-8-sig', newline='\n') as file:
+        while not stop_event.is_set():
+            lines = generator.next_hand()
+            file.write('\n'.join(lines) + '\n\n\n\n')
+            file.flush()
+            write_times[generator.hand_number] = time.perf_counter()
+            stop_event.wait(1 / hands_per_second)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time following several tables at once.')
+    parser.add_argument('--tables', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--hands-per-second', type=float, default=2, help='how fast each table writes hands')
+    args = parser.parse_args()
+
+    latencies = []
+    write_times = {}
+    stop_event = threading.Event()
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_manager_class = type('BenchmarkDBManager', (DBManager,), {'FILE_NAME': os.path.join(work_dir, 'player_stats.sqlite3')})
+        tracker = MultiTableTracker(db_manager=db_manager_class())
+        writers = []
+        for table in range(args.tables):
+            path = os.path.join(work_dir, f'HH20200501 Table {table}.txt')
+            generator = HandHistoryGenerator(num_seats=9, seed=table, table_name=f'Table {table}')
+            writers.append(threading.Thread(target=write_table,
+                                            args=(path, generator, args.hands_per_second, stop_event, write_times)))
+            open(path, 'w').close()
+            tracker.add_table(path)
+        seen_hands = set()
+
+        def on_update(updated):
+            tracker.snapshot()
+            now = time.perf_counter()
+            for game in updated:
+                new_hands = game.hand_numbers - seen_hands
+                seen_hands.update(new_hands)
+                latencies.extend(now - write_times[hand_number] for hand_number in new_hands)
+
+        for writer in writers:
+            writer.start()
+        deadline = time.perf_counter() + args.seconds
+        tracker.run(on_update=on_update, stopped=lambda: time.perf_counter() > deadline)
+        stop_event.set()
+        for writer in writers:
+            writer.join()
+        num_hands = sum(len(game.hands) for game in tracker.tables.values())
+        num_players = len(tracker.shared_stats.game_stats)
+        for path in list(tracker.tables):
+            tracker.remove_table(path)
+
+    latencies.sort()
+    print(f'{args.tables} tables, {num_hands} hands, {num_players} players in the shared stats')
+    print(f'latency mean {1000 * sum(latencies) / len(latencies):.1f} ms, '
+          f'95th percentile {1000 * latencies[int(0.95 * (len(latencies) - 1))]:.1f} ms, max {1000 * latencies[-1]:.1f} ms')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+'''
+Measures how long the hud takes from being launched to being usable, with stats dbs of different sizes,
+to check that startup doesn't get slower as the db grows. For each db size it builds a scratch db
+(synthetic games, the hands they count, and those hands in the event log next to the db), then
+launches a fresh python that imports hud, opens the main window, reads a short hand history and
+shows its stats, and times each step from the launch:
+    imported - hud and everything it imports has been imported
+    window - the main window is up and the Tk loop is running
+    first_refresh - the stats of the hand history have been drawn
+Without a display (or with --headless) there is no window, and first_refresh is when the worker
+hands over the stats. It also reports whether TinyDB or dotenv got imported along the way.
+
+usage: python bench_startup.py [--db-hands 0,100000,1000000] [--hands N] [--runs R] [--headless]
+'''
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# how many hands each synthetic game in the db counts, and how many players a game has
+HANDS_PER_GAME = 1000
+PLAYERS_PER_GAME = 9
+
+
+def build_db(db_manager, num_hands, seated_players, exclude_hand_numbers, sample_hands, seed=0):
+    '''
+    Saves synthetic games counting num_hands hands in all to the db, with the seated players among
+    the players of the games so that their career stats have to be loaded.
+    Every hand is also written to the event log, played out like one of sample_hands, as saving them would have.
+    '''
+    rng = random.Random(seed)
+    player_pool = list(seated_players) + [f'db_player_{index}' for index in range(max(100, num_hands // 200))]
+    event_log = db_manager.event_log()
+    game_stats_by_game_id = {}
+    hand_numbers_by_game_id = {}
+    hand_number = 100000000000
+    for game in range(num_hands // HANDS_PER_GAME):
+        game_id = f'2019{game:08d}'
+        game_stats = {}
+        player_names = rng.sample(player_pool, PLAYERS_PER_GAME)
+        for player_name in player_names:
+            vpip = rng.randrange(HANDS_PER_GAME // 2)
+            game_stats[player_name] = {'hands_played': HANDS_PER_GAME, 'vpip': vpip, 'pfr': rng.randrange(vpip + 1)}
+        game_stats_by_game_id[game_id] = game_stats
+        hand_numbers = set()
+        while len(hand_numbers) < HANDS_PER_GAME:
+            if hand_number not in exclude_hand_numbers:
+                hand_numbers.add(hand_number)
+            hand_number += 1
+        hand_numbers_by_game_id[game_id] = hand_numbers
+        for logged_hand_number in sorted(hand_numbers):
+            hand = rng.choice(sample_hands)
+            flags = [hand.players[player_name].flags for player_name in hand.player_order]
+            event_log.add_events(game_id, logged_hand_number, player_names[:len(flags)], hand.sb_index, flags, hand.events)
+    event_log.flush()
+    db_manager.insert_many_player_stats(game_stats_by_game_id, hand_numbers_by_game_id)
+    db_manager.close()
+
+
+def run_child(path_to_file, headless):
+    '''
+    Runs in the launched python: starts the hud on path_to_file and prints when each step was done
+    '''
+    times = {}
+    import hud
+    times['imported'] = time.time()
+
+    if headless:
+        worker = hud.HUDWorker()
+        worker.start()
+        worker.requests.put(('read', path_to_file))
+        while True:
+            kind, result = worker.results.get()
+            if kind == 'stats':
+                break
+        times['first_refresh'] = time.time()
+        worker.requests.put(('stop', None))
+        worker.join()
+    else:
+        class TimedApp(hud.App):
+            def poll_worker(self):
+                times.setdefault('window', time.time())
+                super().poll_worker()
+
+            def show_stats(self, snapshot):
+                super().show_stats(snapshot)
+                self.window.update_idletasks()
+                times['first_refresh'] = time.time()
+                self.window.after(0, self.quit)
+
+        app = TimedApp()
+        app.worker.requests.put(('read', path_to_file))
+        app.main()
+        app.worker.join()
+
+    times['tinydb_imported'] = 'tinydb' in sys.modules
+    times['dotenv_imported'] = 'dotenv' in sys.modules
+    print(json.dumps(times))
+
+
+def launch(work_dir, path_to_file, headless):
+    ''' launches the hud in a fresh python, and returns the seconds from the launch to each step '''
+    command = [sys.executable, os.path.abspath(__file__), '--child', path_to_file]
+    if headless:
+        command.append('--headless')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    launched = time.time()
+    output = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True, check=True).stdout
+    times = json.loads(output.strip().splitlines()[-1])
+    return {step: value - launched if isinstance(value, float) else value for step, value in times.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time launching the hud to a usable window, with dbs of different sizes.')
+    parser.add_argument('--db-hands', default='0,100000,1000000', help='comma separated numbers of hands in the db')
+    parser.add_argument('--hands', type=int, default=50, help='hands in the hand history the hud reads')
+    parser.add_argument('--runs', type=int, default=5, help='launches per db size (the median is reported)')
+    parser.add_argument('--headless', action='store_true', help="don't open any windows")
+    parser.add_argument('--child', metavar='FILE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.headless)
+        return
+
+    headless = args.headless
+    if not headless and sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+        print('no display, timing without the windows')
+        headless = True
+
+    from analyze_hands import PokerStarsGameIO
+    from db_management import PokerStarsDBManager
+    from hand_history_generator import write_history
+
+    print(f'{"db hands":>10}{"log MB":>10}{"imported":>12}{"window":>12}{"first refresh":>16}   (ms from launch, median of {args.runs})')
+    for num_db_hands in [int(size) for size in args.db_hands.split(',')]:
+        with tempfile.TemporaryDirectory() as work_dir:
+            path_to_file = write_history(os.path.join(work_dir, 'HH20200501 Synthetic.txt'), args.hands, num_seats=9)
+            game = PokerStarsGameIO(path_to_file)
+            game.analyze_new_hands()
+            db_manager_class = type('BenchmarkDBManager', (PokerStarsDBManager,),
+                                    {'FILE_NAME': os.path.join(work_dir, PokerStarsDBManager.FILE_NAME)})
+            db_manager = db_manager_class()
+            build_db(db_manager, num_db_hands, list(game.game_stats), game.hand_numbers, list(game.hands))
+            log_file = db_manager.event_log().file_name
+            log_megabytes = os.path.getsize(log_file) / 1e6 if os.path.exists(log_file) else 0
+            runs = []
+            for _ in range(args.runs):
+                runs.append(launch(work_dir, path_to_file, headless))
+
+        def median(step):
+            values = sorted(run[step] for run in runs if step in run)
+            return f'{1000 * values[len(values) // 2]:.1f}' if values else '-'
+
+        print(f'{num_db_hands:>10}{log_megabytes:>10.1f}{median("imported"):>12}{median("window"):>12}{median("first_refresh"):>16}')
+    print(f'tinydb imported: {runs[-1]["tinydb_imported"]}, dotenv imported: {runs[-1]["dotenv_imported"]}')
+
+
+if __name__ == "__main__":
+    main()
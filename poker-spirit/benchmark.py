@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+Times the main phases of poker spirit on a synthetic hand history, so that we can tell
+whether a change makes things faster or slower:
+    parse  - PokerStarsGameIO.run_file
+    aggregate - assign_stats_from_hand over every parsed hand
+    replay / replay_events - EventLog.replay using the logged flags / every logged action
+    db_insert / db_load - DBManager.insert_player_stats and load_player_history
+    db_load_cached - load_player_history again, once every player's totals are in the CareerStatsCache
+    format - the GameIO.*_str helpers for every player
+    format_lines / format_cached - StatLines for every player, the first time / once the lines are cached
+The results are written as json, and a previous results file can be given to compare against.
+
+usage: python benchmark.py [--hands N] [--seats S] [--seed X] [--output results.json] [--compare old.json]
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from analyze_hands import PokerStarsGameIO, GameIO, assign_stats_from_hand
+from db_management import DBManager
+from event_log import EventLog
+from hand_history_generator import write_history
+from stats_matrix import StatsMatrix, StatLines
+
+
+FORMATTERS = (
+    GameIO.hands_played_str, GameIO.vpip_str, GameIO.pfr_str, GameIO._3_bet_str, GameIO._4_bet_str,
+    GameIO.folds_to_3_bet_str, GameIO.calls_3_bet_str, GameIO.folds_to_c_bet_str, GameIO.calls_c_bet_str,
+    GameIO.raises_c_bet_str, GameIO.c_bet_str, GameIO.checks_c_bet_str,
+    GameIO.double_barrel_str, GameIO.folds_to_turn_bet_str,
+)
+
+
+def git_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def best_of(repeat, function):
+    '''
+    Runs function repeat times, and returns the fastest time along with the result of the last run
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def run_benchmarks(num_hands, num_seats, seed, repeat, work_dir):
+    path_to_file = os.path.join(work_dir, 'HH20200501 Synthetic.txt')
+    write_history(path_to_file, num_hands, num_seats, seed)
+    file_size = os.path.getsize(path_to_file)
+    results = {}
+
+    def parse():
+        game = PokerStarsGameIO(path_to_file)
+        game.analyze_new_hands()
+        return game
+
+    seconds, game = best_of(repeat, parse)
+    results['parse'] = {'seconds': seconds, 'hands_per_sec': num_hands / seconds, 'mb_per_sec': file_size / 1e6 / seconds}
+
+    def aggregate():
+        game_stats = StatsMatrix()
+        for hand in game.hands:
+            assign_stats_from_hand(game_stats, hand)
+        return game_stats
+
+    seconds, _ = best_of(repeat, aggregate)
+    results['aggregate'] = {'seconds': seconds, 'hands_per_sec': len(game.hands) / seconds}
+
+    event_log = EventLog(os.path.join(work_dir, 'replay.events'))
+    for hand in game.hands:
+        event_log.add_hand(game.game_id, hand)
+    event_log.flush()
+    seconds, _ = best_of(repeat, event_log.replay)
+    results['replay'] = {'seconds': seconds, 'hands_per_sec': len(game.hands) / seconds}
+    seconds, _ = best_of(repeat, lambda: event_log.replay(from_events=True))
+    results['replay_events'] = {'seconds': seconds, 'hands_per_sec': len(game.hands) / seconds}
+
+    db_manager_class = type('BenchmarkDBManager', (DBManager,), {'FILE_NAME': os.path.join(work_dir, 'player_stats.sqlite3')})
+    db_manager = db_manager_class()
+    num_records = len(game.game_stats)
+    seconds, _ = best_of(repeat, lambda: db_manager.insert_player_stats(game))
+    results['db_insert'] = {'seconds': seconds, 'records_per_sec': num_records / seconds}
+
+    # load the history of every player we have seen, as if they were all seated
+    game.current_players = list(game.game_stats)
+    career_stats = db_manager.career_stats()
+
+    def load_cold():
+        career_stats.clear()
+        return db_manager.load_player_history(game)
+
+    seconds, _ = best_of(repeat, load_cold)
+    results['db_load'] = {'seconds': seconds, 'players_per_sec': num_records / seconds}
+    # nothing was saved in between, so every player comes from the cache
+    seconds, _ = best_of(repeat, lambda: db_manager.load_player_history(game))
+    results['db_load_cached'] = {'seconds': seconds, 'players_per_sec': num_records / seconds}
+
+    def format_stats():
+        for player_name in game.game_stats:
+            for formatter in FORMATTERS:
+                formatter(game.game_stats, player_name)
+
+    seconds, _ = best_of(repeat, format_stats)
+    results['format'] = {'seconds': seconds, 'players_per_sec': num_records / seconds}
+
+    def format_lines(stat_lines):
+        for player_name in game.game_stats:
+            stat_lines.lines(game.game_stats, player_name)
+        return stat_lines
+
+    seconds, stat_lines = best_of(repeat, lambda: format_lines(StatLines()))
+    results['format_lines'] = {'seconds': seconds, 'players_per_sec': num_records / seconds}
+    # nothing has changed since, so every player's lines come from the cache
+    seconds, _ = best_of(repeat, lambda: format_lines(stat_lines))
+    results['format_cached'] = {'seconds': seconds, 'players_per_sec': num_records / seconds}
+    return results
+
+
+def compare(results, old_results):
+    print(f'{"phase":<14}{"old (s)":>12}{"new (s)":>12}{"speed up":>10}')
+    for phase, result in results.items():
+        old = old_results.get(phase)
+        if old is None:
+            continue
+        print(f'{phase:<14}{old["seconds"]:>12.4f}{result["seconds"]:>12.4f}{old["seconds"]/result["seconds"]:>9.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing, stat aggregation, the db and formatting.')
+    parser.add_argument('--hands', type=int, default=10000)
+    parser.add_argument('--seats', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='keep the best of this many runs of each phase')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='a previous results file to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(args.hands, args.seats, args.seed, args.repeat, work_dir)
+
+    output = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'hands': args.hands,
+        'seats': args.seats,
+        'seed': args.seed,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=2)
+
+    for phase, result in results.items():
+        rates = ', '.join(f'{key} = {val:,.1f}' for key, val in result.items() if key != 'seconds')
+        print(f'{phase:<14}{result["seconds"]:>10.4f} s   {rates}')
+    print(f'results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file)['results'])
+
+
+if __name__ == "__main__":
+    main()
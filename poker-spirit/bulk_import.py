@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+'''
+Imports a whole directory of PokerStars hand history files into the stats db, without the gui.
+The files are analyzed in parallel by a pool of worker processes, then the results
+are merged and saved to the db in one pass.
+
+usage: python bulk_import.py [directory] [--processes N] [--pattern GLOB] [--no-save]
+'''
+
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+
+from analyze_hands import PokerStarsGameIO, merge_game_stats, stat_columns
+from db_management import PokerStarsDBManager
+from event_log import HandHistory
+from hand_index import HandIndex
+from stats_matrix import STAT_FIELDS
+
+
+# set in each worker process by init_worker
+worker_ingested_hands = None
+
+
+def init_worker(db_manager_class):
+    global worker_ingested_hands
+    worker_ingested_hands = db_manager_class().ingested_hands()
+
+
+def import_file(path_to_file):
+    '''
+    Runs in a worker process: analyzes every hand in a single file.
+    Returns the path, the game id, the game_stats (as plain dicts so they are cheap to send back),
+    the numbers of the hands counted, where each of those hands is and who played it with its
+    events (for the hand index and the event log) and how many hands were skipped as already saved in another game.
+    '''
+    hands = []
+    # we take what we need from each hand as it is counted, so the game doesn't need to keep them
+    game = PokerStarsGameIO(path_to_file, ingested_hands=worker_ingested_hands, hands=HandHistory(keep_last=0))
+    for hand_number, offset, length, hand_lines in game.read_hand_spans():
+        if game.process_single_hand(hand_lines, hand_number):
+            hand = game.current_hand
+            flags = [hand.players[player_name].flags for player_name in hand.player_order]
+            hands.append((hand_number, offset, length, hand.player_order, hand.sb_index, flags, bytes(hand.events)))
+    game_stats = {player_name: dict(stats) for player_name, stats in game.game_stats.items()}
+    return path_to_file, game.game_id, game_stats, game.hand_numbers, hands, game.num_duplicate_hands
+
+
+def biggest_first(paths):
+    # start the biggest files first so that one big file doesn't hold up the end of the import
+    return sorted(paths, key=os.path.getsize, reverse=True)
+
+
+def find_files(directory, pattern='*.txt'):
+    return biggest_first(glob.glob(os.path.join(directory, pattern)))
+
+
+def remove_hands(game_stats, hands, hand_numbers):
+    '''
+    Takes the hands (as import_file returns them) whose numbers are in hand_numbers back out of
+    game_stats (as plain dicts), dropping any player left without a hand
+    '''
+    for hand_number, _, _, player_names, _, flags, _ in hands:
+        if hand_number not in hand_numbers:
+            continue
+        for player_name, player_flags in zip(player_names, flags):
+            stats = game_stats[player_name]
+            for column in stat_columns(player_flags):
+                stats[STAT_FIELDS[column]] -= 1
+    for player_name in [player_name for player_name, stats in game_stats.items() if not stats['hands_played']]:
+        del game_stats[player_name]
+
+
+def bulk_import(paths, processes=None, hand_index=None, db_manager_class=PokerStarsDBManager, event_log=None):
+    '''
+    Analyzes all the files in paths across a pool of processes.
+    Returns a dict mapping each game id to the merged game_stats of that game, a dict mapping each
+    game id to the hand numbers counted in it, and the number of hands skipped as duplicates.
+    The game id is the file's name, so files with the same name (e.g. copies in two directories) are merged together.
+    Hands already saved to db_manager_class's db as part of another game are skipped, and so are
+    hands already counted from another file of this import (e.g. those same copies), whatever its name.
+    If hand_index is given, the location of every hand is added to it,
+    and if event_log is given, the events of every hand not already in the db are written to it
+    (so only pass it if the stats are going to be saved).
+    '''
+    db_manager = db_manager_class()
+    # make sure the db exists (and is migrated) before the workers open it
+    db_manager.storage
+    # hands of a file that was imported before are counted again (they replace the game's records), but they are already logged
+    ingested_hands = db_manager.ingested_hands() if event_log is not None else None
+    game_stats_by_game_id = {}
+    hand_numbers_by_game_id = {}
+    num_duplicate_hands = 0
+    # every hand counted so far, from any file
+    counted_hands = set()
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(db_manager_class,)) as pool:
+        for path_to_file, game_id, game_stats, hand_numbers, hands, file_duplicates in \
+                pool.imap_unordered(import_file, paths):
+            # the workers only know about the hands in the db, not the ones the other workers count
+            repeated_hands = counted_hands.intersection(hand_numbers)
+            if repeated_hands:
+                remove_hands(game_stats, hands, repeated_hands)
+                hands = [hand for hand in hands if hand[0] not in repeated_hands]
+                hand_numbers = set(hand_numbers) - repeated_hands
+                file_duplicates += len(repeated_hands)
+            counted_hands.update(hand_numbers)
+            merge_game_stats(game_stats_by_game_id.setdefault(game_id, {}), game_stats)
+            hand_numbers_by_game_id.setdefault(game_id, set()).update(hand_numbers)
+            num_duplicate_hands += file_duplicates
+            # only this process writes to the index and the log, so the workers never fight over the files
+            for hand_number, offset, length, player_names, sb_index, flags, events in hands:
+                if hand_index is not None:
+                    hand_index.add_hand(hand_number, path_to_file, offset, length, player_names)
+                if event_log is not None and hand_number not in ingested_hands:
+                    event_log.add_events(game_id, hand_number, player_names, sb_index, flags, events)
+    if hand_index is not None:
+        hand_index.commit()
+    if event_log is not None:
+        event_log.flush()
+    db_manager.close()
+    return game_stats_by_game_id, hand_numbers_by_game_id, num_duplicate_hands
+
+
+# what import_and_save did, and how long it took
+ImportResult = namedtuple('ImportResult', [
+    'game_stats_by_game_id', 'hand_numbers_by_game_id', 'num_hands', 'num_duplicate_hands', 'num_records',
+    'parse_seconds', 'save_seconds',
+])
+
+
+def import_and_save(paths, db_manager, processes=None, save=True, index=True):
+    '''
+    Analyzes the files in paths with bulk_import and saves the stats of their games to db_manager's db
+    (unless save is False, in which case the event log is left alone too).
+    The hands are added to the hand index unless index is False.
+    Returns an ImportResult
+    '''
+    start = time.perf_counter()
+    hand_index = HandIndex() if index else None
+    # the events only go in the log if the stats go in the db
+    event_log = db_manager.event_log() if save else None
+    try:
+        game_stats_by_game_id, hand_numbers_by_game_id, num_duplicate_hands = \
+            bulk_import(paths, processes, hand_index, type(db_manager), event_log)
+    finally:
+        if hand_index is not None:
+            hand_index.close()
+    parse_seconds = time.perf_counter() - start
+    num_hands = sum(len(hand_numbers) for hand_numbers in hand_numbers_by_game_id.values())
+
+    num_records = 0
+    if save:
+        num_records = db_manager.insert_many_player_stats(game_stats_by_game_id, hand_numbers_by_game_id)
+    save_seconds = time.perf_counter() - start - parse_seconds
+    return ImportResult(game_stats_by_game_id, hand_numbers_by_game_id, num_hands, num_duplicate_hands, num_records,
+                        parse_seconds, save_seconds)
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Import a directory of PokerStars hand histories into the stats db.')
+    parser.add_argument('directory', nargs='?', default=os.getenv("PATH_TO_HANDS", "."))
+    parser.add_argument('--pattern', default='*.txt', help='glob for the hand history files in the directory')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default = number of cores)')
+    parser.add_argument('--no-save', action='store_true', help="analyze the files but don't write to the db")
+    parser.add_argument('--no-index', action='store_true', help="don't add the hands to the hand index")
+    args = parser.parse_args()
+
+    paths = find_files(args.directory, args.pattern)
+    if not paths:
+        print(f'no files matching {args.pattern} in {args.directory}')
+        return
+
+    result = import_and_save(paths, PokerStarsDBManager(), args.processes, save=not args.no_save, index=not args.no_index)
+    print(f'analyzed {len(paths)} files and {result.num_hands} hands in {result.parse_seconds:.2f} seconds '
+          f'({result.num_duplicate_hands} hands skipped as already saved in another game)')
+    print(f'{len(paths)/result.parse_seconds:.1f} files/sec, {result.num_hands/result.parse_seconds:.1f} hands/sec')
+    if not args.no_save:
+        print(f'saved {result.num_records} player records for {len(result.game_stats_by_game_id)} games, '
+              f'{result.parse_seconds + result.save_seconds:.2f} seconds in total')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,80 +1,725 @@
 #!/usr/bin/env python3
 
-import copy
-
-from tinydb import TinyDB, Query
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict
+import bisect
 import datetime
+import os
+import sqlite3
 import time
 
-class DBManager:
-    FILE_NAME = None
+from event_log import EventLog
+from instrumentation import INSTRUMENTATION
+from stats_matrix import STAT_FIELDS
+
+
+def stat_deltas(db_record, old_record=None):
+    '''
+    Returns how much each stat changes by when old_record (if any) is replaced by db_record
+    '''
+    if old_record is None:
+        return [db_record.get(field, 0) for field in STAT_FIELDS]
+    return [db_record.get(field, 0) - old_record.get(field, 0) for field in STAT_FIELDS]
+
+
+class TinyDBStorage:
+    '''
+    Stores one json document per (player, game) in a TinyDB file, plus one document per player
+    with their career totals.
+    Note that TinyDB scans the whole table for every search.
+    The file is opened (and parsed) once, and then read from memory until close; every write
+    still goes straight to the file.
+    '''
     GAME_STATS_TABLE = 'gamestats'
-    
-    def __init__(self):
-        self.last_read_date = 0 # seconds since epoch start at zero (beginning of time)
-        
-    def load_player_history(self, game, career_stats_by_player=None):
-        if self.FILE_NAME is None:
-            # can't call this method from this class, need a subclass            
-            raise NotImplementedError
-        
-        db = TinyDB(self.FILE_NAME)
-        table = db.table(self.GAME_STATS_TABLE)
+    CAREER_STATS_TABLE = 'careerstats'
+    INGESTED_HANDS_TABLE = 'ingestedhands'
+
+    def __init__(self, file_name):
+        # only the old dbs use TinyDB, so it isn't imported until one is opened
+        from tinydb import TinyDB
+        from tinydb.middlewares import CachingMiddleware
+        from tinydb.storages import JSONStorage
+        self.file_name = file_name
+        db = self.db = TinyDB(self.file_name, storage=CachingMiddleware(JSONStorage))
+        if len(db.table(self.CAREER_STATS_TABLE)) == 0 and len(db.table(self.GAME_STATS_TABLE)) > 0:
+            # a db from before we kept career totals
+            self.rebuild_career_stats()
+
+    def rebuild_career_stats(self):
+        '''
+        Recomputes every career total from scratch out of the per game records
+        '''
+        db = self.db
+        career_stats_by_player = {}
+        for db_record in db.table(self.GAME_STATS_TABLE).all():
+            player_name = db_record.get('player_name')
+            if player_name is None:
+                continue
+            career_record = career_stats_by_player.setdefault(player_name, {'player_name': player_name, 'updated_time': 0})
+            for field, delta in zip(STAT_FIELDS, stat_deltas(db_record)):
+                career_record[field] = career_record.get(field, 0) + delta
+            career_record['updated_time'] = max(career_record['updated_time'], db_record.get('updated_time', 0))
+        career_table = db.table(self.CAREER_STATS_TABLE)
+        career_table.truncate()
+        career_table.insert_multiple(career_stats_by_player.values())
+        db.storage.flush()
+
+    def load_player_history(self, player_names, exclude_game_ids=()):
+        '''
+        Returns a dict mapping each player_name to their career totals,
+        leaving out the games exclude_game_ids (which the caller has the live stats for).
+        '''
+        exclude_game_ids = list(exclude_game_ids)
+        db = self.db
+        game_table = db.table(self.GAME_STATS_TABLE)
+        career_table = db.table(self.CAREER_STATS_TABLE)
+        from tinydb import Query
         Player = Query()
-        if career_stats_by_player is None:
-            career_stats_by_player = {}
+        history = {}
+        for player_name in player_names:
+            career_stats = defaultdict(int)
+            # every search goes through the whole table
+            INSTRUMENTATION.count('db.rows_scanned', len(career_table))
+            career_record = career_table.get(Player.player_name == player_name)
+            if career_record is not None:
+                for field, total in zip(STAT_FIELDS, stat_deltas(career_record)):
+                    career_stats[field] = total
+                if exclude_game_ids:
+                    INSTRUMENTATION.count('db.rows_scanned', len(game_table))
+                    for game_record in game_table.search((Player.player_name == player_name) & Player.game_id.one_of(exclude_game_ids)):
+                        for field in STAT_FIELDS:
+                            career_stats[field] -= game_record.get(field, 0)
+            history[player_name] = career_stats
+        return history
+
+    def load_career_updated_times(self, player_names):
+        '''
+        Returns a dict mapping each of player_names that has career totals to when they last changed
+        '''
+        player_names = set(player_names)
+        db = self.db
+        INSTRUMENTATION.count('db.rows_scanned', len(db.table(self.CAREER_STATS_TABLE)))
+        return {doc['player_name']: doc.get('updated_time', 0) for doc in db.table(self.CAREER_STATS_TABLE).all()
+                if doc.get('player_name') in player_names}
+
+    def load_ingested_hand_numbers(self, low=None, high=None):
+        ''' returns the saved hand numbers (only those from low up to, but not including, high if given), sorted '''
+        db = self.db
+        return sorted(doc['hand_number'] for doc in db.table(self.INGESTED_HANDS_TABLE).all()
+                      if (low is None or doc['hand_number'] >= low) and (high is None or doc['hand_number'] < high))
+
+    def ingested_hand_owner(self, hand_number):
+        ''' returns the game_id that the hand was saved as part of, or None '''
+        db = self.db
+        from tinydb import Query
+        doc = db.table(self.INGESTED_HANDS_TABLE).get(Query().hand_number == hand_number)
+        if doc is None:
+            return None
+        return doc['game_id']
+
+    def _update_tables(self, game_ids_to_remove, db_records, ingested_hands=()):
+        '''
+        Removes every record of the games in game_ids_to_remove, then saves db_records
+        (replacing any record of the same player and game), keeping the career totals in step.
+        ingested_hands are (hand_number, game_id) pairs of the hands those records count.
+        TinyDB rewrites the whole file on every write, so all of this is done
+        with one write of the file.
+        '''
+        db = self.db
+        data = db.storage.read() or {}
+        game_docs = data.setdefault(self.GAME_STATS_TABLE, {})
+        career_docs = data.setdefault(self.CAREER_STATS_TABLE, {})
+        game_doc_ids = {(doc.get('player_name'), doc.get('game_id')): doc_id for doc_id, doc in game_docs.items()}
+        career_doc_ids = {doc.get('player_name'): doc_id for doc_id, doc in career_docs.items()}
+        next_game_doc_id = max(map(int, game_docs), default=0) + 1
+        next_career_doc_id = max(map(int, career_docs), default=0) + 1
+        now = time.time()
+        INSTRUMENTATION.count('db.rows_scanned', len(game_docs) + len(career_docs))
+        INSTRUMENTATION.count('db.rows_written', len(db_records))
 
-        for player_name in game.current_players:
-            if player_name in career_stats_by_player:
-                career_stats = career_stats_by_player[player_name]
+        def add_to_career(player_name, deltas, updated_time):
+            nonlocal next_career_doc_id
+            doc_id = career_doc_ids.get(player_name)
+            if doc_id is None:
+                doc_id = str(next_career_doc_id)
+                next_career_doc_id += 1
+                career_doc_ids[player_name] = doc_id
+                career_docs[doc_id] = {'player_name': player_name}
+            career_record = career_docs[doc_id]
+            for field, delta in zip(STAT_FIELDS, deltas):
+                career_record[field] = career_record.get(field, 0) + delta
+            career_record['updated_time'] = updated_time
+
+        for (player_name, game_id), doc_id in list(game_doc_ids.items()):
+            if game_id in game_ids_to_remove:
+                old_record = game_docs.pop(doc_id)
+                del game_doc_ids[(player_name, game_id)]
+                if player_name is not None:
+                    add_to_career(player_name, [-delta for delta in stat_deltas(old_record)], now)
+
+        for db_record in db_records:
+            key = (db_record['player_name'], db_record['game_id'])
+            doc_id = game_doc_ids.get(key)
+            if doc_id is None:
+                old_record = None
+                doc_id = str(next_game_doc_id)
+                next_game_doc_id += 1
+                game_doc_ids[key] = doc_id
             else:
-                career_stats = defaultdict(int)
-            all_stats = table.search((Player.player_name == player_name) & (Player.game_id != game.game_id) & (Player.updated_time > self.last_read_date))
-            for stats in all_stats:
-                for field, val in stats.items():
-                    if type(val) is int:
-                        career_stats[field] += val
-            career_stats_by_player[player_name] = career_stats
+                old_record = game_docs[doc_id]
+            game_docs[doc_id] = db_record
+            # replacing a game's record must take the old one back out of the career totals
+            add_to_career(db_record['player_name'], stat_deltas(db_record, old_record), db_record['updated_time'])
+
+        if ingested_hands:
+            hand_docs = data.setdefault(self.INGESTED_HANDS_TABLE, {})
+            owned = {doc['hand_number'] for doc in hand_docs.values()}
+            next_hand_doc_id = max(map(int, hand_docs), default=0) + 1
+            for hand_number, game_id in ingested_hands:
+                if hand_number not in owned:
+                    owned.add(hand_number)
+                    hand_docs[str(next_hand_doc_id)] = {'hand_number': hand_number, 'game_id': game_id}
+                    next_hand_doc_id += 1
+
+        db.storage.write(data)
+        db.storage.flush()
+
+    def upsert_records(self, db_records, ingested_hands=()):
+        self._update_tables(set(), db_records, ingested_hands)
+
+    def replace_games(self, game_ids, db_records, ingested_hands=()):
+        '''
+        Removes every record of the given games, and inserts db_records in their place
+        '''
+        self._update_tables(set(game_ids), db_records, ingested_hands)
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStorage:
+    '''
+    Stores one row per (player, game) in a SQLite file, with a column per stat.
+    The table is indexed on player_name, game_id and updated_time.
+    A second table keeps every player's career totals up to date as games are saved,
+    so loading the history of every seated player reads one row per player.
+    '''
+    GAME_STATS_TABLE = 'gamestats'
+    CAREER_STATS_TABLE = 'careerstats'
+    INGESTED_HANDS_TABLE = 'ingestedhands'
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name)
+        self.create_tables()
+
+    def create_tables(self):
+        stat_columns = ''.join(f', "{field}" INTEGER NOT NULL DEFAULT 0' for field in STAT_FIELDS)
+        with self.connection:
+            tables = {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.GAME_STATS_TABLE} ('
+                'player_name TEXT NOT NULL, game_id TEXT NOT NULL, '
+                f'updated_time REAL NOT NULL, updated_date TEXT{stat_columns}, '
+                'PRIMARY KEY (player_name, game_id))'
+            )
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.CAREER_STATS_TABLE} ('
+                f'player_name TEXT PRIMARY KEY, updated_time REAL NOT NULL{stat_columns})'
+            )
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.INGESTED_HANDS_TABLE} ('
+                'hand_number INTEGER PRIMARY KEY, game_id TEXT NOT NULL)'
+            )
+            # the primary key already indexes player_name
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS {self.GAME_STATS_TABLE}_game_id ON {self.GAME_STATS_TABLE} (game_id)')
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS {self.GAME_STATS_TABLE}_updated_time ON {self.GAME_STATS_TABLE} (updated_time)')
+            # a db made before a stat was added won't have a column for it yet
+            for table in (self.GAME_STATS_TABLE, self.CAREER_STATS_TABLE):
+                existing = {row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')}
+                for field in STAT_FIELDS:
+                    if field not in existing:
+                        self.connection.execute(f'ALTER TABLE {table} ADD COLUMN "{field}" INTEGER NOT NULL DEFAULT 0')
+        if self.GAME_STATS_TABLE in tables and self.CAREER_STATS_TABLE not in tables:
+            # a db from before we kept career totals
+            self.rebuild_career_stats()
+
+    def rebuild_career_stats(self):
+        '''
+        Recomputes every career total from scratch out of the per game records
+        '''
+        columns = ', '.join(f'"{field}"' for field in STAT_FIELDS)
+        sums = ', '.join(f'SUM("{field}")' for field in STAT_FIELDS)
+        with self.connection:
+            self.connection.execute(f'DELETE FROM {self.CAREER_STATS_TABLE}')
+            self.connection.execute(
+                f'INSERT INTO {self.CAREER_STATS_TABLE} (player_name, updated_time, {columns}) '
+                f'SELECT player_name, MAX(updated_time), {sums} FROM {self.GAME_STATS_TABLE} GROUP BY player_name'
+            )
+
+    def load_player_history(self, player_names, exclude_game_ids=()):
+        '''
+        Returns a dict mapping each player_name to their career totals,
+        leaving out the games exclude_game_ids (which the caller has the live stats for).
+        '''
+        player_names = list(player_names)
+        exclude_game_ids = list(exclude_game_ids)
+        history = {player_name: defaultdict(int) for player_name in player_names}
+        if not player_names:
+            return history
+        totals = ', '.join(f'career."{field}" - IFNULL(game."{field}", 0)' for field in STAT_FIELDS)
+        sums = ', '.join(f'SUM("{field}") AS "{field}"' for field in STAT_FIELDS)
+        placeholders = ', '.join('?' for _ in player_names)
+        game_placeholders = ', '.join('?' for _ in exclude_game_ids)
+        # the excluded games' stats are summed per player first, so each career row is still joined once
+        rows = self.connection.execute(
+            f'SELECT career.player_name, {totals} FROM {self.CAREER_STATS_TABLE} AS career '
+            f'LEFT JOIN (SELECT player_name, {sums} FROM {self.GAME_STATS_TABLE} '
+            f'WHERE game_id IN ({game_placeholders}) GROUP BY player_name) AS game '
+            'ON game.player_name = career.player_name '
+            f'WHERE career.player_name IN ({placeholders})',
+            exclude_game_ids + player_names
+        )
+        for player_name, *totals in rows:
+            INSTRUMENTATION.count('db.rows_scanned')
+            career_stats = history[player_name]
+            for field, total in zip(STAT_FIELDS, totals):
+                career_stats[field] = total
+        return history
+
+    def load_career_updated_times(self, player_names):
+        '''
+        Returns a dict mapping each of player_names that has career totals to when they last changed
+        '''
+        player_names = list(player_names)
+        if not player_names:
+            return {}
+        placeholders = ', '.join('?' for _ in player_names)
+        rows = self.connection.execute(
+            f'SELECT player_name, updated_time FROM {self.CAREER_STATS_TABLE} WHERE player_name IN ({placeholders})',
+            player_names
+        )
+        updated_times = dict(rows)
+        INSTRUMENTATION.count('db.rows_scanned', len(updated_times))
+        return updated_times
+
+    def _row(self, db_record):
+        return [db_record['player_name'], db_record['game_id'], db_record['updated_time'], db_record.get('updated_date')] + \
+            [db_record.get(field, 0) for field in STAT_FIELDS]
+
+    def _insert_sql(self):
+        columns = ', '.join(['player_name', 'game_id', 'updated_time', 'updated_date'] + [f'"{field}"' for field in STAT_FIELDS])
+        placeholders = ', '.join('?' for _ in range(4 + len(STAT_FIELDS)))
+        return f'INSERT OR REPLACE INTO {self.GAME_STATS_TABLE} ({columns}) VALUES ({placeholders})'
+
+    def _get_record(self, player_name, game_id):
+        columns = ', '.join(f'"{field}"' for field in STAT_FIELDS)
+        row = self.connection.execute(
+            f'SELECT {columns} FROM {self.GAME_STATS_TABLE} WHERE player_name = ? AND game_id = ?',
+            (player_name, game_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(STAT_FIELDS, row))
+
+    def _add_to_career(self, player_name, deltas, updated_time):
+        updates = ', '.join(f'"{field}" = "{field}" + ?' for field in STAT_FIELDS)
+        self.connection.execute(
+            f'INSERT OR IGNORE INTO {self.CAREER_STATS_TABLE} (player_name, updated_time) VALUES (?, ?)',
+            (player_name, updated_time)
+        )
+        self.connection.execute(
+            f'UPDATE {self.CAREER_STATS_TABLE} SET updated_time = ?, {updates} WHERE player_name = ?',
+            [updated_time] + list(deltas) + [player_name]
+        )
+
+    def load_ingested_hand_numbers(self, low=None, high=None):
+        ''' returns the saved hand numbers (only those from low up to, but not including, high if given), sorted '''
+        if low is None and high is None:
+            rows = self.connection.execute(f'SELECT hand_number FROM {self.INGESTED_HANDS_TABLE} ORDER BY hand_number')
+        else:
+            # hand_number is the primary key, so this only reads the rows in the range
+            rows = self.connection.execute(
+                f'SELECT hand_number FROM {self.INGESTED_HANDS_TABLE} WHERE hand_number >= ? AND hand_number < ? '
+                'ORDER BY hand_number',
+                (low if low is not None else -2 ** 63, high if high is not None else 2 ** 63 - 1)
+            )
+        return [row[0] for row in rows]
+
+    def ingested_hand_owner(self, hand_number):
+        ''' returns the game_id that the hand was saved as part of, or None '''
+        row = self.connection.execute(
+            f'SELECT game_id FROM {self.INGESTED_HANDS_TABLE} WHERE hand_number = ?', (hand_number,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _insert_ingested_hands(self, ingested_hands):
+        # a hand stays with the first game it was saved as part of
+        self.connection.executemany(
+            f'INSERT OR IGNORE INTO {self.INGESTED_HANDS_TABLE} (hand_number, game_id) VALUES (?, ?)', ingested_hands
+        )
+
+    def upsert_records(self, db_records, ingested_hands=()):
+        '''
+        Saves db_records (replacing any record of the same player and game) in one transaction,
+        along with the (hand_number, game_id) pairs of the hands they count
+        '''
+        INSTRUMENTATION.count('db.rows_scanned', len(db_records))
+        INSTRUMENTATION.count('db.rows_written', len(db_records))
+        with self.connection:
+            self._insert_ingested_hands(ingested_hands)
+            for db_record in db_records:
+                old_record = self._get_record(db_record['player_name'], db_record['game_id'])
+                self.connection.execute(self._insert_sql(), self._row(db_record))
+                # replacing a game's record must take the old one back out of the career totals
+                self._add_to_career(db_record['player_name'], stat_deltas(db_record, old_record), db_record['updated_time'])
+
+    def replace_games(self, game_ids, db_records, ingested_hands=()):
+        '''
+        Removes every record of the given games, and inserts db_records in their place,
+        all in one transaction
+        '''
+        columns = ', '.join(f'"{field}"' for field in STAT_FIELDS)
         now = time.time()
-        self.last_read_date = now
+        with self.connection:
+            self._insert_ingested_hands(ingested_hands)
+            for game_id in game_ids:
+                old_rows = self.connection.execute(
+                    f'SELECT player_name, {columns} FROM {self.GAME_STATS_TABLE} WHERE game_id = ?', (game_id,)
+                ).fetchall()
+                INSTRUMENTATION.count('db.rows_scanned', len(old_rows))
+                for player_name, *old_counts in old_rows:
+                    self._add_to_career(player_name, [-count for count in old_counts], now)
+                self.connection.execute(f'DELETE FROM {self.GAME_STATS_TABLE} WHERE game_id = ?', (game_id,))
+            self.connection.executemany(self._insert_sql(), [self._row(db_record) for db_record in db_records])
+            INSTRUMENTATION.count('db.rows_written', len(db_records))
+            for db_record in db_records:
+                self._add_to_career(db_record['player_name'], stat_deltas(db_record), db_record['updated_time'])
+
+    def close(self):
+        self.connection.close()
+
+    def migrate_from_tinydb(self, tinydb_file_name):
+        '''
+        Copies every record of an old TinyDB stats file into this db.
+        Records that don't know which player they belong to can't be used, so they are skipped.
+        Returns the number of records copied.
+        '''
+        # read the file directly, so that the old file is left exactly as it was
+        from tinydb import TinyDB
+        old_records = TinyDB(tinydb_file_name).table(TinyDBStorage.GAME_STATS_TABLE).all()
+        db_records = [db_record for db_record in old_records
+                      if 'player_name' in db_record and 'game_id' in db_record]
+        with self.connection:
+            self.connection.executemany(self._insert_sql(), [self._row(db_record) for db_record in db_records])
+        self.rebuild_career_stats()
+        return len(db_records)
+
+
+class IngestedHands:
+    '''
+    The hand numbers that have already been saved to the stats db, so that a hand is never
+    counted twice (e.g. when a file is read again, or two files overlap).
+    A sorted array of the hand numbers answers "have we seen this hand?" compactly and without
+    touching the db, and only hands that are in it get the exact check of which game they belong to.
+    The hand numbers are loaded a block (of BLOCK_SIZE consecutive numbers) at a time, the first time
+    a hand in that block is looked up. A hand history only spans a few blocks, so how long it takes
+    to start reading one doesn't depend on how many hands the db has.
+    '''
+    BLOCK_SIZE = 10 ** 6
+
+    def __init__(self, storage):
+        self.storage = storage
+        # block number -> sorted array of the saved hand numbers in that block
+        self.blocks = {}
+        # saved since we loaded the arrays; kept aside so we don't have to keep re-sorting
+        self.new_hand_numbers = set()
+
+    def block(self, hand_number):
+        block_number = hand_number // self.BLOCK_SIZE
+        hand_numbers = self.blocks.get(block_number)
+        if hand_numbers is None:
+            low = block_number * self.BLOCK_SIZE
+            hand_numbers = self.blocks[block_number] = \
+                array('q', self.storage.load_ingested_hand_numbers(low, low + self.BLOCK_SIZE))
+        return hand_numbers
+
+    def __contains__(self, hand_number):
+        if hand_number in self.new_hand_numbers:
+            return True
+        hand_numbers = self.block(hand_number)
+        index = bisect.bisect_left(hand_numbers, hand_number)
+        return index < len(hand_numbers) and hand_numbers[index] == hand_number
+
+    def __len__(self):
+        ''' the number of saved hands in the blocks loaded so far '''
+        return sum(len(hand_numbers) for hand_numbers in self.blocks.values()) + len(self.new_hand_numbers)
+
+    def add(self, hand_numbers):
+        self.new_hand_numbers.update(hand_numbers)
+
+    def is_duplicate(self, hand_number, game_id):
+        '''
+        True if the hand has already been saved as part of a different game.
+        Hands saved with this same game_id are not duplicates, since saving the game replaces them.
+        '''
+        if hand_number not in self:
+            return False
+        return self.storage.ingested_hand_owner(hand_number) not in (None, game_id)
+
+
+class CareerStatsCache:
+    '''
+    The career totals of the players we have looked up lately, so that refreshing the hud after
+    every hand doesn't reload the history of everyone at the table.
+    Each player's entry remembers the updated_time of their career totals when it was loaded
+    (and the games that were left out of them), and is only loaded again once that changes.
+    Players seen for the first time always get their whole history loaded.
+    At most max_players are kept; the ones used least recently are dropped first.
+    '''
+    MAX_PLAYERS = 1000
+
+    def __init__(self, storage, max_players=MAX_PLAYERS):
+        self.storage = storage
+        self.max_players = max_players
+        # player_name -> (exclude_game_ids, updated_time, career stats), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, player_names, exclude_game_ids=()):
+        '''
+        Returns a dict mapping each of player_names to their career totals, leaving out the games exclude_game_ids
+        '''
+        player_names = list(player_names)
+        exclude_game_ids = frozenset(exclude_game_ids)
+        updated_times = self.storage.load_career_updated_times(player_names)
+        to_load = []
+        for player_name in player_names:
+            entry = self.entries.get(player_name)
+            if entry is not None and entry[0] == exclude_game_ids and entry[1] == updated_times.get(player_name):
+                INSTRUMENTATION.count('career_cache.hits')
+                self.hits += 1
+                self.entries.move_to_end(player_name)
+            else:
+                INSTRUMENTATION.count('career_cache.misses')
+                self.misses += 1
+                to_load.append(player_name)
+        if to_load:
+            history = self.storage.load_player_history(to_load, exclude_game_ids)
+            for player_name in to_load:
+                self.entries[player_name] = (exclude_game_ids, updated_times.get(player_name), history[player_name])
+                self.entries.move_to_end(player_name)
+        career_stats_by_player = {player_name: self.entries[player_name][2] for player_name in player_names}
+        while len(self.entries) > max(self.max_players, len(player_names)):
+            self.entries.popitem(last=False)
         return career_stats_by_player
 
-    def insert_player_stats(self, game):
+    def invalidate(self, player_names):
+        '''
+        Drops the entries of player_names, e.g. because we just saved new stats for them
+        '''
+        for player_name in player_names:
+            self.entries.pop(player_name, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0
+        return f'career stats cache: {len(self.entries)} players, {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hits)'
+
+
+class DBManager:
+    FILE_NAME = None
+    # the TinyDB file that was used before we moved to SQLite, which gets migrated on first use
+    LEGACY_FILE_NAME = None
+    STORAGE = SQLiteStorage
+
+    def __init__(self):
+        self._storage = None
+        self._ingested_hands = None
+        self._event_log = None
+        self._career_stats = None
+        # game id -> how many of the game's hands without a number (e.g. live ones) went in the event log
+        self._num_logged_unnumbered_hands = {}
+
+    @property
+    def storage(self):
         if self.FILE_NAME is None:
-            # can't call this method from this class, need a subclass            
+            # can't call this method from this class, need a subclass
             raise NotImplementedError
-        
-        db = TinyDB(self.FILE_NAME)
-        table = db.table(self.GAME_STATS_TABLE)
-        GAME_STATS = Query()
-        print(game.game_stats)
-        now = time.time()
-        now_str = str(datetime.datetime.utcnow())
-        print(f'new now str = {now_str}')
-        for player_name, stats in game.game_stats.items():
-            # game_id = stats.get('game_id')
-            db_record = copy.deepcopy(stats)
+        if self._storage is None:
+            needs_migration = self.STORAGE is SQLiteStorage and not os.path.exists(self.FILE_NAME) \
+                and self.LEGACY_FILE_NAME is not None and os.path.exists(self.LEGACY_FILE_NAME)
+            self._storage = self.STORAGE(self.FILE_NAME)
+            if needs_migration:
+                num_records = self._storage.migrate_from_tinydb(self.LEGACY_FILE_NAME)
+                print(f'migrated {num_records} records from {self.LEGACY_FILE_NAME} to {self.FILE_NAME}')
+        return self._storage
+
+    def close(self):
+        '''
+        Closes the db and the event log, if they were opened. The storage is opened the first time it's used
+        and then kept open for the rest of the session, so this is only needed when the session ends.
+        '''
+        if self._event_log is not None:
+            self._event_log.close()
+            self._event_log = None
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+            self._ingested_hands = None
+            self._career_stats = None
+
+    def ingested_hands(self):
+        '''
+        Returns the IngestedHands for this db, loading it the first time
+        '''
+        if self._ingested_hands is None:
+            self._ingested_hands = IngestedHands(self.storage)
+        return self._ingested_hands
+
+    def event_log(self):
+        '''
+        Returns the EventLog kept next to this db (the same name, with .events instead of .sqlite3)
+        '''
+        if self.FILE_NAME is None:
+            raise NotImplementedError
+        if self._event_log is None:
+            self._event_log = EventLog(os.path.splitext(self.FILE_NAME)[0] + '.events')
+        return self._event_log
+
+    def career_stats(self):
+        '''
+        Returns the CareerStatsCache for this db, making it the first time
+        '''
+        if self._career_stats is None:
+            self._career_stats = CareerStatsCache(self.storage)
+        return self._career_stats
+
+    def load_player_history(self, game):
+        '''
+        Returns a dict mapping every player at the table to their career totals
+        (leaving out the current game, since we have its live stats).
+        Only the players whose totals changed since we last loaded them are read from the db.
+        '''
+        with INSTRUMENTATION.timer('db.load_player_history'):
+            return self.career_stats().load(game.current_players, {game.game_id})
+
+    @staticmethod
+    def make_db_records(game_id, game_stats, now, now_str):
+        db_records = []
+        for player_name, stats in game_stats.items():
+            db_record = dict(stats)
             # the db record has a couple fields that the player stats don't
-            db_record['game_id'] = game.game_id
-            #db_record['created_time'] = now
-            #db_record['created_date'] = now_str                                
+            db_record['player_name'] = player_name
+            db_record['game_id'] = game_id
             db_record['updated_time'] = now
             db_record['updated_date'] = now_str
-            print('about to enter db_record:')
-            print(db_record)
-            print()
-            table.upsert(db_record, (GAME_STATS.player_name == player_name) & (GAME_STATS.game_id == game.game_id))
-            
+            db_records.append(db_record)
+        return db_records
+
+    def unsaved_hands(self, game):
+        '''
+        Returns the hands of the game that haven't been saved yet: the ones whose number isn't in the db,
+        and the ones without a number that came after those logged when the game was last saved.
+        Has to be called before the game is saved, since saving adds its hand numbers to the db.
+        '''
+        ingested_hands = self.ingested_hands()
+        num_logged = self._num_logged_unnumbered_hands.get(game.game_id, 0)
+        num_unnumbered = 0
+        hands = []
+        for hand in game.hands:
+            if hand.hand_number is None:
+                num_unnumbered += 1
+                if num_unnumbered > num_logged:
+                    hands.append(hand)
+            elif hand.hand_number not in ingested_hands:
+                hands.append(hand)
+        return hands
+
+    def log_hands(self, game_id, hands):
+        '''
+        Appends the hands (of a game that was just saved) to the event log
+        '''
+        if not hands:
+            return
+        event_log = self.event_log()
+        with INSTRUMENTATION.timer('event_log.add_hand'):
+            for hand in hands:
+                event_log.add_hand(game_id, hand)
+            event_log.flush()
+        self._num_logged_unnumbered_hands[game_id] = self._num_logged_unnumbered_hands.get(game_id, 0) + \
+            sum(hand.hand_number is None for hand in hands)
+
+    def insert_player_stats(self, game):
+        '''
+        Saves the stats of every player in the game, all in one transaction.
+        The hands that weren't saved before are then appended to the event log.
+        '''
+        now = time.time()
+        now_str = str(datetime.datetime.utcnow())
+        db_records = self.make_db_records(game.game_id, game.game_stats, now, now_str)
+        ingested_hands = [(hand_number, game.game_id) for hand_number in game.hand_numbers]
+        new_hands = self.unsaved_hands(game)
+        with INSTRUMENTATION.timer('db.save'):
+            self.storage.upsert_records(db_records, ingested_hands)
+        self.log_hands(game.game_id, new_hands)
+        if self._ingested_hands is not None:
+            self._ingested_hands.add(game.hand_numbers)
+        if self._career_stats is not None:
+            self._career_stats.invalidate(game.game_stats)
+        return len(db_records)
+
+    def insert_many_player_stats(self, game_stats_by_game_id, hand_numbers_by_game_id=None, games=()):
+        '''
+        Saves the stats of many games at once, e.g. after a bulk import.
+        game_stats_by_game_id maps a game id to the game_stats of that game,
+        and hand_numbers_by_game_id to the hand numbers those stats count.
+        Any records already saved for those games are replaced, and the whole thing is
+        done in one transaction instead of one upsert per record.
+        The unsaved hands of games (GameIOs whose stats are among those saved) are then appended to the event log.
+        '''
+        new_hands_by_game = [(game.game_id, self.unsaved_hands(game)) for game in games]
+        now = time.time()
+        now_str = str(datetime.datetime.utcnow())
+        db_records = []
+        for game_id, game_stats in game_stats_by_game_id.items():
+            db_records += self.make_db_records(game_id, game_stats, now, now_str)
+
+        ingested_hands = []
+        for game_id, hand_numbers in (hand_numbers_by_game_id or {}).items():
+            ingested_hands += [(hand_number, game_id) for hand_number in hand_numbers]
+
+        with INSTRUMENTATION.timer('db.save'):
+            self.storage.replace_games(game_stats_by_game_id.keys(), db_records, ingested_hands)
+        for game_id, new_hands in new_hands_by_game:
+            self.log_hands(game_id, new_hands)
+        if self._ingested_hands is not None:
+            self._ingested_hands.add(hand_number for hand_number, _ in ingested_hands)
+        if self._career_stats is not None:
+            self._career_stats.invalidate({db_record['player_name'] for db_record in db_records})
+        return len(db_records)
+
 class LiveDBManager(DBManager):
-    FILE_NAME = 'player_stats_live.db'
+    FILE_NAME = 'player_stats_live.sqlite3'
+    LEGACY_FILE_NAME = 'player_stats_live.db'
 
 class PokerStarsDBManager(DBManager):
-    FILE_NAME = 'player_stats_poker_stars.db'    
+    FILE_NAME = 'player_stats_poker_stars.sqlite3'
+    LEGACY_FILE_NAME = 'player_stats_poker_stars.db'
 
 
 if __name__ == "__main__":
-    manager = PokerStarsDBManager()
-    career_stats_by_player = manager.load_player_history(player_names={'sleep evil'})
-    print(career_stats_by_player)
-                                                 
+    # migrate the old TinyDB files (this also happens automatically the first time a db is used)
+    for manager in (PokerStarsDBManager(), LiveDBManager()):
+        if os.path.exists(manager.LEGACY_FILE_NAME):
+            num_records = SQLiteStorage(manager.FILE_NAME).migrate_from_tinydb(manager.LEGACY_FILE_NAME)
+            print(f'{manager.LEGACY_FILE_NAME}: copied {num_records} records into {manager.FILE_NAME}')
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+'''
+An append-only binary log of every action of every hand we count, kept next to the stats db,
+so that the stats can be recomputed (e.g. after adding a new stat) without parsing all the
+hand histories again.
+
+Each hand is logged with its actions (see Hand.events), and with the PlayerHand flags that
+the parser worked out from them. Replaying with new STAT_RULES only needs the flags, which
+is a table lookup per player. If the flags themselves change (PLAYER_FLAGS or
+PLAYER_FLAGS_VERSION), the hands are replayed action by action through Hand instead.
+
+The file starts with MAGIC, followed by records that each start with a one byte type:
+    b'S' the start of a segment: everything an EventLog writes in one flush is a segment of its own,
+         numbering its players and games from 0 again, so that appending never has to read the log first
+         and several processes can append to the same log
+    b'P' a new player name: <H length, then the name in utf-8. Players are numbered in the order they are added
+    b'G' a new game id: <H length, then the game id in utf-8. Numbered the same way
+    b'F' the layout of the flags of the hands that follow: <H length, then the version and the flag names
+    b'H' a hand: HAND_HEADER (hand number, game number, small blind index, number of players, number of events),
+         then a <I player number and a <I flags per seat, then the events of the hand (2 bytes each)
+
+usage:
+    python event_log.py replay [--log FILE] [--from-events] [--save]
+'''
+
+import argparse
+import contextlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+import weakref
+from collections import Counter, deque
+
+from analyze_hands import Hand, PlayerHand, STAGES, ACTIONS, STAGE_ACTIONS, ACTION_TO_HAND_METHOD, \
+    PLAYER_FLAGS, PLAYER_FLAGS_VERSION, STAT_RULES, stat_columns
+from stats_matrix import StatsMatrix, NUM_STATS
+
+
+MAGIC = b'PSEVENTS1\n'
+NAME_HEADER = struct.Struct('<H')
+HAND_HEADER = struct.Struct('<QIBBH')
+NO_SB = 255
+NO_HAND_NUMBER = 0
+FLAGS_LAYOUT = f'{PLAYER_FLAGS_VERSION}:' + ','.join(PLAYER_FLAGS)
+
+# event code -> (stage, the Hand method the action is routed to, or None if the parser doesn't route it)
+EVENT_DISPATCH = {
+    stage_code << 4 | action_code:
+        (stage, getattr(Hand, ACTION_TO_HAND_METHOD[action]) if action in STAGE_ACTIONS.get(stage, ()) else None)
+    for stage_code, stage in enumerate(STAGES)
+    for action_code, action in enumerate(ACTIONS)
+}
+
+
+def read_records(data):
+    '''
+    Goes through the bytes of an event log, yielding a tuple for each record:
+        ('S',), ('P', player_name), ('G', game_id), ('F', flags_layout)
+        or ('H', hand_number, game_number, sb_index, player_numbers, flags, events)
+    A record cut short at the end of the data (e.g. a write that was interrupted) is ignored.
+    '''
+    # data can be an mmap, which has no startswith
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not an event log')
+    position = len(MAGIC)
+    end = len(data)
+    unpack_name = NAME_HEADER.unpack_from
+    unpack_hand = HAND_HEADER.unpack_from
+    while position < end:
+        kind = data[position: position + 1]
+        position += 1
+        if kind == b'H':
+            if position + HAND_HEADER.size > end:
+                return
+            hand_number, game_number, sb_index, num_players, num_events = unpack_hand(data, position)
+            position += HAND_HEADER.size
+            if position + 8 * num_players + 2 * num_events > end:
+                return
+            seats = struct.unpack_from(f'<{2 * num_players}I', data, position)
+            position += 8 * num_players
+            events = data[position: position + 2 * num_events]
+            position += 2 * num_events
+            yield ('H', hand_number if hand_number != NO_HAND_NUMBER else None, game_number,
+                   sb_index if sb_index != NO_SB else None, seats[0::2], seats[1::2], events)
+        elif kind in (b'P', b'G', b'F'):
+            if position + NAME_HEADER.size > end:
+                return
+            length, = unpack_name(data, position)
+            position += NAME_HEADER.size
+            if position + length > end:
+                return
+            name = data[position: position + length]
+            position += length
+            yield (kind.decode(), bytes(name).decode('utf-8'))
+        elif kind == b'S':
+            yield ('S',)
+        else:
+            raise ValueError(f'bad record type {kind!r} at byte {position - 1}')
+
+
+def replay_hand(hand_number, player_names, sb_index, events):
+    '''
+    Rebuilds the Hand from its events, by routing each action to the Hand the same way the parser does
+    '''
+    hand = Hand(sb_index=sb_index, hand_number=hand_number)
+    hand.player_order = list(player_names)
+    hand.players = {player_name: PlayerHand(player_name) for player_name in player_names}
+    hand.events = bytearray(events)
+    for i in range(0, len(events), 2):
+        # moving straight to the stage, since there is nothing to do in between
+        hand.stage, method = EVENT_DISPATCH[events[i + 1]]
+        if method is not None:
+            method(hand, player_names[events[i]])
+    return hand
+
+
+# the Hand.ACTION_STATE of a hand before its first action, and every other one seen since, numbered
+ACTION_STATES = [tuple(getattr(Hand(), name) for name in Hand.ACTION_STATE)]
+ACTION_STATE_NUMBERS = {ACTION_STATES[0]: 0}
+FLAGS_BITS = len(PLAYER_FLAGS)
+STATE_SHIFT = FLAGS_BITS + 8
+
+
+def action_transition(key):
+    '''
+    Runs one action through a Hand set up in the given state, and returns where it leaves the hand and the player
+    (packed the way ActionTransitions keeps them)
+    '''
+    state_number, flags, event_code = key >> STATE_SHIFT, key >> 8 & (1 << FLAGS_BITS) - 1, key & 0xff
+    hand = Hand()
+    for name, value in zip(Hand.ACTION_STATE, ACTION_STATES[state_number]):
+        setattr(hand, name, value)
+    player = hand.players[0] = PlayerHand(0)
+    player.flags = flags
+    hand.stage, method = EVENT_DISPATCH[event_code]
+    if method is not None:
+        method(hand, 0)
+    state = tuple(getattr(hand, name) for name in Hand.ACTION_STATE)
+    state_number = ACTION_STATE_NUMBERS.get(state)
+    if state_number is None:
+        state_number = ACTION_STATE_NUMBERS[state] = len(ACTION_STATES)
+        ACTION_STATES.append(state)
+    return state_number << STATE_SHIFT, player.flags << 8
+
+
+class ActionTransitions(dict):
+    '''
+    (action state number << STATE_SHIFT | the acting player's flags << 8 | event code)
+    -> (the next action state number << STATE_SHIFT, the player's flags after << 8).
+    Everything is kept shifted into place, so that the next key is just the three or'ed together.
+    Only a few thousand ever happen, so each is worked out through Hand the first time we see it
+    '''
+
+    def __missing__(self, key):
+        transition = self[key] = action_transition(key)
+        return transition
+
+
+ACTION_TRANSITIONS = ActionTransitions()
+
+
+def replay_flags(num_players, events):
+    '''
+    Works out the PlayerHand flags of each seat from the events of a hand, giving the same flags
+    as replay_hand, but with a table lookup per action instead of going through a Hand
+    '''
+    flags = [0] * num_players
+    state = 0
+    transitions = ACTION_TRANSITIONS
+    # hands are replayed one action at a time, so this loop is what replaying from the events costs
+    pairs = iter(events)
+    for seat, event_code in zip(pairs, pairs):
+        state, flags[seat] = transitions[state | flags[seat] | event_code]
+    return [seat_flags >> 8 for seat_flags in flags]
+
+
+def restore_hand(hand_number, player_names, sb_index, flags, events):
+    '''
+    Rebuilds the Hand as the parser left it from its logged flags, without replaying the actions
+    (the blind amounts aren't logged, so only the small blind's seat comes back)
+    '''
+    hand = Hand(sb_index=sb_index, hand_number=hand_number)
+    hand.player_order = list(player_names)
+    for player_name, player_flags in zip(player_names, flags):
+        player = hand.players[player_name] = PlayerHand(player_name)
+        player.flags = player_flags
+    hand.events = bytearray(events)
+    return hand
+
+
+class EventLog:
+    '''
+    Appends the hands given to add_hand to the log file (in batches, when flush is called
+    or enough have built up), and replays the whole log.
+    '''
+    # how many bytes we buffer before writing them to the file
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # the numbers of the players and games in our segment, which starts with the first hand added after a flush
+        self.player_numbers = {}
+        self.game_numbers = {}
+        self.segment_started = False
+        self.pending = bytearray()
+
+    def read(self):
+        ''' the bytes of the log, including anything not yet flushed '''
+        if not os.path.exists(self.file_name):
+            return bytes(self.pending) if self.pending else MAGIC
+        with open(self.file_name, 'rb') as file:
+            return file.read() + self.pending
+
+    def _start_segment(self):
+        if not os.path.exists(self.file_name) or os.path.getsize(self.file_name) == 0:
+            self.pending += MAGIC
+        self.pending += b'S'
+        self._add_name(b'F', FLAGS_LAYOUT)
+        self.segment_started = True
+
+    def _add_name(self, kind, name):
+        encoded = name.encode('utf-8')
+        self.pending += kind + NAME_HEADER.pack(len(encoded)) + encoded
+
+    def _number(self, numbers, kind, name):
+        number = numbers.get(name)
+        if number is None:
+            number = len(numbers)
+            numbers[name] = number
+            self._add_name(kind, name)
+        return number
+
+    def add_hand(self, game_id, hand):
+        flags = [hand.players[player_name].flags for player_name in hand.player_order]
+        self.add_events(game_id, hand.hand_number, hand.player_order, hand.sb_index, flags, hand.events)
+
+    def add_events(self, game_id, hand_number, player_names, sb_index, flags, events):
+        if not self.segment_started:
+            self._start_segment()
+        game_number = self._number(self.game_numbers, b'G', game_id or '')
+        seats = []
+        for player_name, player_flags in zip(player_names, flags):
+            seats += (self._number(self.player_numbers, b'P', player_name), player_flags)
+        self.pending += b'H' + HAND_HEADER.pack(
+            hand_number if hand_number is not None else NO_HAND_NUMBER, game_number,
+            sb_index if sb_index is not None else NO_SB, len(player_names), len(events) // 2
+        )
+        self.pending += struct.pack(f'<{len(seats)}I', *seats)
+        self.pending += events
+        if len(self.pending) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # in a single write, so that another process appending to the log (e.g. bulk_import.py while the hud
+        # is open) can't land in the middle of it
+        with open(self.file_name, 'ab') as file:
+            file.write(self.pending)
+        self.pending = bytearray()
+        # and since that other process may have started a segment of its own since our last flush,
+        # whatever we add next starts a new segment, naming its players and games again
+        self.player_numbers = {}
+        self.game_numbers = {}
+        self.segment_started = False
+
+    def close(self):
+        '''
+        Writes the hands that are still buffered. The file is only ever open while we flush,
+        so there is nothing else to close.
+        '''
+        self.flush()
+
+    def replay(self, rules=STAT_RULES, game_ids=None, from_events=False):
+        '''
+        Recomputes the stats of every game in the log (or just those in game_ids),
+        counting them with rules (see analyze_hands.STAT_RULES).
+        The flags saved with each hand are used when they are still laid out the way PlayerHand
+        works them out today; otherwise (or with from_events) the hand is replayed from its actions.
+        A hand that was logged more than once (e.g. a file that was read again) is only counted once.
+        Returns a dict mapping each game id to its StatsMatrix, and a dict mapping each game id
+        to the numbers of its hands.
+        '''
+        # the players and games of the segment we are in, by their numbers there.
+        # Each game is (its tallies, the set of its hand numbers), or None if it isn't in game_ids
+        player_names = []
+        games = []
+        flags_current = False
+        # (game id, the player names of the segment, {(player number, flags): how many of their hands had those flags})
+        # for every game of every segment. Most hands of a player repeat a handful of flag patterns,
+        # so they are only turned into counters once at the end
+        segment_tallies = []
+        hand_numbers_by_game_id = {}
+        seen_hands = set()
+        # (number of players, events) -> the flags they replay to, as hands that are played out the same way
+        # (e.g. everyone folding to the big blind) come up again and again
+        flags_by_events = {}
+        for record in read_records(self.read()):
+            kind = record[0]
+            if kind == 'H':
+                _, hand_number, game_number, sb_index, player_numbers, flags, events = record
+                game = games[game_number]
+                if game is None:
+                    continue
+                tallies, hand_numbers = game
+                if hand_number is not None:
+                    if hand_number in seen_hands:
+                        continue
+                    seen_hands.add(hand_number)
+                    hand_numbers.add(hand_number)
+                if not flags_current or from_events:
+                    key = (len(player_numbers), events)
+                    flags = flags_by_events.get(key)
+                    if flags is None:
+                        flags = flags_by_events[key] = replay_flags(len(player_numbers), events)
+                tallies.update(zip(player_numbers, flags))
+            elif kind == 'P':
+                player_names.append(record[1])
+            elif kind == 'G':
+                game_id = record[1]
+                if game_ids is None or game_id in game_ids:
+                    tallies = Counter()
+                    segment_tallies.append((game_id, player_names, tallies))
+                    games.append((tallies, hand_numbers_by_game_id.setdefault(game_id, set())))
+                else:
+                    games.append(None)
+            elif kind == 'S':
+                player_names = []
+                games = []
+            else:
+                flags_current = record[1] == FLAGS_LAYOUT
+
+        # game id -> player name -> their counters
+        rows_by_game_id = {}
+        for game_id, segment_player_names, tallies in segment_tallies:
+            if not tallies:
+                continue
+            rows = rows_by_game_id.setdefault(game_id, {})
+            for (player_number, player_flags), count in tallies.items():
+                player_name = segment_player_names[player_number]
+                row = rows.get(player_name)
+                if row is None:
+                    row = rows[player_name] = [0] * NUM_STATS
+                for column in stat_columns(player_flags, rules):
+                    row[column] += count
+        game_stats_by_game_id = {}
+        for game_id, rows in rows_by_game_id.items():
+            game_stats = game_stats_by_game_id[game_id] = StatsMatrix()
+            for player_name, row in rows.items():
+                game_stats.add_row(game_stats.player_id(player_name), row)
+        hand_numbers_by_game_id = {game_id: hand_numbers_by_game_id[game_id] for game_id in game_stats_by_game_id}
+        return game_stats_by_game_id, hand_numbers_by_game_id
+
+
+class HandHistory:
+    '''
+    A drop in for the GameIO.hands list that doesn't grow without bound over a long session.
+    The last keep_last hands are kept as they are. Older ones are spilled to a temporary event log
+    (a few dozen bytes each) if spill is set, or otherwise dropped.
+    len() still counts every hand that was added, and iterating streams every hand that is still
+    around back in order, rebuilding the spilled ones one at a time as they are reached.
+    With keep_last=None nothing is ever spilled or dropped, like a plain list.
+    '''
+
+    def __init__(self, keep_last=None, spill=False):
+        self.keep_last = keep_last
+        self.recent = deque()
+        self.num_spilled = 0
+        self.num_dropped = 0
+        self.spill_log = None
+        if spill:
+            spill_file, spill_path = tempfile.mkstemp(prefix='poker_spirit_hands_', suffix='.events')
+            os.close(spill_file)
+            os.remove(spill_path) # so that EventLog starts a new log there
+            self.spill_log = EventLog(spill_path)
+            # the spilled hands only last as long as we do
+            self._remove_spill_file = weakref.finalize(self, _remove_file, spill_path)
+
+    def __len__(self):
+        return self.num_dropped + self.num_spilled + len(self.recent)
+
+    def append(self, hand):
+        self.recent.append(hand)
+        if self.keep_last is not None and len(self.recent) > self.keep_last:
+            old_hand = self.recent.popleft()
+            if self.spill_log is not None:
+                self.spill_log.add_hand(None, old_hand)
+                self.num_spilled += 1
+            else:
+                self.num_dropped += 1
+
+    def __iter__(self):
+        # copied up front, so hands appended while we go through the spilled ones don't break the deque
+        recent = list(self.recent)
+        yield from self.spilled_hands()
+        yield from recent
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not self.num_dropped + self.num_spilled <= index < len(self):
+            raise IndexError('hand index out of range (or the hand was dropped)')
+        return self.recent[index - self.num_dropped - self.num_spilled]
+
+    def spilled_hands(self):
+        '''
+        Yields the spilled hands, oldest first, reading them back from the spill file as we go
+        '''
+        if not self.num_spilled:
+            return
+        self.spill_log.flush()
+        player_names = []
+        with open(self.spill_log.file_name, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for record in read_records(data):
+                kind = record[0]
+                if kind == 'H':
+                    _, hand_number, _, sb_index, player_numbers, flags, events = record
+                    yield restore_hand(hand_number, [player_names[number] for number in player_numbers],
+                                       sb_index, flags, events)
+                elif kind == 'P':
+                    player_names.append(record[1])
+                elif kind == 'S':
+                    player_names = []
+
+    def close(self):
+        '''
+        Removes the spill file (the spilled hands are gone after this)
+        '''
+        if self.spill_log is not None:
+            self._remove_spill_file()
+            self.spill_log = None
+            self.num_dropped += self.num_spilled
+            self.num_spilled = 0
+
+
+def _remove_file(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    from db_management import PokerStarsDBManager
+
+    parser = argparse.ArgumentParser(description='Recompute the stats of every game from the event log.')
+    parser.add_argument('command', choices=['replay'])
+    parser.add_argument('--log', help='the event log (default: the one next to the Poker Stars stats db)')
+    parser.add_argument('--from-events', action='store_true',
+                        help='replay every action, rather than using the flags saved with each hand')
+    parser.add_argument('--save', action='store_true', help='replace the stats of the replayed games in the stats db')
+    args = parser.parse_args()
+
+    db_manager = PokerStarsDBManager()
+    event_log = EventLog(args.log) if args.log else db_manager.event_log()
+    start = time.perf_counter()
+    game_stats_by_game_id, hand_numbers_by_game_id = event_log.replay(from_events=args.from_events)
+    seconds = time.perf_counter() - start
+    num_hands = sum(len(hand_numbers) for hand_numbers in hand_numbers_by_game_id.values())
+    print(f'replayed {num_hands} hands of {len(game_stats_by_game_id)} games in {seconds:.2f} seconds '
+          f'({num_hands / max(seconds, 1e-9):.1f} hands/sec)')
+    if args.save:
+        num_records = db_manager.insert_many_player_stats(game_stats_by_game_id, hand_numbers_by_game_id)
+        print(f'saved {num_records} player records')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+'''
+Writes synthetic (but realistic looking) PokerStars cash game hand histories,
+in the exact line formats that analyze_hands expects. The same seed always gives the same file.
+
+usage: python hand_history_generator.py output.txt [--hands N] [--seats S] [--seed X]
+'''
+
+import argparse
+import datetime
+import random
+
+
+RANKS = '23456789TJQKA'
+SUITS = 'cdhs'
+DECK = [rank + suit for rank in RANKS for suit in SUITS]
+
+SMALL_BLIND = 1 # in cents
+BIG_BLIND = 2
+HERO = 'Hero'
+# max number of raises in a betting round, so that hands always end
+MAX_RAISES = 4
+
+
+def money(cents):
+    return f'${cents / 100:.2f}'.replace('.00', '')
+
+
+class HandHistoryGenerator:
+    '''
+    Plays out random hands at a single table and returns their text.
+    Players mostly stay seated from hand to hand, with the occasional player leaving
+    and being replaced, and the button moves around the table like in a real game.
+    '''
+
+    def __init__(self, num_seats=6, seed=0, table_name='Synthetic', num_names=None):
+        if not 2 <= num_seats <= 9:
+            raise ValueError('num_seats must be between 2 and 9')
+        self.rng = random.Random(seed)
+        self.num_seats = num_seats
+        self.table_name = table_name
+        num_names = num_names or num_seats * 20
+        self.name_pool = [f'player_{self.rng.randrange(10**6):06d}_{i}' for i in range(num_names)]
+        self.seated = [HERO] + self.rng.sample(self.name_pool, num_seats - 1)
+        self.stacks = {name: self.rng.randint(80, 250) * BIG_BLIND for name in self.seated}
+        self.button = 0
+        self.hand_number = 200000000000 + self.rng.randrange(10**9)
+        self.time = datetime.datetime(2020, 5, 1, 10, 0, 0)
+
+    def next_hand(self):
+        '''
+        Returns the lines of the next hand (without the blank lines that separate hands)
+        '''
+        self.hand_number += 1
+        self.time += datetime.timedelta(seconds=self.rng.randint(15, 90))
+        self.button = (self.button + 1) % self.num_seats
+        if self.rng.random() < 0.05:
+            # somebody (other than the hero) leaves, and a new player takes their seat
+            seat = self.rng.randrange(1, self.num_seats)
+            new_player = self.rng.choice(self.name_pool)
+            if new_player not in self.seated:
+                self.seated[seat] = new_player
+                self.stacks[new_player] = self.rng.randint(80, 250) * BIG_BLIND
+        return HandPlayer(self).play()
+
+
+class HandPlayer:
+    '''
+    Plays out a single hand for HandHistoryGenerator
+    '''
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.rng = generator.rng
+        num_seats = generator.num_seats
+        # the order of players starting with the small blind
+        self.order = [generator.seated[(generator.button + 1 + i) % num_seats] for i in range(num_seats)]
+        if num_seats == 2:
+            # heads up, the button posts the small blind
+            self.order = [generator.seated[generator.button], generator.seated[(generator.button + 1) % num_seats]]
+        self.active = list(self.order)
+        self.put_in = {name: 0 for name in self.order} # this betting round
+        self.pot = 0
+        self.lines = []
+        self.deck = list(DECK)
+        self.rng.shuffle(self.deck)
+
+    def deal(self, num_cards):
+        cards = self.deck[:num_cards]
+        del self.deck[:num_cards]
+        return cards
+
+    def play(self):
+        generator = self.generator
+        lines = self.lines
+        date = generator.time.strftime('%Y/%m/%d %H:%M:%S')
+        lines.append(f"PokerStars Hand #{generator.hand_number}:  Hold'em No Limit "
+                     f"({money(SMALL_BLIND)}/{money(BIG_BLIND)} USD) - {date} ET")
+        lines.append(f"Table '{generator.table_name}' {generator.num_seats}-max Seat #{generator.button + 1} is the button")
+        for seat, name in enumerate(generator.seated, 1):
+            lines.append(f'Seat {seat}: {name} ({money(generator.stacks[name])} in chips)')
+        small, big = self.order[0], self.order[1]
+        lines.append(f'{small}: posts small blind {money(SMALL_BLIND)}')
+        lines.append(f'{big}: posts big blind {money(BIG_BLIND)}')
+        self.put_in[small] = SMALL_BLIND
+        self.put_in[big] = BIG_BLIND
+        lines.append('*** HOLE CARDS ***')
+        self.hole_cards = {name: self.deal(2) for name in self.order}
+        lines.append(f'Dealt to {HERO} [{" ".join(self.hole_cards[HERO])}]')
+
+        # pre flop starts left of the big blind
+        pre_flop_order = self.order[2:] + self.order[:2]
+        self.betting_round(pre_flop_order, current_bet=BIG_BLIND)
+
+        board = []
+        for street, num_cards in (('FLOP', 3), ('TURN', 1), ('RIVER', 1)):
+            if len(self.active) < 2:
+                break
+            new_cards = self.deal(num_cards)
+            if board:
+                lines.append(f'*** {street} *** [{" ".join(board)}] [{" ".join(new_cards)}]')
+            else:
+                lines.append(f'*** {street} *** [{" ".join(new_cards)}]')
+            board += new_cards
+            self.betting_round([name for name in self.order if name in self.active], current_bet=0)
+
+        if len(self.active) == 1:
+            winner = self.active[0]
+            lines.append(f'{winner} collected {money(self.pot)} from pot')
+            result = {winner: f'collected ({money(self.pot)})'}
+        else:
+            lines.append('*** SHOW DOWN ***')
+            for name in self.active:
+                lines.append(f'{name}: shows [{" ".join(self.hole_cards[name])}] (a hand)')
+            winner = self.rng.choice(self.active)
+            lines.append(f'{winner} collected {money(self.pot)} from pot')
+            result = {name: f'showed [{" ".join(self.hole_cards[name])}] and lost' for name in self.active}
+            result[winner] = f'showed [{" ".join(self.hole_cards[winner])}] and won ({money(self.pot)})'
+
+        lines.append('*** SUMMARY ***')
+        lines.append(f'Total pot {money(self.pot)} | Rake $0')
+        if board:
+            lines.append(f'Board [{" ".join(board)}]')
+        for seat, name in enumerate(generator.seated, 1):
+            lines.append(f'Seat {seat}: {name} {result.get(name, "folded")}')
+        return lines
+
+    def betting_round(self, order, current_bet):
+        '''
+        Random but plausible actions until everybody still in the hand has matched the bet
+        '''
+        lines = self.lines
+        num_raises = 0
+        # everyone gets to act at least once
+        to_act = list(order)
+        while to_act and len(self.active) > 1:
+            name = to_act.pop(0)
+            if name not in self.active:
+                continue
+            to_call = current_bet - self.put_in[name]
+            roll = self.rng.random()
+            if to_call == 0:
+                if roll < 0.25 and num_raises < MAX_RAISES:
+                    amount = max(BIG_BLIND, self.rng.choice((1, 2, 3)) * max(self.pot, BIG_BLIND) // 3)
+                    if current_bet == 0:
+                        lines.append(f'{name}: bets {money(amount)}')
+                    else:
+                        lines.append(f'{name}: raises {money(amount)} to {money(current_bet + amount)}')
+                    current_bet += amount
+                    num_raises += 1
+                    self.put_in[name] = current_bet
+                    to_act = [other for other in self.rotation(order, name) if other in self.active]
+                else:
+                    lines.append(f'{name}: checks')
+            else:
+                fold_chance = 0.55 if num_raises < 2 else 0.7
+                if roll < fold_chance:
+                    lines.append(f'{name}: folds')
+                    self.active.remove(name)
+                elif roll < 0.92 or num_raises >= MAX_RAISES:
+                    lines.append(f'{name}: calls {money(to_call)}')
+                    self.put_in[name] = current_bet
+                else:
+                    raise_by = max(current_bet, BIG_BLIND) * self.rng.choice((2, 3))
+                    new_bet = current_bet + raise_by
+                    lines.append(f'{name}: raises {money(raise_by)} to {money(new_bet)}')
+                    current_bet = new_bet
+                    num_raises += 1
+                    self.put_in[name] = current_bet
+                    to_act = [other for other in self.rotation(order, name) if other in self.active]
+
+        self.pot += sum(self.put_in.values())
+        if len(self.active) == 1:
+            winner = self.active[0]
+            # whatever nobody called goes back to the last bettor
+            others = max([put_in for name, put_in in self.put_in.items() if name != winner], default=0)
+            uncalled = self.put_in[winner] - others
+            if uncalled > 0:
+                lines.append(f'Uncalled bet ({money(uncalled)}) returned to {winner}')
+                self.pot -= uncalled
+        self.put_in = {name: 0 for name in self.order}
+
+    @staticmethod
+    def rotation(order, name):
+        ''' everyone else in order, starting after name '''
+        index = order.index(name)
+        return order[index + 1:] + order[:index]
+
+
+def write_history(path, num_hands, num_seats=6, seed=0, table_name='Synthetic'):
+    '''
+    Writes num_hands hands to path, the way PokerStars does (a byte order mark at the start,
+    and three blank lines after every hand). Returns the path.
+    '''
+    generator = HandHistoryGenerator(num_seats=num_seats, seed=seed, table_name=table_name)
+    with open(path, 'w', encoding='utf-8-sig', newline='\n') as file:
+        for _ in range(num_hands):
+            file.write('\n'.join(generator.next_hand()))
+            file.write('\n\n\n\n')
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic PokerStars hand history.')
+    parser.add_argument('path')
+    parser.add_argument('--hands', type=int, default=1000)
+    parser.add_argument('--seats', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--table', default='Synthetic')
+    args = parser.parse_args()
+    write_history(args.path, args.hands, args.seats, args.seed, args.table)
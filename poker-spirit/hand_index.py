@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''
+An on-disk index of every hand we have parsed: where it lives (file, byte offset, length)
+and who was seated, so that any hand can be pulled back out of the history files
+without scanning them again.
+
+usage:
+    python hand_index.py hand HAND_NUMBER
+    python hand_index.py player PLAYER_NAME [--limit 20]
+    python hand_index.py build FILE [FILE ...]
+'''
+
+import argparse
+import os
+import sqlite3
+
+from analyze_hands import PokerStarsGameIO
+
+
+class HandIndex:
+    FILE_NAME = 'hand_index.sqlite3'
+    # how many hands we buffer before writing them to the index
+    BATCH_SIZE = 1000
+
+    def __init__(self, file_name=None):
+        self.file_name = file_name or self.FILE_NAME
+        self.connection = sqlite3.connect(self.file_name)
+        self.file_ids = {}
+        self.pending_hands = []
+        self.pending_players = []
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS hands ('
+                'hand_number INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS hand_players ('
+                'player_name TEXT NOT NULL, hand_number INTEGER NOT NULL, '
+                'PRIMARY KEY (player_name, hand_number)) WITHOUT ROWID'
+            )
+
+    def file_id(self, path_to_file):
+        path_to_file = os.path.abspath(path_to_file)
+        file_id = self.file_ids.get(path_to_file)
+        if file_id is None:
+            with self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO files (path) VALUES (?)', (path_to_file,))
+            file_id = self.connection.execute('SELECT file_id FROM files WHERE path = ?', (path_to_file,)).fetchone()[0]
+            self.file_ids[path_to_file] = file_id
+        return file_id
+
+    def add_hand(self, hand_number, path_to_file, offset, length, player_names):
+        '''
+        Records where a hand is. Hands are buffered, and written in batches (or by commit())
+        '''
+        if hand_number is None:
+            return
+        self.pending_hands.append((hand_number, self.file_id(path_to_file), offset, length))
+        self.pending_players += [(player_name, hand_number) for player_name in player_names]
+        if len(self.pending_hands) >= self.BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        if not self.pending_hands:
+            return
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO hands VALUES (?, ?, ?, ?)', self.pending_hands)
+            self.connection.executemany('INSERT OR IGNORE INTO hand_players VALUES (?, ?)', self.pending_players)
+        self.pending_hands = []
+        self.pending_players = []
+
+    def get_location(self, hand_number):
+        '''
+        Returns (path_to_file, offset, length) of the hand, or None if it isn't in the index
+        '''
+        return self.connection.execute(
+            'SELECT files.path, hands.offset, hands.length FROM hands JOIN files USING (file_id) WHERE hand_number = ?',
+            (hand_number,)
+        ).fetchone()
+
+    def get_raw(self, hand_number):
+        ''' returns the text of the hand, exactly as PokerStars wrote it '''
+        location = self.get_location(hand_number)
+        if location is None:
+            return None
+        path_to_file, offset, length = location
+        with open(path_to_file, 'rb') as file:
+            file.seek(offset)
+            return file.read(length).decode('utf-8', errors='replace').lstrip('\ufeff')
+
+    def get_hand(self, hand_number):
+        ''' returns the hand parsed into a Hand '''
+        raw = self.get_raw(hand_number)
+        if raw is None:
+            return None
+        path_to_file, _, _ = self.get_location(hand_number)
+        game = PokerStarsGameIO(path_to_file)
+        game.process_single_hand(raw.splitlines(), hand_number)
+        return game.current_hand
+
+    def hand_numbers_for_player(self, player_name, limit=20):
+        ''' the most recent hand numbers (newest first) that player_name was seated for '''
+        rows = self.connection.execute(
+            'SELECT hand_number FROM hand_players WHERE player_name = ? ORDER BY hand_number DESC LIMIT ?',
+            (player_name, limit)
+        )
+        return [row[0] for row in rows]
+
+    def get_raw_for_player(self, player_name, limit=20):
+        return [self.get_raw(hand_number) for hand_number in self.hand_numbers_for_player(player_name, limit)]
+
+    def get_hands_for_player(self, player_name, limit=20):
+        return [self.get_hand(hand_number) for hand_number in self.hand_numbers_for_player(player_name, limit)]
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Look up hands in the hand index.')
+    parser.add_argument('--index', default=HandIndex.FILE_NAME, help='the index file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    hand_parser = subparsers.add_parser('hand', help='print a hand by its number')
+    hand_parser.add_argument('hand_number', type=int)
+    player_parser = subparsers.add_parser('player', help="print a player's most recent hands")
+    player_parser.add_argument('player_name')
+    player_parser.add_argument('--limit', type=int, default=20)
+    build_parser = subparsers.add_parser('build', help='index hand history files')
+    build_parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    hand_index = HandIndex(args.index)
+    if args.command == 'hand':
+        print(hand_index.get_raw(args.hand_number))
+    elif args.command == 'player':
+        for raw in reversed(hand_index.get_raw_for_player(args.player_name, args.limit)):
+            print(raw)
+            print()
+    elif args.command == 'build':
+        for path_to_file in args.paths:
+            PokerStarsGameIO(path_to_file, hand_index=hand_index).analyze_new_hands()
+            print(f'indexed {path_to_file}')
+    hand_index.close()
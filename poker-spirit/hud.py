@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 import os
+import queue
+import threading
+import time
 
 from collections import defaultdict
 
 import tkinter as tk
-from tkinter.filedialog import askopenfilename
 from tkinter import ttk
 
-from analyze_hands import PokerStarsGameIO, GameIO, assign_stats_from_hand
+from analyze_hands import PokerStarsGameIO
 from db_management import PokerStarsDBManager
-from dotenv import load_dotenv
+from event_log import HandHistory
+from hand_index import HandIndex
+import instrumentation
+from instrumentation import INSTRUMENTATION
+from multi_table import MultiTableTracker, DirectoryWatcher, HANDS_KEPT, RECENT_HANDS
+from stats_matrix import StatsMatrix, StatLines, RollingStats, RATIO_BY_NAME
+
+# how often the Tk loop picks up results from the worker, and so the most often the windows get repainted
+POLL_INTERVAL_MS = 33
 
 def merge_current_and_career_stats(game, career_stats):
         '''
@@ -27,136 +37,341 @@ def merge_current_and_career_stats(game, career_stats):
 
 class PlayerWindowsManager:
     # making this its own class so that we can use this code in the live tracker gui as well
-    def __init__(self):
+
+    # the lines of each player's window, by their names in stats_matrix.RATIOS
+    STAT_NAMES = ('vpip', 'pfr', '3_bet', 'folds_to_3_bet', 'c_bet', 'folds_to_c_bet', '4_bet')
+
+    def __init__(self, master=None):
+        # the windows are Toplevels of master (by default the app's Tk root), rather than a Tk root each
+        self.master = master
         self.player_windows = {}
-        self.player_career_windows = {}        
+        self.player_career_windows = {}
+        self.player_recent_windows = {}
+        # whether to show a third window per player with their stats over their last few hands (see GameIO.recent_stats)
+        self.show_recent = True
+        # window -> its Text and the lines it is showing, so a refresh only redraws lines that changed
+        self.rendered = {}
+        # the lines of the game stats and of the career stats of each player, only reformatted when they change
+        ratios = [RATIO_BY_NAME[name] for name in self.STAT_NAMES]
+        self.game_lines = StatLines(ratios)
+        self.career_lines = StatLines(ratios)
+        self.recent_lines = StatLines(ratios)
+        # how long the last populate took, and how many lines it redrew
+        self.last_refresh_seconds = 0.0
+        self.last_num_lines_updated = 0
 
     def destroy(self):
         for window in self.player_windows.values():
             window.destroy()
         for window in self.player_career_windows.values():
             window.destroy()
-        
-    def insert_stats_into_text(self, text, game_stats, player_name):
-        text.delete(0.0, tk.END) # clear what is there
-        text.insert(tk.END,
-                    GameIO.vpip_str(game_stats, player_name) + "\n"
-        )
-        text.insert(tk.END,
-                    GameIO.pfr_str(game_stats, player_name) + "\n"
-        )
-        text.insert(tk.END,
-                    GameIO._3_bet_str(game_stats, player_name) + "\n"
-        )
-        text.insert(tk.END,
-                    GameIO.folds_to_3_bet_str(game_stats, player_name) + "\n"
-        )
-        text.insert(tk.END,
-                    GameIO.c_bet_str(game_stats, player_name) + "\n"
-        )
-        text.insert(tk.END,
-                    GameIO.folds_to_c_bet_str(game_stats, player_name) + "\n"                    
-        )
-        text.insert(tk.END,
-                    GameIO._4_bet_str(game_stats, player_name) + "\n"                
-        )
+        for window in self.player_recent_windows.values():
+            window.destroy()
+        self.player_windows = {}
+        self.player_career_windows = {}
+        self.player_recent_windows = {}
+        self.rendered = {}
+
+    def make_window(self, title):
+        window = tk.Toplevel(self.master)
+        window.geometry("185x100")
+        window.title(title)
+        text = tk.Text(window)
+        text.insert(tk.END, "\n" * len(self.STAT_NAMES))
+        text.pack()
+        self.rendered[window] = (text, (None,) * len(self.STAT_NAMES))
+        return window
+
+    def insert_stats_into_text(self, window, lines):
+        '''
+        Redraws the lines of the window that have changed since it was last drawn.
+        Returns how many lines were redrawn.
+        '''
+        text, old_lines = self.rendered[window]
+        if lines is old_lines:
+            # the player's stats haven't changed, so StatLines gave us back the same lines
+            return 0
+        num_updated = 0
+        for index, line in enumerate(lines):
+            if line != old_lines[index]:
+                text.delete(f'{index + 1}.0', f'{index + 1}.end')
+                text.insert(f'{index + 1}.0', line)
+                num_updated += 1
+        self.rendered[window] = (text, lines)
+        return num_updated
     
     def populate(self, game, career_stats_by_player):
+        with INSTRUMENTATION.timer('hud.player_windows'):
+            self._populate(game, career_stats_by_player)
+
+    def _populate(self, game, career_stats_by_player):
+        start = time.perf_counter()
         new_stats = merge_current_and_career_stats(game, career_stats_by_player)
+        recent_stats = getattr(game, 'recent_stats', None) if self.show_recent else None
+        num_updated = 0
         
         for player_name in sorted(game.current_players, key=lambda x: x.lower()):            
-            if player_name in self.player_windows:
-                window = self.player_windows[player_name]
-                text = window.winfo_children()[0]
-            else:
-                # a new player has entered the table
-                window = tk.Tk()
-                self.player_windows[player_name] = window                
-                window.geometry("185x100")
-                window.title(player_name)
-                text = tk.Text(window)
-
-            self.insert_stats_into_text(text, game.game_stats, player_name)
-            text.pack()
-
-            #####
-            #####
-            if player_name in self.player_career_windows:
-                window = self.player_career_windows[player_name]
-                text = window.winfo_children()[0]
-            else:
-                # a new player has entered the table
-                window = tk.Tk()
-                self.player_career_windows[player_name] = window                
-                window.geometry("185x100")
-                window.title(player_name)
-                text = tk.Text(window)
-
-            self.insert_stats_into_text(text, new_stats, player_name)
-            text.pack()
+            # a new player who has entered the table gets their windows made here
+            num_updated += self.show_player_stats(self.player_windows, self.game_lines,
+                                                  game.game_stats, player_name, player_name)
+            num_updated += self.show_player_stats(self.player_career_windows, self.career_lines,
+                                                  new_stats, player_name, player_name)
+            if recent_stats is not None and player_name in recent_stats:
+                num_updated += self.show_player_stats(self.player_recent_windows, self.recent_lines,
+                                                      recent_stats, player_name, f'{player_name} (recent)')
             
         # don't want to have windows lingering around for players who
         # are no longer at the table
-        for player_name in list(self.player_windows.keys()):
-            if player_name not in game.current_players:
-                del self.player_windows[player_name]
-                del self.player_career_windows[player_name]    
+        for windows, stat_lines in ((self.player_windows, self.game_lines),
+                                    (self.player_career_windows, self.career_lines),
+                                    (self.player_recent_windows, self.recent_lines)):
+            for player_name in list(windows.keys()):
+                if player_name not in game.current_players or (windows is self.player_recent_windows and recent_stats is None):
+                    window = windows.pop(player_name)
+                    del self.rendered[window]
+                    window.destroy()
+                    stat_lines.forget(player_name)
+
+        self.last_refresh_seconds = time.perf_counter() - start
+        self.last_num_lines_updated = num_updated
+        INSTRUMENTATION.count('hud.lines_redrawn', num_updated)
+
+    def show_player_stats(self, windows, stat_lines, game_stats, player_name, title):
+        '''
+        Shows the player's lines of game_stats in their window of windows, making it if they don't have one yet.
+        Returns how many lines were redrawn.
+        '''
+        window = windows.get(player_name)
+        if window is None:
+            INSTRUMENTATION.count('hud.windows_created')
+            window = windows[player_name] = self.make_window(title)
+        return self.insert_stats_into_text(window, stat_lines.lines(game_stats, player_name))
 
 class AllPlayerWindow:
     # making this its own class so that we can use this code in the live tracker gui as well
-    def __init__(self):
-        self.window = tk.Tk()
+    def __init__(self, master=None):
+        self.window = tk.Toplevel(master)
         self.window.geometry("640x512")
         self.window.title("Stats")
-        self.tree = ttk.Treeview(self.window, columns=('player', 'hands', 'vpip', 'pfr'), show='headings')   
+        self.tree = ttk.Treeview(self.window, columns=('player', 'hands', 'vpip', 'pfr', 'recent_vpip', 'recent_pfr'),
+                                 show='headings')   
         
         self.tree.heading('player', text="Player")
         self.tree.heading('hands', text="Hands Played")
         self.tree.heading('vpip', text="VP")
         self.tree.heading('pfr', text="PR")
+        self.tree.heading('recent_vpip', text="Recent VP")
+        self.tree.heading('recent_pfr', text="Recent PR")
 
         self.tree.column("player", minwidth=5, width=30)
         self.tree.column("hands", minwidth=2, width=4) 
         self.tree.column("vpip", minwidth=2, width=4) 
         self.tree.column("pfr", minwidth=2, width=4) 
+        self.tree.column("recent_vpip", minwidth=2, width=4)
+        self.tree.column("recent_pfr", minwidth=2, width=4)
+        # player_name -> (the id of their row, the values it shows)
+        self.rows = {}
         
     def destroy(self):
         self.window.destroy()
         
+    @staticmethod
+    def vpip_and_pfr(stats):
+        hands_played = stats['hands_played']
+        if hands_played > 0:
+            return round(100*stats["vpip"]/hands_played, 1), round(100*stats["pfr"]/hands_played, 1)
+        return 0.0, 0.0
+
     def insert_stats_into_text(self, game, game_stats):
-        # clear treeview
-        self.tree.delete(*self.tree.get_children())
-        for player_name in game.current_players:
-            stats = game_stats[player_name]
-            hands_played = stats['hands_played']
-            vpip = 0.0
-            pfr = 0.0
+        recent_stats = getattr(game, 'recent_stats', None)
+        for player_name in list(self.rows):
+            if player_name not in game.current_players:
+                self.tree.delete(self.rows.pop(player_name)[0])
 
-            if hands_played > 0:
-                vpip = round(100*stats["vpip"]/hands_played, 1)
-                pfr = round(100*stats["pfr"]/hands_played, 1)
+        for index, player_name in enumerate(game.current_players):
+            stats = game_stats[player_name]
+            vpip, pfr = self.vpip_and_pfr(stats)
+            recent_vpip, recent_pfr = '', ''
+            if recent_stats is not None and player_name in recent_stats:
+                recent_vpip, recent_pfr = self.vpip_and_pfr(recent_stats[player_name])
 
-            self.tree.insert("", "end", values=(player_name, hands_played, vpip, pfr))
+            values = (player_name, stats['hands_played'], vpip, pfr, recent_vpip, recent_pfr)
+            row = self.rows.get(player_name)
+            if row is None:
+                INSTRUMENTATION.count('hud.rows_updated')
+                self.rows[player_name] = (self.tree.insert("", index, values=values), values)
+            elif row[1] != values:
+                INSTRUMENTATION.count('hud.rows_updated')
+                self.tree.item(row[0], values=values)
+                self.rows[player_name] = (row[0], values)
 
 
     def populate(self, game, career_stats_by_player):
-        new_stats = merge_current_and_career_stats(game, career_stats_by_player)
-
-        self.insert_stats_into_text(game, new_stats)
+        with INSTRUMENTATION.timer('hud.all_players_window'):
+            new_stats = merge_current_and_career_stats(game, career_stats_by_player)
+            self.insert_stats_into_text(game, new_stats)
         self.tree.pack(side=tk.TOP,fill=tk.X)
    
         
+class GameSnapshot:
+    '''
+    What the windows need from a game: the players at the table and their stats, copied
+    so that the worker can carry on with the game while the windows are drawn
+    '''
+    def __init__(self, game, career_stats_by_player):
+        self.game_id = game.game_id
+        self.num_hands = len(game.hands)
+        self.current_players = list(game.current_players)
+        self.game_stats = StatsMatrix()
+        for player_name in self.current_players:
+            self.game_stats[player_name] = game.game_stats[player_name]
+        self.recent_stats = None
+        if game.recent_stats is not None:
+            self.recent_stats = game.recent_stats.select(self.current_players)
+        self.career_stats_by_player = {
+            player_name: career_stats_by_player[player_name]
+            for player_name in self.current_players if player_name in career_stats_by_player
+        }
+
+
+class HUDWorker(threading.Thread):
+    '''
+    Does all of the parsing and db work for the App, so that the Tk thread never waits on it.
+    Requests come in on self.requests as (request, argument) and results go out on self.results,
+    which the App drains from the Tk loop. The db and the hand index are only ever used from this
+    thread (a SQLite connection belongs to the thread that opened it).
+    While it is following several tables, it polls their files whenever no request has come in
+    for MultiTableTracker.POLL_SECONDS.
+    '''
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        # set to stop reading the current file (after the hand being analyzed)
+        self.cancel_event = threading.Event()
+        self.game = None
+        # the tables being followed, if any, the DirectoryWatcher finding them (if we are watching
+        # a directory), and whether we are still polling them
+        self.tracker = None
+        self.watcher = None
+        self.following = False
+
+    def run(self):
+        INSTRUMENTATION.start_profile()
+        self.db_manager = PokerStarsDBManager()
+        self.hand_index = HandIndex()
+        while True:
+            try:
+                request, argument = self.requests.get(timeout=MultiTableTracker.POLL_SECONDS if self.following else None)
+            except queue.Empty:
+                self.poll_tables()
+                continue
+            if request == 'stop':
+                break
+            if request == 'read':
+                # a burst of reads of the same file only needs one pass over the new hands
+                while not self.requests.empty() and self.requests.queue[0] == (request, argument):
+                    self.requests.get()
+            try:
+                if request == 'read':
+                    self.read_file(argument)
+                elif request == 'track':
+                    self.track_tables(argument)
+                elif request == 'watch':
+                    self.watch_directory(argument)
+                elif request == 'save':
+                    self.save_data()
+            except Exception as error:
+                self.results.put(('error', f'{request} failed: {error}'))
+        self.hand_index.close()
+        self.db_manager.close()
+        INSTRUMENTATION.stop_profile()
+
+    def read_file(self, filename):
+        self.cancel_event.clear()
+        if self.game is None or self.game.path_to_file != filename:
+            if self.game is not None:
+                self.game.hands.close()
+            self.game = PokerStarsGameIO(filename, hand_index=self.hand_index,
+                                         ingested_hands=self.db_manager.ingested_hands(),
+                                         hands=HandHistory(keep_last=HANDS_KEPT, spill=True))
+            self.game.recent_stats = RollingStats(RECENT_HANDS)
+        # on a file we have already read, this only analyzes the newly written hands
+        self.game.run_file(progress=self.report_progress, cancelled=self.cancel_event.is_set)
+        career_stats_by_player = self.db_manager.load_player_history(self.game)
+        with INSTRUMENTATION.timer('worker.snapshot'):
+            snapshot = GameSnapshot(self.game, career_stats_by_player)
+        self.results.put(('stats', snapshot))
+        if self.cancel_event.is_set():
+            self.results.put(('status', f'cancelled, {len(self.game.hands)} hands read'))
+        else:
+            self.results.put(('status', f'{len(self.game.hands)} hands read'))
+
+    def report_progress(self, bytes_done, bytes_total, hands_done):
+        self.results.put(('progress', (bytes_done, bytes_total, hands_done)))
+
+    def track_tables(self, filenames):
+        '''
+        Starts following every file in filenames (along with any we are following already)
+        '''
+        self.cancel_event.clear()
+        if self.tracker is None:
+            self.tracker = MultiTableTracker(db_manager=self.db_manager, hand_index=self.hand_index)
+        for filename in filenames:
+            self.tracker.add_table(filename)
+        self.following = True
+        self.results.put(('status', f'following {len(self.tracker.active)} tables...'))
+        self.poll_tables()
+
+    def watch_directory(self, directory):
+        '''
+        Follows every table being played in the directory, picking up new tables as they open
+        '''
+        self.cancel_event.clear()
+        if self.tracker is None:
+            self.tracker = MultiTableTracker(db_manager=self.db_manager, hand_index=self.hand_index)
+        self.watcher = DirectoryWatcher(directory, self.tracker)
+        self.following = True
+        self.results.put(('status', f'watching {directory}...'))
+        self.poll_tables()
+
+    def poll_tables(self):
+        poller = self.watcher if self.watcher is not None else self.tracker
+        updated = poller.poll(cancelled=self.cancel_event.is_set)
+        if updated:
+            with INSTRUMENTATION.timer('worker.snapshot'):
+                snapshot = self.tracker.snapshot()
+            self.results.put(('stats', snapshot))
+            self.results.put(('status', f'{snapshot.num_hands} hands read at {snapshot.num_tables} tables'))
+        if self.cancel_event.is_set():
+            # cancelling stops following the tables, but keeps their games around to save
+            self.results.put(('status', f'stopped following {len(self.tracker.active)} tables'))
+            self.following = False
+            self.watcher = None
+
+    def save_data(self):
+        num_records = 0
+        if self.game is not None:
+            num_records += self.db_manager.insert_player_stats(self.game)
+        if self.tracker is not None:
+            num_records += self.tracker.save()
+        self.results.put(('status', f'saved {num_records} player records'))
+
+
 class App:
     def __init__(self):
         self.filename = None
-        self.db_manager = PokerStarsDBManager()
-        self.career_stats_by_player = {}
+        self.worker = HUDWorker()
+        self.snapshot = None # the newest stats from the worker, until they are drawn
         self.pwm = PlayerWindowsManager()
         self.one_window = None
         self.stats_window = None
         self.show_player_stats = None
-        load_dotenv()
+        self.show_recent_stats = None
         # get env vars from .env file
+        from dotenv import load_dotenv
+        load_dotenv()
         self.path_to_hands = os.getenv("PATH_TO_HANDS", ".")
         self.path_to_stats_db = os.getenv("PATH_TO_STATS_DB", "player_stats.db")        
                                        
@@ -171,6 +386,8 @@ class App:
         return truncated
     
     def select_file(self):
+        # the dialogs are only imported once they are wanted, to keep startup quick
+        from tkinter.filedialog import askopenfilename
         filename =  askopenfilename(initialdir = self.path_to_hands,
                                     title = "Select file"
         )
@@ -186,30 +403,96 @@ class App:
     def read_file(self):
         if self.filename is None:
             return
-        else:
-            self.game = PokerStarsGameIO(self.filename)
-            self.game.run_file()
-            self.career_stats_by_player = self.db_manager.load_player_history(self.game, self.career_stats_by_player)
+        self.status_var.set('reading...')
+        self.progress_bar['value'] = 0
+        self.worker.requests.put(('read', self.filename))
+
+    def follow_tables(self):
+        '''
+        Follows several tables at once: every hand written to any of the chosen files is counted
+        as it comes in, with each player's stats shared between the tables
+        '''
+        from tkinter.filedialog import askopenfilenames
+        filenames = askopenfilenames(initialdir = self.path_to_hands,
+                                     title = "Select the files of the tables to follow"
+        )
+        if not filenames:
+            return
+        self.status_var.set('reading...')
+        self.progress_bar['value'] = 0
+        self.worker.requests.put(('track', list(filenames)))
 
-            if self.show_player_stats.get():
-                self.pwm.populate(self.game, self.career_stats_by_player)
+    def watch_directory(self):
+        '''
+        Follows every table being played in a hand history directory, without choosing the files
+        '''
+        from tkinter.filedialog import askdirectory
+        directory = askdirectory(initialdir = self.path_to_hands,
+                                 title = "Select the hand history directory to watch"
+        )
+        if not directory:
+            return
+        self.status_var.set('reading...')
+        self.progress_bar['value'] = 0
+        self.worker.requests.put(('watch', directory))
 
-            if self.one_window.get():
-                if self.stats_window is None:
-                    self.stats_window = AllPlayerWindow()
-                self.stats_window.populate(self.game, self.career_stats_by_player)
+    def cancel_read(self):
+        self.worker.cancel_event.set()
 
     def save_data(self):
-        self.db_manager.insert_player_stats(self.game)
+        self.worker.requests.put(('save', None))
+
+    def poll_worker(self):
+        '''
+        Runs on the Tk loop every POLL_INTERVAL_MS: takes everything the worker has sent,
+        and repaints at most once, with the newest stats
+        '''
+        while True:
+            try:
+                kind, result = self.worker.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'stats':
+                self.snapshot = result
+            elif kind == 'progress':
+                bytes_done, bytes_total, hands_done = result
+                self.progress_bar['value'] = 100 * bytes_done / bytes_total if bytes_total else 100
+                self.status_var.set(f'reading... {hands_done} hands')
+            else:
+                self.status_var.set(result)
+
+        if self.snapshot is not None:
+            self.show_stats(self.snapshot)
+            self.snapshot = None
+        self.window.after(POLL_INTERVAL_MS, self.poll_worker)
+
+    def show_stats(self, snapshot):
+        self.progress_bar['value'] = 100
+        if self.show_player_stats.get():
+            self.pwm.show_recent = self.show_recent_stats.get()
+            self.pwm.populate(snapshot, snapshot.career_stats_by_player)
+
+        if self.one_window.get():
+            if self.stats_window is None:
+                self.stats_window = AllPlayerWindow()
+            self.stats_window.populate(snapshot, snapshot.career_stats_by_player)
+
+        if INSTRUMENTATION.enabled:
+            # draw now rather than whenever Tk gets round to it, so that the drawing can be timed
+            with INSTRUMENTATION.timer('hud.tk_redraw'):
+                self.window.update_idletasks()
             
     def quit(self):
-        self.window.destroy()
+        self.worker.cancel_event.set()
+        self.worker.requests.put(('stop', None))
+        # the player windows belong to the main window, so they go first
         self.pwm.destroy()
+        self.window.destroy()
             
     def main(self):
-        self.game = None
+        self.worker.start()
         self.window = tk.Tk()
-        self.window.geometry("575x240")
+        self.window.geometry("575x395")
         
         self.window.title( "Poker Spirit")
 
@@ -230,10 +513,31 @@ class App:
         self.show_player_stats.set(1)
         ttk.Checkbutton(self.window, text="Show Player Stats", variable=self.show_player_stats).pack()
 
+        self.show_recent_stats = tk.IntVar()
+        self.show_recent_stats.set(1)
+        ttk.Checkbutton(self.window, text=f"Show Stats of the Last {RECENT_HANDS} Hands",
+                        variable=self.show_recent_stats).pack()
+
         button_run = ttk.Button(self.window,
                                 text="Read and Analyze File",
                                 command=self.read_file
         ).pack()
+        ttk.Button(self.window,
+                   text="Follow Several Tables",
+                   command=self.follow_tables
+        ).pack()
+        ttk.Button(self.window,
+                   text="Watch Hand History Folder",
+                   command=self.watch_directory
+        ).pack()
+        button_run = ttk.Button(self.window,
+                                text="Cancel Reading",
+                                command=self.cancel_read
+        ).pack()
+        self.progress_bar = ttk.Progressbar(self.window, length=300, maximum=100)
+        self.progress_bar.pack()
+        self.status_var = tk.StringVar()
+        ttk.Label(self.window, textvariable=self.status_var).pack()
         button_run = ttk.Button(self.window,
                                 text="Save Game Data",
                                 command=self.save_data
@@ -243,8 +547,17 @@ class App:
                                  command=self.quit
         ).pack()
 
+        self.window.after(POLL_INTERVAL_MS, self.poll_worker)
         self.window.mainloop()
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='The Poker Spirit hud.')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.enable_from_arguments(args)
     app = App()
     app.main()
+    # let the worker finish (and stop its profile) before we sum everything up
+    app.worker.join(timeout=5)
+    instrumentation.dump_from_arguments(args)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Cheap timers and counters for the phases of reading hands and refreshing the hud, to find out
+where the time goes: reading the files, parsing, counting the stats, the db or redrawing the windows.
+Everything goes through the one INSTRUMENTATION object. It is off unless an entry point turns it on
+(e.g. python analyze_hands.py --instrument, or python hud.py --instrument), and while it is off
+a timer or a count is a single check of INSTRUMENTATION.enabled.
+It can also run cProfile in each thread that asks for it, and on exit it prints a summary table
+or writes everything to a json file.
+'''
+
+import io
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class Timer:
+    '''
+    A context manager that adds the time spent in it to a phase (and counts the call)
+    '''
+    __slots__ = 'instrumentation', 'name', 'start'
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.instrumentation.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+            self.start = None
+        return False
+
+
+class Instrumentation:
+    '''
+    Timers for phases (total seconds and number of calls) and plain counters, both by name.
+    Names are dotted by area, e.g. 'parse.hand', 'lines.seat', 'db.rows_scanned', 'hud.lines_redrawn'.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.profiles = []
+        self.profile_path = None
+        self.start_time = None
+
+    def enable(self, profile_path=None):
+        '''
+        Turns the timers and counters on. With profile_path, each thread that calls
+        start_profile (and this one) is profiled with cProfile, and the stats are saved there on dump.
+        '''
+        self.enabled = True
+        self.start_time = time.perf_counter()
+        self.profile_path = profile_path
+        if profile_path is not None:
+            self.start_profile()
+
+    def start_profile(self):
+        '''
+        Starts profiling the calling thread, if profiling was asked for
+        '''
+        if self.profile_path is None:
+            return
+        # only imported when profiling, so that turning the instrumentation off costs nothing at startup
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # newer pythons only allow one profiler at a time
+            print('instrumentation: could not profile another thread, only the first one is profiled')
+            return
+        with self.lock:
+            self.profiles.append((threading.get_ident(), profile))
+
+    def stop_profile(self):
+        '''
+        Stops profiling the calling thread (a profile can only be stopped from its own thread)
+        '''
+        with self.lock:
+            for thread_id, profile in self.profiles:
+                if thread_id == threading.get_ident():
+                    profile.disable()
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            # += on a defaultdict isn't atomic, and the hud counts from two threads
+            with self.lock:
+                self.counters[name] += amount
+
+    def add_counts(self, counts, prefix=''):
+        '''
+        Adds a whole dict of counts at once, e.g. the ones a loop kept locally
+        '''
+        if self.enabled:
+            with self.lock:
+                for name, amount in counts.items():
+                    self.counters[prefix + name] += amount
+
+    def summary(self):
+        '''
+        Returns everything measured so far as a dict, ready for json
+        '''
+        with self.lock:
+            return {
+                'wall_seconds': time.perf_counter() - self.start_time if self.start_time is not None else 0.0,
+                'phases': {
+                    name: {'seconds': self.seconds[name], 'calls': self.calls[name],
+                           'ms_per_call': 1000 * self.seconds[name] / self.calls[name]}
+                    for name in sorted(self.seconds)
+                },
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f'instrumentation over {summary["wall_seconds"]:.2f} seconds']
+        lines.append(f'{"phase":<24}{"seconds":>10}{"calls":>10}{"ms/call":>10}')
+        for name, phase in summary['phases'].items():
+            lines.append(f'{name:<24}{phase["seconds"]:>10.3f}{phase["calls"]:>10}{phase["ms_per_call"]:>10.3f}')
+        lines.append(f'{"counter":<24}{"count":>10}')
+        for name, count in summary['counters'].items():
+            lines.append(f'{name:<24}{count:>10}')
+        return '\n'.join(lines)
+
+    def dump(self, json_path=None):
+        '''
+        Prints the summary table (or writes the summary to json_path), and saves any cProfile stats
+        to the profile path, printing the functions that took the most time
+        '''
+        if not self.enabled:
+            return
+        if json_path is not None:
+            with open(json_path, 'w') as file:
+                json.dump(self.summary(), file, indent=2)
+            print(f'instrumentation written to {json_path}')
+        else:
+            print(self.format_summary())
+        if self.profiles:
+            import pstats
+            # any other thread that was profiled should have stopped its own profile by now
+            self.stop_profile()
+            profiles = [profile for _, profile in self.profiles]
+            stats = pstats.Stats(profiles[0], stream=io.StringIO())
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.profile_path)
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats('cumulative').print_stats(20)
+            print(output.getvalue())
+            print(f'profile written to {self.profile_path} (python -m pstats {self.profile_path})')
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+def add_arguments(parser):
+    '''
+    Adds the --instrument, --instrument-json and --profile options to an entry point's argparse parser
+    '''
+    parser.add_argument('--instrument', action='store_true',
+                        help='time each phase and count hands, lines, db rows and redraws; print a summary on exit')
+    parser.add_argument('--instrument-json', metavar='FILE', help='like --instrument, but write the summary to FILE as json')
+    parser.add_argument('--profile', metavar='FILE', help='also run cProfile, saving its stats to FILE')
+
+
+def enable_from_arguments(args):
+    '''
+    Turns the instrumentation on if any of the options from add_arguments were given
+    '''
+    if args.instrument or args.instrument_json or args.profile:
+        INSTRUMENTATION.enable(profile_path=args.profile)
+
+
+def dump_from_arguments(args):
+    INSTRUMENTATION.dump(json_path=args.instrument_json)
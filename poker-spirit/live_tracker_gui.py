@@ -162,11 +162,8 @@ class GuiGameIO(LiveGameIO):
     def end_hand(self):
         self.finish_hand()
         self.print_stats()
-        players_to_load = []
-        for player_name in self.current_players:
-            #if player_name not in self.career_stats_by_player:
-            players_to_load.append(player_name)
-        self.career_stats_by_player = self.db_manager.load_player_history(players_to_load, self.career_stats_by_player)
+        # players we have already loaded come from the db manager's cache
+        self.career_stats_by_player = self.db_manager.load_player_history(self)
         self.pwm.populate(self, self.career_stats_by_player)
         self.populate_game_window()
 
@@ -266,9 +263,10 @@ class GuiGameIO(LiveGameIO):
         
     
     def quit(self):
+        # the player windows are toplevels of the default root, i.e. the main window, so they go first
+        self.pwm.destroy()
         self.window.destroy()
         self.db_manager.insert_player_stats(self)        
-        self.pwm.destroy()
 
 
     def run(self):
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+'''
+Follows several PokerStars tables at once, each writing its own hand history file.
+Every table gets its own PokerStarsGameIO, which knows who is seated where and keeps that
+game's stats for the db, and every hand is also counted once in a SharedStats, so a player
+sitting at two tables has one set of session stats that the hud can read from another thread.
+A single thread polls the sizes of the files, so the db, the hand index and the event log
+are only ever used from that thread.
+
+A DirectoryWatcher finds the tables by itself, by watching the hand history directory for
+files that are new or growing.
+
+usage: python multi_table.py [FILE ...] [--watch DIRECTORY] [--save]
+'''
+
+import argparse
+import fnmatch
+import os
+import threading
+import time
+
+from analyze_hands import PokerStarsGameIO, assign_stats_from_hand
+from event_log import HandHistory
+from stats_matrix import StatsMatrix, RollingStats
+
+
+# how many of the latest hands of each table we keep in memory (see event_log.HandHistory)
+HANDS_KEPT = 500
+# how many of each player's latest hands their recent stats cover
+RECENT_HANDS = 100
+
+
+class SharedStats:
+    '''
+    The session stats of every player across all the tables, counting each hand once
+    (by its hand number), behind a lock so that the hud can read them while the tables are followed.
+    '''
+
+    def __init__(self, recent_hands=RECENT_HANDS):
+        self.lock = threading.Lock()
+        self.game_stats = StatsMatrix()
+        self.recent_stats = RollingStats(recent_hands) if recent_hands else None
+        self.hand_numbers = set()
+
+    def add_hand(self, hand):
+        '''
+        Counts the hand, unless it has been counted already. Returns whether it was counted.
+        '''
+        with self.lock:
+            if hand.hand_number is not None:
+                if hand.hand_number in self.hand_numbers:
+                    return False
+                self.hand_numbers.add(hand.hand_number)
+            assign_stats_from_hand(self.game_stats, hand)
+            if self.recent_stats is not None:
+                assign_stats_from_hand(self.recent_stats, hand)
+            return True
+
+    def select(self, player_names):
+        '''
+        Returns copies of the game stats and the recent stats (or None) of player_names
+        '''
+        with self.lock:
+            recent_stats = self.recent_stats.select(player_names) if self.recent_stats is not None else None
+            return self.game_stats.select(player_names), recent_stats
+
+
+class TablesSnapshot:
+    '''
+    What the hud windows need from all the tables at once, like hud.GameSnapshot does for one game:
+    everyone seated at any of the tables, with their stats from the SharedStats
+    '''
+
+    def __init__(self, tracker, career_stats_by_player):
+        self.game_id = None
+        self.num_tables = len(tracker.active)
+        self.num_hands = sum(len(game.hands) for game in tracker.tables.values())
+        self.current_players = tracker.current_players()
+        self.game_stats, self.recent_stats = tracker.shared_stats.select(self.current_players)
+        self.career_stats_by_player = career_stats_by_player
+
+
+class MultiTableTracker:
+    '''
+    Follows the hand history files given to add_table. Each poll looks at the size and
+    modification time of the file of every active table, and only analyzes the hands written
+    to the ones that changed. A table set_idle (e.g. one that has closed) keeps its game,
+    to be saved, but isn't polled and its players no longer count as seated.
+    '''
+    # how long run waits between polls
+    POLL_SECONDS = 0.2
+
+    def __init__(self, shared_stats=None, db_manager=None, hand_index=None, hands_kept=HANDS_KEPT):
+        self.shared_stats = shared_stats if shared_stats is not None else SharedStats()
+        self.db_manager = db_manager
+        self.hand_index = hand_index
+        self.hands_kept = hands_kept
+        # path -> the PokerStarsGameIO of the table
+        self.tables = {}
+        # the paths of the tables that are polled, in the order they were added
+        self.active = {}
+        # path -> (size, modification time) of the file when we last read it
+        self.file_states = {}
+
+    def add_table(self, path_to_file):
+        '''
+        Starts following the file (from its first hand), and returns its PokerStarsGameIO
+        '''
+        self.active[path_to_file] = None
+        game = self.tables.get(path_to_file)
+        if game is not None:
+            return game
+        ingested_hands = None
+        if self.db_manager is not None:
+            ingested_hands = self.db_manager.ingested_hands()
+        game = PokerStarsGameIO(path_to_file, hand_index=self.hand_index, ingested_hands=ingested_hands,
+                                hands=HandHistory(keep_last=self.hands_kept, spill=True))
+        game.shared_stats = self.shared_stats
+        self.tables[path_to_file] = game
+        return game
+
+    def remove_table(self, path_to_file):
+        '''
+        Stops following the file, and returns its PokerStarsGameIO (or None)
+        '''
+        self.file_states.pop(path_to_file, None)
+        self.active.pop(path_to_file, None)
+        game = self.tables.pop(path_to_file, None)
+        if game is not None:
+            game.hands.close()
+        return game
+
+    def set_idle(self, path_to_file):
+        '''
+        Stops polling the table's file until add_table is called with it again
+        '''
+        self.active.pop(path_to_file, None)
+
+    def poll(self, cancelled=None):
+        '''
+        Analyzes the new hands of every active table's file that has changed since the last poll.
+        Returns the PokerStarsGameIO of each table that had new hands.
+        '''
+        updated = []
+        for path_to_file in list(self.active):
+            game = self.tables[path_to_file]
+            try:
+                stat = os.stat(path_to_file)
+            except FileNotFoundError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if state == self.file_states.get(path_to_file):
+                continue
+            if game.analyze_new_hands(cancelled=cancelled):
+                updated.append(game)
+            if cancelled is not None and cancelled():
+                # there may be more hands in the file, so look at it again next time
+                break
+            self.file_states[path_to_file] = state
+        return updated
+
+    def run(self, on_update=None, stopped=None):
+        '''
+        Polls until stopped() returns True, calling on_update(updated games) after every poll
+        that found new hands
+        '''
+        while stopped is None or not stopped():
+            updated = self.poll(cancelled=stopped)
+            if updated and on_update is not None:
+                on_update(updated)
+            time.sleep(self.POLL_SECONDS)
+
+    def current_players(self):
+        ''' everyone seated at any of the active tables, each once '''
+        current_players = {}
+        for path_to_file in self.active:
+            current_players.update(dict.fromkeys(self.tables[path_to_file].current_players))
+        return list(current_players)
+
+    def load_player_history(self):
+        '''
+        Returns the career totals of everyone at the active tables, leaving out the games of
+        all the tracked tables (idle ones too), since the shared session stats already count them
+        '''
+        exclude_game_ids = {game.game_id for game in self.tables.values()}
+        return self.db_manager.career_stats().load(self.current_players(), exclude_game_ids)
+
+    def snapshot(self):
+        career_stats_by_player = self.load_player_history() if self.db_manager is not None else {}
+        return TablesSnapshot(self, career_stats_by_player)
+
+    def save(self):
+        '''
+        Saves the stats of every table's game to the db, in one transaction.
+        Tables whose files have the same name (so share a game id) are saved together, like bulk_import does.
+        '''
+        game_stats_by_game_id = {}
+        hand_numbers_by_game_id = {}
+        for game in self.tables.values():
+            if game.hand_numbers:
+                game_stats_by_game_id.setdefault(game.game_id, StatsMatrix()).merge(game.game_stats)
+                hand_numbers_by_game_id.setdefault(game.game_id, set()).update(game.hand_numbers)
+        return self.db_manager.insert_many_player_stats(game_stats_by_game_id, hand_numbers_by_game_id,
+                                                        games=self.tables.values())
+
+
+class DirectoryWatcher:
+    '''
+    Watches a hand history directory, and has the MultiTableTracker follow every table that is being played:
+    files that appear, files that grow, and (when we start) files written to in the last IDLE_SECONDS.
+    A table whose file hasn't grown for IDLE_SECONDS is set idle, so it is no longer polled.
+    Each poll stats the directory and the files of the active tables, so it costs the same however many
+    old files the directory holds. The directory is only listed again (with os.scandir) when its
+    modification time changes (a file was added or removed) and every FULL_SCAN_SECONDS, to catch
+    an idle file that is written to again (e.g. a table that is opened again the same day).
+    '''
+    FULL_SCAN_SECONDS = 30
+    IDLE_SECONDS = 300
+
+    def __init__(self, directory, tracker, pattern='*.txt'):
+        self.directory = directory
+        self.tracker = tracker
+        self.pattern = pattern
+        # path -> (size, modification time) of every matching file when the directory was last listed
+        self.file_states = {}
+        # path -> when (time.monotonic) an active table's file last had new hands
+        self.last_hand_times = {}
+        self.directory_mtime = None
+        self.last_scan_time = None
+        self.num_scans = 0
+
+    def scan(self, now):
+        '''
+        Lists the directory, and follows the files that are new or have changed since the last scan
+        '''
+        first_scan = self.last_scan_time is None
+        recent = time.time() - self.IDLE_SECONDS
+        file_states = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not fnmatch.fnmatch(entry.name, self.pattern) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                state = file_states[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                if entry.path in self.tracker.active:
+                    continue
+                if first_scan:
+                    changed = stat.st_mtime >= recent
+                else:
+                    changed = self.file_states.get(entry.path) != state
+                if changed:
+                    self.tracker.add_table(entry.path)
+                    self.last_hand_times[entry.path] = now
+        self.file_states = file_states
+        self.last_scan_time = now
+        self.num_scans += 1
+
+    def poll(self, cancelled=None):
+        '''
+        Looks for tables to follow, then analyzes the new hands of every active table.
+        Returns the PokerStarsGameIO of each table that had new hands.
+        '''
+        now = time.monotonic()
+        directory_mtime = os.stat(self.directory).st_mtime_ns
+        if directory_mtime != self.directory_mtime or now - self.last_scan_time >= self.FULL_SCAN_SECONDS:
+            self.directory_mtime = directory_mtime
+            self.scan(now)
+        updated = self.tracker.poll(cancelled)
+        for game in updated:
+            self.last_hand_times[game.path_to_file] = now
+        for path_to_file in list(self.tracker.active):
+            if now - self.last_hand_times.get(path_to_file, now) >= self.IDLE_SECONDS:
+                self.tracker.set_idle(path_to_file)
+                del self.last_hand_times[path_to_file]
+        return updated
+
+
+if __name__ == "__main__":
+    from db_management import PokerStarsDBManager
+
+    parser = argparse.ArgumentParser(description='Follow several hand history files at once (ctrl-c to stop).')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--watch', metavar='DIRECTORY', help='also follow every table being played in this directory')
+    parser.add_argument('--save', action='store_true', help='save the stats of every table to the db when stopped')
+    args = parser.parse_args()
+
+    tracker = MultiTableTracker(db_manager=PokerStarsDBManager())
+    for path_to_file in args.files:
+        tracker.add_table(path_to_file)
+    poller = DirectoryWatcher(args.watch, tracker) if args.watch else tracker
+
+    try:
+        while True:
+            updated = poller.poll()
+            if updated:
+                snapshot = tracker.snapshot()
+                print(f'{", ".join(game.game_id for game in updated)}: {snapshot.num_hands} hands '
+                      f'at {snapshot.num_tables} tables, {len(snapshot.current_players)} players seated')
+            time.sleep(tracker.POLL_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    if args.save:
+        print(f'saved {tracker.save()} player records')
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+'''
+Imports PokerStars hand histories into the stats db and reports every player's stats, without the gui,
+e.g. from cron or on a server. Takes any mix of files, directories (every *.txt file in them)
+and globs, analyzes them in parallel like bulk_import.py, and prints the stats as a table,
+csv or json. How long it took (and how many hands per second) goes to stderr, so the stats
+can be piped somewhere.
+
+usage: python report.py PATH [PATH ...] [--format table|csv|json] [--output FILE]
+                        [--career] [--min-hands N] [--processes N] [--no-save] [--no-index]
+'''
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+from bulk_import import biggest_first, import_and_save
+from db_management import PokerStarsDBManager
+from instrumentation import add_arguments, enable_from_arguments, dump_from_arguments
+from stats_matrix import StatsMatrix, RATIOS, STAT_FIELDS
+
+
+def expand_paths(paths, pattern='*.txt'):
+    '''
+    Returns every file named by paths, which can be files, directories (the files in them matching pattern)
+    or globs, each once, biggest first so that one big file doesn't hold up the end of the import
+    '''
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, pattern)))
+        elif glob.has_magic(path):
+            files.update(match for match in glob.glob(path, recursive=True) if os.path.isfile(match))
+        elif os.path.isfile(path):
+            files.add(path)
+        else:
+            print(f'no such file or directory: {path}', file=sys.stderr)
+    return biggest_first(files)
+
+
+def report_rows(game_stats, min_hands=0):
+    '''
+    Returns a row per player (most hands first) of their name, their counters and their ratios
+    (the percentage, or None if they never had the chance)
+    '''
+    ratios = game_stats.ratios()
+    rows = []
+    for player_name in game_stats:
+        stats = game_stats[player_name]
+        if stats['hands_played'] < min_hands:
+            continue
+        rows.append((player_name, {field: stats[field] for field in STAT_FIELDS}, ratios[player_name]))
+    rows.sort(key=lambda row: (-row[1]['hands_played'], row[0]))
+    return rows
+
+
+def write_table(rows, file):
+    headers = ['Player', 'Hands'] + [ratio.label for ratio in RATIOS]
+    table = [[player_name, str(stats['hands_played'])] +
+             ['NA' if ratios[ratio.name] is None else f'{ratios[ratio.name]:.1f}' for ratio in RATIOS]
+             for player_name, stats, ratios in rows]
+    widths = [max([len(header)] + [len(line[index]) for line in table]) for index, header in enumerate(headers)]
+    print('  '.join(header.ljust(width) if index == 0 else header.rjust(width)
+                    for index, (header, width) in enumerate(zip(headers, widths))), file=file)
+    for line in table:
+        print('  '.join(value.ljust(width) if index == 0 else value.rjust(width)
+                        for index, (value, width) in enumerate(zip(line, widths))), file=file)
+
+
+def write_csv(rows, file):
+    writer = csv.writer(file)
+    writer.writerow(['player_name'] + list(STAT_FIELDS) + [f'{ratio.name}_pct' for ratio in RATIOS])
+    for player_name, stats, ratios in rows:
+        writer.writerow([player_name] + [stats[field] for field in STAT_FIELDS] +
+                        ['' if ratios[ratio.name] is None else round(ratios[ratio.name], 1) for ratio in RATIOS])
+
+
+def write_json(rows, file):
+    json.dump({player_name: {'stats': stats, 'ratios': ratios} for player_name, stats, ratios in rows}, file, indent=2)
+    file.write('\n')
+
+
+WRITERS = {'table': write_table, 'csv': write_csv, 'json': write_json}
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Import PokerStars hand histories and report the stats of every player.')
+    parser.add_argument('paths', nargs='+', help='files, directories or globs (quote globs to use ** for subdirectories)')
+    parser.add_argument('--pattern', default='*.txt', help='the hand history files in a directory')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='table')
+    parser.add_argument('--output', help='write the stats to this file instead of stdout')
+    parser.add_argument('--career', action='store_true',
+                        help="report the players' career stats from the db (after this import) instead of just these hands")
+    parser.add_argument('--min-hands', type=int, default=0, help='leave out players with fewer hands than this')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default = number of cores)')
+    parser.add_argument('--no-save', action='store_true', help="don't write the stats to the db")
+    parser.add_argument('--no-index', action='store_true', help="don't add the hands to the hand index")
+    add_arguments(parser)
+    args = parser.parse_args()
+    enable_from_arguments(args)
+
+    paths = expand_paths(args.paths, args.pattern)
+    if not paths:
+        print('no hand history files found', file=sys.stderr)
+        return 1
+    num_bytes = sum(os.path.getsize(path) for path in paths)
+
+    start = time.perf_counter()
+    db_manager = PokerStarsDBManager()
+    result = import_and_save(paths, db_manager, args.processes, save=not args.no_save, index=not args.no_index)
+    game_stats_by_game_id = result.game_stats_by_game_id
+
+    game_stats = StatsMatrix()
+    for stats in game_stats_by_game_id.values():
+        game_stats.merge(stats)
+    if args.career:
+        game_stats = StatsMatrix()
+        player_names = dict.fromkeys(player_name for stats in game_stats_by_game_id.values() for player_name in stats)
+        career_stats_by_player = db_manager.storage.load_player_history(player_names)
+        for player_name, stats in career_stats_by_player.items():
+            game_stats[player_name] = stats
+
+    rows = report_rows(game_stats, args.min_hands)
+    if args.output:
+        with open(args.output, 'w', newline='' if args.format == 'csv' else None) as file:
+            WRITERS[args.format](rows, file)
+    else:
+        WRITERS[args.format](rows, sys.stdout)
+
+    total_seconds = time.perf_counter() - start
+    parse_seconds = result.parse_seconds
+    print(f'analyzed {len(paths)} files, {num_bytes / 1e6:.1f} MB and {result.num_hands} hands in {parse_seconds:.2f} seconds: '
+          f'{result.num_hands / parse_seconds:.1f} hands/sec, {num_bytes / 1e6 / parse_seconds:.1f} MB/sec '
+          f'({result.num_duplicate_hands} hands skipped as already saved in another game)', file=sys.stderr)
+    if not args.no_save:
+        print(f'saved {result.num_records} player records for {len(game_stats_by_game_id)} games in {result.save_seconds:.2f} seconds',
+              file=sys.stderr)
+    print(f'reported {len(rows)} players, {total_seconds:.2f} seconds in total', file=sys.stderr)
+    dump_from_arguments(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+'''
+A compact store for the stat counters of many players: one dense matrix of integers
+with a row per player and a column per stat, instead of a dict of dicts keyed by strings.
+'''
+
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping
+
+
+STAT_FIELDS = (
+    'hands_played', 'vpip', 'pfr',
+    '3_bet', '3_bet_opp', 'folds_3_bet_opp', 'calls_3_bet_opp',
+    '4_bet', '5_bet',
+    'folds_to_3_bet', 'calls_3_bet', 'seen_3_bet',
+    'c_bet', 'checks_c_bet_opp', 'c_bet_opp',
+    'folds_to_c_bet', 'calls_c_bet', 'raises_c_bet', 'seen_c_bet',
+    'double_barrel_opp', 'double_barrel', 'seen_turn_bet', 'folds_to_turn_bet',
+)
+STAT_INDEX = {field: index for index, field in enumerate(STAT_FIELDS)}
+NUM_STATS = len(STAT_FIELDS)
+
+# column indexes, in the same order as STAT_FIELDS
+HANDS_PLAYED, VPIP, PFR, \
+    _3_BET, _3_BET_OPP, FOLDS_3_BET_OPP, CALLS_3_BET_OPP, \
+    _4_BET, _5_BET, \
+    FOLDS_TO_3_BET, CALLS_3_BET, SEEN_3_BET, \
+    C_BET, CHECKS_C_BET_OPP, C_BET_OPP, \
+    FOLDS_TO_C_BET, CALLS_C_BET, RAISES_C_BET, SEEN_C_BET, \
+    DOUBLE_BARREL_OPP, DOUBLE_BARREL, SEEN_TURN_BET, FOLDS_TO_TURN_BET = range(NUM_STATS)
+
+
+# a stat that we show as a percentage: numerator out of denominator (both names of STAT_FIELDS).
+# With no opportunities yet it shows as "label = NA", or with na_counts as "label = 0/0 = NA"
+Ratio = namedtuple('Ratio', ['name', 'label', 'numerator', 'denominator', 'na_counts'], defaults=(False,))
+
+# every ratio that we show, in the order that GameIO.print_stats shows them.
+# Adding a stat to the display is adding a line here
+RATIOS = (
+    Ratio('vpip', 'VPIP', 'vpip', 'hands_played', na_counts=True),
+    Ratio('pfr', 'PFR', 'pfr', 'hands_played', na_counts=True),
+    Ratio('3_bet', '3-Bet', '3_bet', '3_bet_opp', na_counts=True),
+    # every time a player raised pre flop and saw a 3-bet, they could have 4-bet
+    Ratio('4_bet', '4-Bet', '4_bet', 'seen_3_bet'),
+    Ratio('folds_to_3_bet', 'Folds 3-Bet', 'folds_to_3_bet', 'seen_3_bet'),
+    Ratio('calls_3_bet', 'Calls 3-Bet', 'calls_3_bet', 'seen_3_bet'),
+    Ratio('folds_to_c_bet', 'Folds C-Bet', 'folds_to_c_bet', 'seen_c_bet'),
+    Ratio('calls_c_bet', 'Calls C-Bet', 'calls_c_bet', 'seen_c_bet'),
+    Ratio('raises_c_bet', 'Raises C-Bet', 'raises_c_bet', 'seen_c_bet'),
+    Ratio('c_bet', 'C-Bet', 'c_bet', 'c_bet_opp'),
+    Ratio('checks_c_bet_opp', 'Checks C-Bet Opp.', 'checks_c_bet_opp', 'c_bet_opp'),
+    Ratio('double_barrel', 'Double Barrel', 'double_barrel', 'double_barrel_opp'),
+    Ratio('folds_to_turn_bet', 'Folds Turn Bet', 'folds_to_turn_bet', 'seen_turn_bet'),
+)
+RATIO_BY_NAME = {ratio.name: ratio for ratio in RATIOS}
+
+
+def format_count(count):
+    # the counters of a DecayedStats are fractions
+    if isinstance(count, float):
+        return f'{count:.1f}'
+    return str(count)
+
+
+def format_ratio(ratio, numerator, denominator):
+    '''
+    e.g. "VPIP = 12/40 = 30.0"
+    '''
+    if denominator > 0:
+        return f'{ratio.label} = {format_count(numerator)}/{format_count(denominator)} = {round(100*numerator/denominator, 1)}'
+    if ratio.na_counts:
+        return f'{ratio.label} = {format_count(numerator)}/{format_count(denominator)} = NA'
+    return f'{ratio.label} = NA'
+
+
+class PlayerStats(Mapping):
+    '''
+    A view onto one player's row of a StatsMatrix, which reads like the defaultdict(int)
+    that used to hold a player's stats: a stat that has no column reads as 0.
+    '''
+    __slots__ = 'matrix', 'player_id', 'base'
+
+    def __init__(self, matrix, player_id):
+        self.matrix = matrix
+        self.player_id = player_id
+        self.base = player_id * NUM_STATS
+
+    def __getitem__(self, stat):
+        index = STAT_INDEX.get(stat)
+        if index is None:
+            return 0
+        return self.matrix.counts[self.base + index]
+
+    def __setitem__(self, stat, val):
+        self.matrix.counts[self.base + STAT_INDEX[stat]] = val
+        self.matrix.changes[self.player_id] += 1
+
+    def __iter__(self):
+        return iter(STAT_FIELDS)
+
+    def __len__(self):
+        return NUM_STATS
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class StatsMatrix(Mapping):
+    '''
+    Holds the counters of every player in a single array, with NUM_STATS columns per player.
+    Players get a row id the first time we see them, and it can be used like the dict
+    mapping player_name -> stats that it replaces (e.g. game_stats[player_name]['vpip']).
+    Every change to a player's row is counted in changes, so that anything derived from
+    the row (like StatLines) can tell when it is out of date.
+    '''
+
+    def __init__(self):
+        self.player_ids = {}
+        self.player_names = []
+        self.counts = array('q')
+        self.changes = array('q')
+
+    def player_id(self, player_name):
+        '''
+        Returns the row id of the player, adding an empty row if we haven't seen them before
+        '''
+        player_id = self.player_ids.get(player_name)
+        if player_id is None:
+            player_id = len(self.player_names)
+            self.player_ids[player_name] = player_id
+            self.player_names.append(player_name)
+            self.counts.frombytes(bytes(self.counts.itemsize * NUM_STATS)) # a row of zeros
+            self.changes.append(0)
+        return player_id
+
+    def add(self, player_id, columns):
+        ''' increments each of the given columns of the player's row by one '''
+        base = player_id * NUM_STATS
+        counts = self.counts
+        for column in columns:
+            counts[base + column] += 1
+        self.changes[player_id] += 1
+
+    def add_row(self, player_id, deltas):
+        ''' adds a full row of NUM_STATS deltas to the player's row '''
+        base = player_id * NUM_STATS
+        counts = self.counts
+        for column, delta in enumerate(deltas):
+            if delta:
+                counts[base + column] += delta
+        self.changes[player_id] += 1
+
+    def merge(self, game_stats):
+        '''
+        Adds in the stats of every player from another StatsMatrix
+        (or any mapping of player_name -> stats).
+        '''
+        if isinstance(game_stats, StatsMatrix):
+            for player_name, other_id in game_stats.player_ids.items():
+                other_base = other_id * NUM_STATS
+                self.add_row(self.player_id(player_name), game_stats.counts[other_base: other_base + NUM_STATS])
+        else:
+            for player_name, stats in game_stats.items():
+                self.add_row(self.player_id(player_name), [stats.get(field, 0) for field in STAT_FIELDS])
+        return self
+
+    def ratios(self, ratios=RATIOS):
+        '''
+        Computes every ratio for every player in one pass over the matrix.
+        Returns a dict mapping player_name -> {ratio name: percentage}, where the percentage
+        is None if the player never had the opportunity.
+        '''
+        columns = [(ratio.name, STAT_INDEX[ratio.numerator], STAT_INDEX[ratio.denominator]) for ratio in ratios]
+        counts = self.counts
+        all_ratios = {}
+        for player_id, player_name in enumerate(self.player_names):
+            row = counts[player_id * NUM_STATS: (player_id + 1) * NUM_STATS]
+            all_ratios[player_name] = {
+                name: 100 * row[numerator] / row[denominator] if row[denominator] > 0 else None
+                for name, numerator, denominator in columns
+            }
+        return all_ratios
+
+    def row(self, player_id):
+        return self.counts[player_id * NUM_STATS: (player_id + 1) * NUM_STATS]
+
+    def select(self, player_names):
+        '''
+        Returns a new StatsMatrix with a copy of the rows of those of player_names that we have,
+        e.g. to hand to another thread
+        '''
+        selected = StatsMatrix()
+        selected.counts = array(self.counts.typecode)
+        for player_name in player_names:
+            player_id = self.player_ids.get(player_name)
+            if player_id is not None:
+                selected.add_row(selected.player_id(player_name), self.row(player_id))
+        return selected
+
+    def __getitem__(self, player_name):
+        return PlayerStats(self, self.player_ids[player_name])
+
+    def __setitem__(self, player_name, stats):
+        player_id = self.player_id(player_name)
+        base = player_id * NUM_STATS
+        for index, field in enumerate(STAT_FIELDS):
+            self.counts[base + index] = stats.get(field, 0)
+        self.changes[player_id] += 1
+
+    def __contains__(self, player_name):
+        return player_name in self.player_ids
+
+    def __iter__(self):
+        return iter(self.player_names)
+
+    def __len__(self):
+        return len(self.player_names)
+
+    def __repr__(self):
+        return repr({player_name: dict(stats) for player_name, stats in self.items()})
+
+
+class StatLines:
+    '''
+    The formatted lines (see format_ratio) of a set of ratios for each player, worked out
+    in one pass over the player's counters and cached until they change.
+    With a StatsMatrix a player's lines are reused while their row hasn't changed;
+    with any other mapping of player_name -> stats, while their counters are all the same.
+    '''
+
+    def __init__(self, ratios=RATIOS):
+        self.ratios = tuple(ratios)
+        self.columns = [(ratio, STAT_INDEX[ratio.numerator], STAT_INDEX[ratio.denominator]) for ratio in self.ratios]
+        # player_name -> [the stats it came from, their number of changes, their counters, the lines]
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lines(self, game_stats, player_name):
+        '''
+        Returns a tuple of the lines of every ratio, in order, for the player
+        '''
+        entry = self.cache.get(player_name)
+        if isinstance(game_stats, StatsMatrix):
+            player_id = game_stats.player_ids[player_name]
+            changes = game_stats.changes[player_id]
+            if entry is not None and entry[0] is game_stats and entry[1] == changes:
+                self.hits += 1
+                return entry[3]
+            row = tuple(game_stats.row(player_id))
+        else:
+            changes = None
+            stats = game_stats[player_name]
+            row = tuple(stats.get(field, 0) for field in STAT_FIELDS)
+
+        if entry is not None and entry[2] == row:
+            self.hits += 1
+            entry[0], entry[1] = game_stats, changes
+            return entry[3]
+        self.misses += 1
+        lines = tuple(format_ratio(ratio, row[numerator], row[denominator]) for ratio, numerator, denominator in self.columns)
+        self.cache[player_name] = [game_stats, changes, row, lines]
+        return lines
+
+    def forget(self, player_name):
+        self.cache.pop(player_name, None)
+
+
+class RollingStats(StatsMatrix):
+    '''
+    The counters of each player's last window hands, e.g. to see that a regular has changed gears
+    when their career stats still show their long run average.
+    Counting a hand (with add, as assign_stats_from_hand does) remembers its columns in the player's
+    ring buffer; once the buffer is full, the columns of the hand it replaces are taken back out.
+    So an update costs the same however big the window is.
+    Only add keeps the window; rows set or merged in some other way are just counters.
+    '''
+
+    def __init__(self, window=100):
+        super().__init__()
+        self.window = window
+        # per player: the columns of each of their last window hands, and the slot the next hand goes in
+        self.rings = []
+        self.next_slots = array('q')
+
+    def player_id(self, player_name):
+        player_id = self.player_ids.get(player_name)
+        if player_id is None:
+            player_id = super().player_id(player_name)
+            self.rings.append([])
+            self.next_slots.append(0)
+        return player_id
+
+    def add(self, player_id, columns):
+        ring = self.rings[player_id]
+        if len(ring) < self.window:
+            ring.append(columns)
+        else:
+            slot = self.next_slots[player_id]
+            base = player_id * NUM_STATS
+            counts = self.counts
+            for column in ring[slot]:
+                counts[base + column] -= 1
+            ring[slot] = columns
+            self.next_slots[player_id] = (slot + 1) % self.window
+        super().add(player_id, columns)
+
+
+class DecayedStats(StatsMatrix):
+    '''
+    Counters that fade as a player plays more hands: every hand a player is dealt in scales their
+    counters down so that a hand counts half as much half_life hands later.
+    Like RollingStats this favours recent play, but without a hard edge, and it only keeps
+    one row per player. The counters are floats, so this is for display rather than the db.
+    '''
+
+    def __init__(self, half_life=100):
+        super().__init__()
+        self.counts = array('d')
+        self.half_life = half_life
+        self.decay = 0.5 ** (1 / half_life)
+
+    def add(self, player_id, columns):
+        base = player_id * NUM_STATS
+        counts = self.counts
+        decay = self.decay
+        for index in range(base, base + NUM_STATS):
+            counts[index] *= decay
+        for column in columns:
+            counts[base + column] += 1
+        self.changes[player_id] += 1
@@ -0,0 +1,35 @@
+'''
+The fixtures the tests share: a synthetic hand history in a scratch directory, and a stats db
+next to it (once for each kind of storage)
+'''
+
+import os
+import sys
+
+import pytest
+
+# the modules import each other by name, so they are found the same way here
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_management import DBManager, SQLiteStorage, TinyDBStorage
+from hand_history_generator import write_history
+
+
+@pytest.fixture
+def history(tmp_path):
+    ''' the path of a synthetic hand history of a couple hundred hands '''
+    return write_history(str(tmp_path / 'HH20200501 Synthetic.txt'), 200)
+
+
+@pytest.fixture(params=[SQLiteStorage, TinyDBStorage], ids=['sqlite', 'tinydb'])
+def db_manager_class(request, tmp_path):
+    file_name = 'player_stats.sqlite3' if request.param is SQLiteStorage else 'player_stats.db'
+    return type('TestDBManager', (DBManager,), {'FILE_NAME': str(tmp_path / file_name), 'STORAGE': request.param})
+
+
+@pytest.fixture
+def db_manager(db_manager_class):
+    db_manager = db_manager_class()
+    yield db_manager
+    db_manager.close()
+
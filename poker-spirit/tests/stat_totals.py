@@ -0,0 +1,34 @@
+'''
+Adds up stats as plain dicts, so that the tests can compare what was parsed with what was saved
+'''
+
+from stats_matrix import STAT_FIELDS
+
+
+def stats_totals(*all_game_stats):
+    '''
+    Returns a dict mapping every player in the game_stats (StatsMatrix or plain dicts) to their stats summed over all of them
+    '''
+    totals = {}
+    for game_stats in all_game_stats:
+        for player_name in game_stats:
+            stats = game_stats[player_name]
+            player_totals = totals.setdefault(player_name, dict.fromkeys(STAT_FIELDS, 0))
+            for field in STAT_FIELDS:
+                player_totals[field] += stats[field]
+    return totals
+
+
+def game_totals(*games):
+    '''
+    Returns a dict mapping every player of the games to their stats summed over all of them
+    '''
+    return stats_totals(*(game.game_stats for game in games))
+
+
+def career_totals(db_manager, player_names):
+    '''
+    Returns a dict mapping each of the players to their career totals in the db
+    '''
+    history = db_manager.storage.load_player_history(player_names)
+    return {player_name: {field: stats[field] for field in STAT_FIELDS} for player_name, stats in history.items()}
@@ -0,0 +1,53 @@
+'''
+The career totals kept per player: saving a game subtracts whatever was saved for it before
+and adds its new stats, so saving the same game again never counts it twice
+'''
+
+from analyze_hands import PokerStarsGameIO
+from hand_history_generator import write_history
+from stat_totals import game_totals, career_totals
+
+
+def test_saving_the_same_game_again_leaves_the_career_totals_alone(db_manager, history):
+    game = PokerStarsGameIO(history)
+    game.analyze_new_hands()
+    db_manager.insert_player_stats(game)
+    db_manager.insert_player_stats(game)
+    assert career_totals(db_manager, list(game.game_stats)) == game_totals(game)
+
+
+def test_saving_a_game_as_it_grows_replaces_what_was_saved_for_it(db_manager, history, tmp_path):
+    with open(history, 'rb') as file:
+        data = file.read()
+    path = tmp_path / 'HH20200501 Growing.txt'
+    path.write_bytes(data[:len(data) // 2])
+    game = PokerStarsGameIO(str(path))
+    game.analyze_new_hands()
+    db_manager.insert_player_stats(game)
+
+    with open(path, 'ab') as file:
+        file.write(data[len(data) // 2:])
+    game.analyze_new_hands()
+    db_manager.insert_player_stats(game)
+    assert career_totals(db_manager, list(game.game_stats)) == game_totals(game)
+
+
+def test_career_totals_add_up_every_game_and_survive_reopening(db_manager_class, db_manager, history, tmp_path):
+    other_history = write_history(str(tmp_path / 'HH20200502 Other.txt'), 150, seed=1)
+    games = []
+    for path in (history, other_history):
+        game = PokerStarsGameIO(path)
+        game.analyze_new_hands()
+        db_manager.insert_player_stats(game)
+        games.append(game)
+    # and again, all at once the way bulk_import saves
+    db_manager.insert_many_player_stats({game.game_id: game.game_stats for game in games},
+                                        {game.game_id: game.hand_numbers for game in games})
+    db_manager.close()
+
+    expected = game_totals(*games)
+    reopened = db_manager_class()
+    try:
+        assert career_totals(reopened, list(expected)) == expected
+    finally:
+        reopened.close()
@@ -0,0 +1,50 @@
+'''
+The event log: hands replay to the stats they were parsed into, even when several writers append to one log
+'''
+
+from analyze_hands import PokerStarsGameIO
+from event_log import EventLog
+from hand_history_generator import write_history
+from stat_totals import game_totals, stats_totals
+
+
+def test_writers_taking_turns_on_one_log(history, tmp_path):
+    game = PokerStarsGameIO(history)
+    game.analyze_new_hands()
+    other_game = PokerStarsGameIO(write_history(str(tmp_path / 'HH20200502 Other.txt'), 100, seed=1))
+    other_game.analyze_new_hands()
+    path = str(tmp_path / 'player_stats.events')
+
+    # like the hud saving now and then while bulk_import.py appends to the same log from cron
+    hud_log = EventLog(path)
+    hands = list(game.hands)
+    for hand in hands[:100]:
+        hud_log.add_hand(game.game_id, hand)
+    hud_log.flush()
+    other_log = EventLog(path)
+    for hand in other_game.hands:
+        other_log.add_hand(other_game.game_id, hand)
+    other_log.flush()
+    for hand in hands[100:]:
+        hud_log.add_hand(game.game_id, hand)
+    hud_log.flush()
+
+    event_log = EventLog(path)
+    for from_events in (False, True):
+        game_stats_by_game_id, hand_numbers_by_game_id = event_log.replay(from_events=from_events)
+        assert hand_numbers_by_game_id == {game.game_id: game.hand_numbers, other_game.game_id: other_game.hand_numbers}
+        assert stats_totals(game_stats_by_game_id[game.game_id]) == game_totals(game)
+        assert stats_totals(game_stats_by_game_id[other_game.game_id]) == game_totals(other_game)
+
+
+def test_closing_the_db_writes_the_buffered_hands(db_manager_class, history):
+    game = PokerStarsGameIO(history)
+    game.analyze_new_hands()
+    db_manager = db_manager_class()
+    event_log = db_manager.event_log()
+    for hand in game.hands:
+        event_log.add_hand(game.game_id, hand)
+    db_manager.close()
+
+    _, hand_numbers_by_game_id = EventLog(event_log.file_name).replay()
+    assert hand_numbers_by_game_id == {game.game_id: game.hand_numbers}
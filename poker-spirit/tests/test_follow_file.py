@@ -0,0 +1,64 @@
+'''
+PokerStarsGameIO.analyze_new_hands (what run_file does) on a file that PokerStars is still writing:
+each call picks up from the byte offset where the last one stopped, so every hand is counted exactly once
+'''
+
+from analyze_hands import PokerStarsGameIO
+from stat_totals import game_totals
+
+
+def follow_in_pieces(data, path, cuts):
+    '''
+    Writes data to path a piece at a time (each ending at the next of cuts), running the game
+    on the file after every piece the way the hud polls it, and returns the game
+    '''
+    game = PokerStarsGameIO(str(path))
+    written = 0
+    for cut in cuts:
+        with open(path, 'ab') as file:
+            file.write(data[written:cut])
+        written = cut
+        game.analyze_new_hands()
+        assert game.file_offset <= written
+    return game
+
+
+def test_following_a_growing_file_counts_each_hand_once(history, tmp_path):
+    whole = PokerStarsGameIO(history)
+    whole.analyze_new_hands()
+    with open(history, 'rb') as file:
+        data = file.read()
+
+    # the pieces end partway through lines and hands (and one in the middle of a hand number),
+    # as they do when PokerStars is part way through writing a hand
+    hand_start = data.index(b'Hand #', len(data) // 2)
+    cuts = [len(data) // 3, len(data) // 3 + 1, hand_start + len('Hand #') + 2, len(data) - 5, len(data)]
+    game = follow_in_pieces(data, tmp_path / 'HH20200501 Growing.txt', cuts)
+
+    assert game.hand_numbers == whole.hand_numbers
+    assert len(game.hands) == len(whole.hands)
+    assert game_totals(game) == game_totals(whole)
+
+
+def test_a_hand_still_being_written_is_left_for_the_next_call(history, tmp_path):
+    with open(history, 'rb') as file:
+        data = file.read()
+    second_hand = data.index(b'PokerStars Hand #', data.index(b'PokerStars Hand #') + 1)
+    path = tmp_path / 'HH20200501 Growing.txt'
+
+    # the first hand is followed by its blank lines, so it's done, and the second has only just started
+    game = follow_in_pieces(data, path, [second_hand + 40])
+    assert len(game.hands) == 1
+    assert game.file_offset <= second_hand
+
+    with open(path, 'ab') as file:
+        file.write(data[second_hand + 40:])
+    game.analyze_new_hands()
+    assert len(game.hands) == 200
+
+
+def test_running_again_on_an_unchanged_file_reads_nothing(history):
+    game = PokerStarsGameIO(history)
+    assert game.analyze_new_hands() == 200
+    assert game.analyze_new_hands() == 0
+    assert len(game.hands) == 200
@@ -0,0 +1,82 @@
+'''
+Hands already saved as part of one game are skipped when they turn up in another,
+e.g. a copy of a hand history under another name
+'''
+
+import shutil
+
+from analyze_hands import PokerStarsGameIO
+from bulk_import import bulk_import, import_and_save
+from stats_matrix import STAT_FIELDS
+from stat_totals import game_totals, career_totals
+
+
+def read_and_save(db_manager, path):
+    game = PokerStarsGameIO(str(path), ingested_hands=db_manager.ingested_hands())
+    game.analyze_new_hands()
+    db_manager.insert_player_stats(game)
+    return game
+
+
+def test_a_renamed_copy_of_a_saved_file_is_skipped(db_manager, history, tmp_path):
+    game = read_and_save(db_manager, history)
+    copy = tmp_path / 'HH20200501 Renamed.txt'
+    shutil.copy(history, copy)
+
+    copied_game = read_and_save(db_manager, copy)
+    assert copied_game.num_duplicate_hands == len(game.hands)
+    assert not copied_game.hand_numbers
+    assert len(copied_game.game_stats) == 0
+    assert career_totals(db_manager, list(game.game_stats)) == game_totals(game)
+
+
+def test_saved_hands_are_skipped_after_reopening_the_db(db_manager_class, db_manager, history, tmp_path):
+    game = read_and_save(db_manager, history)
+    db_manager.close()
+    copy = tmp_path / 'HH20200501 Renamed.txt'
+    shutil.copy(history, copy)
+
+    reopened = db_manager_class()
+    try:
+        copied_game = read_and_save(reopened, copy)
+        assert copied_game.num_duplicate_hands == len(game.hands)
+        assert career_totals(reopened, list(game.game_stats)) == game_totals(game)
+    finally:
+        reopened.close()
+
+
+def test_reading_the_same_file_again_still_counts_its_hands(db_manager, history):
+    game = read_and_save(db_manager, history)
+    # the hands were saved as part of this very game, so they aren't duplicates of it
+    again = read_and_save(db_manager, history)
+    assert again.num_duplicate_hands == 0
+    assert again.hand_numbers == game.hand_numbers
+    assert career_totals(db_manager, list(game.game_stats)) == game_totals(game)
+
+
+def test_bulk_import_skips_a_renamed_copy(db_manager_class, db_manager, history, tmp_path):
+    game = read_and_save(db_manager, history)
+    copy = tmp_path / 'HH20200501 Renamed.txt'
+    shutil.copy(history, copy)
+
+    _, hand_numbers_by_game_id, num_duplicate_hands = \
+        bulk_import([str(copy)], processes=1, db_manager_class=db_manager_class)
+    assert num_duplicate_hands == len(game.hands)
+    assert not hand_numbers_by_game_id['HH20200501 Renamed']
+
+
+def test_same_name_copies_in_one_import_are_counted_once(db_manager, history, tmp_path):
+    game = PokerStarsGameIO(history)
+    game.analyze_new_hands()
+    copies = []
+    for directory in ('one', 'two'):
+        (tmp_path / directory).mkdir()
+        copies.append(shutil.copy(history, tmp_path / directory))
+
+    result = import_and_save(copies, db_manager, processes=1, index=False)
+    assert result.num_hands == len(game.hands)
+    assert result.num_duplicate_hands == len(game.hands)
+    imported_stats = result.game_stats_by_game_id[game.game_id]
+    assert {player_name: {field: stats[field] for field in STAT_FIELDS} for player_name, stats in imported_stats.items()} \
+        == game_totals(game)
+    assert career_totals(db_manager, list(game.game_stats)) == game_totals(game)
@@ -0,0 +1,34 @@
+'''
+Several tables followed at once: the session stats already count every tracked table's hands,
+so the career totals shown next to them leave out all of those games, even after a save
+'''
+
+from analyze_hands import PokerStarsGameIO
+from hand_history_generator import write_history, HERO
+from multi_table import MultiTableTracker
+from stats_matrix import STAT_FIELDS
+from stat_totals import game_totals
+
+
+def test_career_stats_leave_out_every_tracked_table_after_a_save(db_manager, history, tmp_path):
+    # an earlier session, which is all the career totals should hold
+    earlier = PokerStarsGameIO(history)
+    earlier.analyze_new_hands()
+    db_manager.insert_player_stats(earlier)
+
+    tracker = MultiTableTracker(db_manager=db_manager)
+    paths = [write_history(str(tmp_path / f'HH20200502 Table {seed}.txt'), 60, seed=seed, table_name=f'Table {seed}')
+             for seed in (1, 2)]
+    for path in paths:
+        tracker.add_table(path)
+    tracker.poll()
+    # the second table closes, but its hands are still in the session stats
+    tracker.set_idle(paths[1])
+    tracker.save()
+
+    career_stats_by_player = tracker.load_player_history()
+    assert HERO in career_stats_by_player
+    expected = game_totals(earlier)
+    for player_name, career_stats in career_stats_by_player.items():
+        assert {field: career_stats[field] for field in STAT_FIELDS} == \
+            expected.get(player_name, {field: 0 for field in STAT_FIELDS})